@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import logging
+import sys
+
+from src.log_config import add_log_arguments, configure_logging
+from src.profiling import add_profile_arguments, profile_session
+
+logger = logging.getLogger(__name__)
+
+TEXT_MODEL = "gpt-4o"
+MULTIMODAL_MODEL = "gpt-4o"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Offline HTP screening through a provider batch API")
+    parser.add_argument("inputs", nargs="+", help="Image files or folders of images")
+    parser.add_argument("--output", type=str, required=True, help="JSONL file to write one HTPOutput record per drawing to")
+    parser.add_argument("--work_dir", type=str, default="batch_work", help="Folder for request files and resumable run state")
+    parser.add_argument("--provider", choices=["openai", "local"], default="openai",
+                        help="'local' runs an in-process stand-in instead of calling the API")
+    parser.add_argument("--poll_interval", type=float, default=None, help="Seconds between batch status checks")
+    parser.add_argument("--completion_window", type=str, default="24h", help="Batch completion window")
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="Seconds the whole run may take; unfinished batches are cancelled and partial results written")
+    parser.add_argument("--language", type=str, default="en", help="Language of the analysis report")
+    add_profile_arguments(parser)
+    add_log_arguments(parser)
+
+    return parser.parse_args()
+
+def collect_images(inputs):
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths.extend(
+                os.path.join(item, name) for name in sorted(os.listdir(item))
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        else:
+            paths.append(item)
+    return paths
+
+def main():
+    config = get_args()
+    configure_logging(config.log_level)
+
+    from dotenv import load_dotenv
+
+    from src.app.models import to_htp_output
+    from src.batch_jobs import POLL_INTERVAL, BatchScreening, LocalBatchProvider, OpenAIBatchProvider
+    from src.custom_chat_openai import ChatOpenAI
+    from src.model_langchain import HTPModel
+
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY", "")
+    base_url = os.getenv("OPENAI_BASE_URL")
+    if config.provider == "openai" and not api_key:
+        logger.error("OPENAI_API_KEY environment variable not set.")
+        sys.exit(1)
+
+    image_paths = collect_images(config.inputs)
+    if not image_paths:
+        logger.error("No images found.")
+        sys.exit(1)
+    logger.info(f"Screening {len(image_paths)} drawings with the {config.provider} batch provider")
+
+    # The clients are only used to build request bodies, nothing is sent through them
+    model = HTPModel(
+        text_model=ChatOpenAI(api_key=api_key, base_url=base_url, model_name=TEXT_MODEL, temperature=0.2),
+        multimodal_model=ChatOpenAI(api_key=api_key, base_url=base_url, model_name=MULTIMODAL_MODEL, temperature=0.2),
+        language=config.language,
+    )
+    if config.provider == "local":
+        provider = LocalBatchProvider()
+        poll_interval = 0 if config.poll_interval is None else config.poll_interval
+    else:
+        provider = OpenAIBatchProvider(api_key, base_url, completion_window=config.completion_window)
+        poll_interval = POLL_INTERVAL if config.poll_interval is None else config.poll_interval
+
+    # The local stand-in keeps its batches in memory, so there is nothing to resume
+    screening = BatchScreening(
+        model, provider, config.work_dir, poll_interval=poll_interval,
+        resume=config.provider != "local", deadline=config.deadline
+    )
+    with profile_session(config.profile, config.profile_mode):
+        results = screening.run(image_paths)
+
+    with open(config.output, "w", encoding="utf-8") as f:
+        for image_path, result in zip(image_paths, results):
+            record = {"image": image_path, "image_ref": result.get("image_ref"), **to_htp_output(result).model_dump()}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    logger.info(f"Wrote {len(results)} results to {config.output}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        logger.error(f"Error running batch screening: {str(e)}", exc_info=True)
+        sys.exit(1)
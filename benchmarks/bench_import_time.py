@@ -0,0 +1,70 @@
+"""
+Measure start-up cost of the command line entry points.
+
+    python benchmarks/bench_import_time.py --runs 5 --top 15
+
+Every target runs in a fresh interpreter. The median wall time is reported,
+followed by the slowest imports from `python -X importtime` for each target,
+which shows which modules still load eagerly.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+TARGETS = {
+    "run.py --help": ["run.py", "--help"],
+    "deploy.py --help": ["deploy.py", "--help"],
+    "import htp_analyzer": ["-c", "import htp_analyzer"],
+    "import src.model_langchain": ["-c", "import src.model_langchain"],
+}
+
+
+def time_target(args, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def slowest_imports(args, top: int):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + args,
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # Keep the indentation after the separator space, it encodes the nesting depth
+        rows.append((int(cumulative_us), name[1:].rstrip()))
+    # Only top-level packages, nested modules are already included in their parent's cumulative time
+    top_level = [(us, name) for us, name in rows if not name.startswith(" ")]
+    return sorted(top_level, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Entry point import-time benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'target':<28} {'median s':>9}")
+    for name, target in TARGETS.items():
+        print(f"{name:<28} {time_target(target, args.runs):>9.3f}")
+
+    for name, target in TARGETS.items():
+        print(f"\nSlowest imports for {name}:")
+        for cumulative_us, module in slowest_imports(target, args.top):
+            print(f"  {cumulative_us / 1000:>8.1f} ms  {module}")
+
+
+if __name__ == "__main__":
+    main()
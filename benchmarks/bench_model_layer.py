@@ -0,0 +1,236 @@
+"""
+Regression benchmarks for the CPU-bound parts of the model layer, with the LLM mocked.
+
+    python benchmarks/bench_model_layer.py                  # compare with the stored baseline
+    python benchmarks/bench_model_layer.py --save           # record a new baseline
+    python benchmarks/bench_model_layer.py --only convert   # cases whose name contains "convert"
+
+Each case reports throughput (operations per second, best of --repeats timed
+rounds of at least --min-time seconds) and the peak traced memory of one
+operation, measured in a separate run so tracemalloc does not slow the timed
+rounds down. The comparison fails (exit status 1) when throughput drops by
+more than --max-slowdown or peak memory grows by more than
+--max-memory-growth relative to the baseline. Cases faster than
+--min-gated-time per operation are reported but left out of the throughput
+gate: at that scale call overhead and timer noise swing the result by more
+than the threshold. Baselines are machine specific: record one per machine
+before comparing.
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+# Keep the benchmark's image store out of the real one
+os.environ.setdefault("PSYDRAW_IMAGE_STORE", os.path.join(tempfile.mkdtemp(prefix="psydraw-bench-"), "images"))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baselines", "model_layer.json")
+MAX_SLOWDOWN = 0.25
+MAX_MEMORY_GROWTH = 0.20
+# Operations faster than this are too noisy to gate on throughput
+MIN_GATED_TIME = 10e-6
+
+
+def make_drawing(size: int = 1600, seed: int = 0) -> bytes:
+    """A PNG roughly the size of a scanned drawing: lines on light noise."""
+    from PIL import Image, ImageDraw
+
+    noise = Image.frombytes("RGB", (size, size), random.Random(seed).randbytes(size * size * 3))
+    image = Image.blend(Image.new("RGB", (size, size), "white"), noise, 0.15)
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((100, 600, 600, 1100), outline="black", width=6)
+    draw.ellipse((800, 200, 1200, 700), outline="green", width=6)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class FakeChatModel:
+    """Stands in for ChatOpenAI: answers instantly with a fixed analysis and usage."""
+
+    def __init__(self, content: str):
+        self.content = content
+
+    def invoke(self, messages, **kwargs):
+        from langchain_core.messages import AIMessage
+
+        return AIMessage(content=self.content, response_metadata={
+            "token_usage": {"prompt_tokens": 1200, "completion_tokens": 600, "total_tokens": 1800},
+            "finish_reason": "stop",
+        })
+
+
+def build_cases() -> Dict[str, Tuple[Callable[[], Any], int]]:
+    """name -> (operation, operations per call). Setup happens here, outside the timings."""
+    from langchain_core.messages import HumanMessage
+
+    from src.app.models import to_htp_output
+    from src.custom_chat_openai import ChatOpenAI
+    from src.image_store import DataURLCache, get_image_store, image_ref
+    from src.mock_openai import ANALYSIS_TEXT
+    from src.model_langchain import HTPModel, is_base64_or_path, is_generic_response, load_image, parse_packed_response
+    from src.payload import encode_chat_body
+    from src.report_export import results_zip
+
+    store = get_image_store()
+    png = make_drawing()
+    digest = store.put(png)
+    ref = image_ref(digest)
+    data_url = load_image(ref)[0]
+    b64 = data_url.split(",", 1)[1]
+
+    client = ChatOpenAI(api_key="bench", model_name="gpt-4o")
+    messages = [HumanMessage(content=[
+        {"type": "text", "text": "Analyze this House-Tree-Person drawing. " * 40},
+        {"type": "image_url", "image_url": {"url": data_url}},
+    ])]
+    openai_messages = client._convert_messages_to_openai_format(messages)
+    body = client._build_request_data(openai_messages, "gpt-4o")
+
+    long_text = (ANALYSIS_TEXT + " ") * 20
+    model = HTPModel(text_model=FakeChatModel(long_text), multimodal_model=FakeChatModel(long_text))
+    result = model.workflow(ref)
+    packed = json.dumps({"drawings": [{"id": str(i), "analysis": long_text} for i in range(4)]})
+    export = [
+        {"file_name": f"drawing_{i}.png", "image_ref": digest, "success": True, "analysis_result": result}
+        for i in range(10)
+    ]
+
+    def cold_data_url():
+        return DataURLCache().get(store, digest)
+
+    def jpeg_variant():
+        path = store.path(digest, "jpeg")
+        if os.path.exists(path):
+            os.remove(path)
+        return store.variant(digest, "jpeg")
+
+    return {
+        "image: data URL encode (cold)": (cold_data_url, 1),
+        "image: load_image (cached ref)": (lambda: load_image(ref), 1),
+        "image: jpeg variant": (jpeg_variant, 1),
+        "is_base64_or_path (base64)": (lambda: is_base64_or_path(b64), 1),
+        "convert_messages (1 image)": (lambda: client._convert_messages_to_openai_format(messages), 1),
+        "encode_chat_body (1 image)": (lambda: encode_chat_body(body), 1),
+        "phrase scan: is_generic_response": (lambda: is_generic_response(long_text), 1),
+        "phrase scan: text_messages": (lambda: model.text_messages(long_text), 1),
+        "parse_packed_response (4)": (lambda: parse_packed_response(packed, ["0", "1", "2", "3"]), 1),
+        "result: to_htp_output + dump": (lambda: to_htp_output(result).model_dump_json(), 1),
+        "workflow (mock LLM)": (lambda: model.workflow(ref), 1),
+        "export: docx + zip (10)": (lambda: results_zip(export, "disclaimer"), 10),
+    }
+
+
+def measure(operation: Callable[[], Any], per_call: int, repeats: int, min_time: float) -> Dict[str, float]:
+    operation()  # warm caches and lazy imports
+    # Size a round to take at least min_time
+    calls, elapsed = 1, 0.0
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            operation()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or calls >= 1_000_000:
+            break
+        calls *= 2 if elapsed == 0 else max(2, min(10, int(min_time / elapsed) + 1))
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            operation()
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"ops_per_sec": round(calls * per_call / best, 2), "peak_kib": round(peak / 1024, 1)}
+
+
+def is_gated(ops_per_sec: float, min_gated_time: float) -> bool:
+    return ops_per_sec * min_gated_time <= 1
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Any],
+    max_slowdown: float,
+    max_memory_growth: float,
+    min_gated_time: float = MIN_GATED_TIME,
+) -> List[str]:
+    failures = []
+    for name, current in results.items():
+        base = baseline["cases"].get(name)
+        if base is None:
+            continue
+        speed = current["ops_per_sec"] / base["ops_per_sec"]
+        memory = current["peak_kib"] / base["peak_kib"] if base["peak_kib"] else 1.0
+        if speed < 1 - max_slowdown and is_gated(base["ops_per_sec"], min_gated_time):
+            failures.append(f"{name}: throughput {current['ops_per_sec']} ops/s is {1 - speed:.0%} below baseline {base['ops_per_sec']}")
+        # Ignore growth of allocations too small to matter
+        if memory > 1 + max_memory_growth and current["peak_kib"] - base["peak_kib"] > 64:
+            failures.append(f"{name}: peak memory {current['peak_kib']} KiB is {memory - 1:.0%} above baseline {base['peak_kib']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--only", default=None, help="Only run cases whose name contains this text")
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per timed round")
+    parser.add_argument(
+        "--min-gated-time", type=float, default=MIN_GATED_TIME,
+        help="Seconds per operation below which a case is reported but not gated on throughput",
+    )
+    parser.add_argument("--max-slowdown", type=float, default=MAX_SLOWDOWN)
+    parser.add_argument("--max-memory-growth", type=float, default=MAX_MEMORY_GROWTH)
+    args = parser.parse_args()
+
+    cases = build_cases()
+    results = {}
+    print(f"{'case':<36} {'ops/s':>12} {'peak KiB':>10}")
+    for name, (operation, per_call) in cases.items():
+        if args.only and args.only not in name:
+            continue
+        results[name] = measure(operation, per_call, args.repeats, args.min_time)
+        note = "" if is_gated(results[name]["ops_per_sec"], args.min_gated_time) else "  (not gated)"
+        print(f"{name:<36} {results[name]['ops_per_sec']:>12,.1f} {results[name]['peak_kib']:>10,.1f}{note}")
+
+    machine = {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.machine()}
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"machine": machine, "cases": results}, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, record one with --save")
+        return
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("machine") != machine:
+        print(f"Warning: baseline was recorded on {baseline.get('machine')}, this is {machine}")
+    failures = compare(results, baseline, args.max_slowdown, args.max_memory_growth, args.min_gated_time)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if failures:
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Compare the CPU cost of serializing chat payloads with large embedded images.
+
+    python benchmarks/bench_serialization.py --image-mb 1 2 4 --concurrency 1 4 8
+
+Each strategy is run at every concurrency level with a thread pool (the way the
+Streamlit and API workers call the client) and reports CPU milliseconds per
+request and the resulting body size.
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from src import serialization
+from src.payload import encode_chat_body
+
+
+def make_payload(image_mb: float) -> dict:
+    raw = os.urandom(int(image_mb * 1024 * 1024))
+    data_url = "data:image/jpeg;base64," + base64.b64encode(raw).decode("ascii")
+    return {
+        "model": "gpt-4o",
+        "messages": [
+            {"role": "user", "content": [
+                {"type": "text", "text": "Analyze this House-Tree-Person drawing. " * 40},
+                {"type": "image_url", "image_url": {"url": data_url}},
+            ]}
+        ],
+        "temperature": 0.2,
+        "max_tokens": 4096,
+    }
+
+
+def requests_json(payload):
+    # What session.post(json=...) does internally
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def spliced(name):
+    def run(payload):
+        serialization.set_serializer(name)
+        return encode_chat_body(payload)
+    return run
+
+
+def spliced_gzip(payload):
+    serialization.set_serializer("auto")
+    return serialization.gzip_body(encode_chat_body(payload))
+
+
+def strategies():
+    result = {"requests json=": requests_json, "spliced (json)": spliced("json")}
+    if "orjson" in serialization.SERIALIZERS:
+        result["spliced (orjson)"] = spliced("orjson")
+    result["spliced + gzip"] = spliced_gzip
+    return result
+
+
+def measure(func, payload, concurrency: int, requests_per_worker: int):
+    def worker(_):
+        size = 0
+        for _ in range(requests_per_worker):
+            size = len(func(payload))
+        return size
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        sizes = list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    total = concurrency * requests_per_worker
+    return cpu / total * 1000, wall / total * 1000, sizes[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat payload serialization benchmark")
+    parser.add_argument("--image-mb", type=float, nargs="+", default=[1.0, 4.0])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=10, help="Requests per worker")
+    args = parser.parse_args()
+
+    print(f"{'image':>7} {'conc':>5} {'strategy':<18} {'cpu ms/req':>11} {'wall ms/req':>12} {'body bytes':>12}")
+    for image_mb in args.image_mb:
+        payload = make_payload(image_mb)
+        for concurrency in args.concurrency:
+            baseline = None
+            for name, func in strategies().items():
+                cpu_ms, wall_ms, size = measure(func, payload, concurrency, args.requests)
+                baseline = baseline or cpu_ms
+                saved = f"  (-{baseline - cpu_ms:.1f} ms)" if cpu_ms < baseline else ""
+                print(f"{image_mb:>5.1f}MB {concurrency:>5} {name:<18} {cpu_ms:>11.2f} {wall_ms:>12.2f} {size:>12}{saved}")
+    serialization.set_serializer("auto")
+
+
+if __name__ == "__main__":
+    main()
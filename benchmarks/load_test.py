@@ -0,0 +1,317 @@
+"""
+Load test of the FastAPI service (/v1/predict) with a local stand-in for the LLM backend.
+
+    python benchmarks/load_test.py --mode closed --concurrency 1 4 16 --sizes 512 1600
+    python benchmarks/load_test.py --mode open --rates 0.5 1 2 4 --latency 1.5
+    python benchmarks/load_test.py --url http://127.0.0.1:9557 --mode closed --concurrency 8
+
+By default create_app(model) is served in-process by uvicorn (own thread and
+event loop) with the model's ChatOpenAI pointed at the mock server of
+src/mock_openai.py, which answers every chat completion after --latency
+seconds. --backend-url uses another OpenAI-compatible backend instead, and
+--url load-tests an already running service (no event-loop lag is measured
+then).
+
+Closed-loop mode keeps N requests in flight (each worker sends the next
+request when the previous one answers); open-loop mode sends requests at a
+fixed rate whether or not earlier ones finished, with latency measured from
+the scheduled send time so a saturated server shows up as growing latency
+rather than as a lower send rate. Every level of the sweep reports achieved
+requests per second, latency percentiles, the error rate and, in-process,
+how late the server's event loop ran a periodic timer (event-loop lag).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+# Keep the load test's images out of the real store
+os.environ.setdefault("PSYDRAW_IMAGE_STORE", os.path.join(tempfile.mkdtemp(prefix="psydraw-load-"), "images"))
+
+from bench_model_layer import make_drawing
+from src.log_config import add_log_arguments, configure_logging
+
+# Distinct drawings per size, so per-image caches do not turn the test into a cache benchmark
+VARIANTS = 4
+LAG_INTERVAL = 0.01
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile (q in 0..100) of values, None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def make_bodies(size: int, language: str) -> List[bytes]:
+    """Pre-encoded /v1/predict request bodies, so the client spends no CPU on them during the test."""
+    return [
+        json.dumps({"image_path": base64.b64encode(make_drawing(size, seed)).decode("ascii"), "language": language}).encode("utf-8")
+        for seed in range(VARIANTS)
+    ]
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic timer fires on an event loop: time the loop spent blocked."""
+
+    def __init__(self, interval: float = LAG_INTERVAL):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def reset(self) -> List[float]:
+        samples, self.samples = self.samples, []
+        return samples
+
+
+class InProcessServer:
+    """create_app(model) under uvicorn in a background thread with its own event loop."""
+
+    def __init__(self, backend_url: str, api_key: str, model_name: str):
+        import uvicorn
+
+        from src.app.api import create_app
+        from src.custom_chat_openai import ChatOpenAI
+        from src.model_langchain import HTPModel
+
+        client = ChatOpenAI(api_key=api_key, base_url=backend_url, model_name=model_name, temperature=0.2)
+        app = create_app(HTPModel(text_model=client, multimodal_model=client))
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+        self.loop = asyncio.new_event_loop()
+        self.lag = LoopLagMonitor()
+        self._thread = threading.Thread(target=self.loop.run_until_complete, args=(self._serve(),), name="uvicorn", daemon=True)
+
+    async def _serve(self) -> None:
+        self.lag.start()
+        try:
+            await self.server.serve()
+        finally:
+            await self.lag.stop()
+
+    def start(self) -> None:
+        self._thread.start()
+        while not self.server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("The in-process server failed to start")
+            time.sleep(0.05)
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self._thread.join(timeout=10)
+
+
+class LevelStats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors: Counter = Counter()
+        self.sent = 0
+
+    def record(self, latency: float, error: Optional[str]) -> None:
+        if error is None:
+            self.latencies.append(latency)
+        else:
+            self.errors[error] += 1
+
+
+async def send(client, url: str, body: bytes, stats: LevelStats, scheduled: float) -> None:
+    import httpx
+
+    stats.sent += 1
+    error = None
+    try:
+        response = await client.post(url, content=body, headers={"Content-Type": "application/json"})
+        if response.status_code != 200:
+            error = f"HTTP {response.status_code}"
+        else:
+            # Failed analyses are returned with status 200 and an error status field
+            result_status = response.json().get("status", "ok")
+            if result_status not in ("ok", "partial"):
+                error = f"status {result_status}"
+    except httpx.TimeoutException:
+        error = "timeout"
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    stats.record(time.perf_counter() - scheduled, error)
+
+
+async def closed_loop(client, url: str, bodies: List[bytes], concurrency: int, duration: float, stats: LevelStats) -> None:
+    end = time.perf_counter() + duration
+
+    async def worker(offset: int):
+        i = offset
+        while time.perf_counter() < end:
+            await send(client, url, bodies[i % len(bodies)], stats, time.perf_counter())
+            i += 1
+
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+
+
+async def open_loop(client, url: str, bodies: List[bytes], rate: float, duration: float, stats: LevelStats, poisson: bool) -> None:
+    rng = random.Random(0)
+    start = time.perf_counter()
+    scheduled, i, tasks = start, 0, []
+    while scheduled < start + duration:
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, url, bodies[i % len(bodies)], stats, scheduled)))
+        i += 1
+        scheduled += rng.expovariate(rate) if poisson else 1 / rate
+    await asyncio.gather(*tasks)
+
+
+def summarize(mode: str, level: float, size: int, stats: LevelStats, elapsed: float, lag: Optional[List[float]]) -> Dict[str, Any]:
+    failed = sum(stats.errors.values())
+    completed = len(stats.latencies) + failed
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        "mode": mode,
+        "level": level,
+        "size": size,
+        "sent": stats.sent,
+        "ok": len(stats.latencies),
+        "error_rate": round(failed / completed, 4) if completed else 0.0,
+        "errors": dict(stats.errors),
+        "rps": round(len(stats.latencies) / elapsed, 3) if elapsed else 0.0,
+        "p50_ms": ms(percentile(stats.latencies, 50)),
+        "p90_ms": ms(percentile(stats.latencies, 90)),
+        "p99_ms": ms(percentile(stats.latencies, 99)),
+        "max_ms": ms(max(stats.latencies, default=None)),
+        "lag_p99_ms": ms(percentile(lag, 99)) if lag is not None else None,
+        "lag_max_ms": ms(max(lag, default=None)) if lag is not None else None,
+    }
+
+
+def format_row(row: Dict[str, Any]) -> str:
+    def cell(value, width):
+        return f"{'-' if value is None else value:>{width}}"
+
+    errors = f"{row['error_rate'] * 100:.1f}%"
+    return (
+        f"{row['mode']:<6} {cell(row['level'], 6)} {cell(row['size'], 6)} {cell(row['sent'], 6)} {cell(errors, 7)} "
+        f"{cell(row['rps'], 8)} {cell(row['p50_ms'], 9)} {cell(row['p90_ms'], 9)} {cell(row['p99_ms'], 9)} "
+        f"{cell(row['max_ms'], 9)} {cell(row['lag_p99_ms'], 9)} {cell(row['lag_max_ms'], 9)}"
+    )
+
+
+HEADER = (
+    f"{'mode':<6} {'level':>6} {'size':>6} {'sent':>6} {'errors':>7} {'rps':>8} {'p50 ms':>9} {'p90 ms':>9} "
+    f"{'p99 ms':>9} {'max ms':>9} {'lag p99':>9} {'lag max':>9}"
+)
+
+
+async def sweep(args, base_url: str, server: Optional[InProcessServer]) -> List[Dict[str, Any]]:
+    import httpx
+
+    url = base_url.rstrip("/") + "/v1/predict"
+    levels = args.concurrency if args.mode == "closed" else args.rates
+    # Open-loop arrivals must never wait for a free connection
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=max(64, int(max(levels))))
+    rows = []
+    print(HEADER)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        for size in args.sizes:
+            bodies = make_bodies(size, args.language)
+            for level in levels:
+                if args.warmup:
+                    await send(client, url, bodies[0], LevelStats(), time.perf_counter())
+                if server:
+                    server.lag.reset()
+                stats = LevelStats()
+                start = time.perf_counter()
+                if args.mode == "closed":
+                    await closed_loop(client, url, bodies, int(level), args.duration, stats)
+                else:
+                    await open_loop(client, url, bodies, level, args.duration, stats, args.poisson)
+                elapsed = time.perf_counter() - start
+                lag = server.lag.reset() if server else None
+                row = summarize(args.mode, level, size, stats, elapsed, lag)
+                rows.append(row)
+                print(format_row(row), flush=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the /v1/predict endpoint")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed",
+                        help="closed: fixed number of requests in flight; open: fixed arrival rate")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8], help="Closed-loop levels")
+    parser.add_argument("--rates", type=float, nargs="+", default=[0.5, 1.0, 2.0, 4.0], help="Open-loop levels (requests per second)")
+    parser.add_argument("--poisson", action="store_true", help="Open loop: exponential inter-arrival times instead of a fixed interval")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024], help="Width and height of the synthetic drawings")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per level")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Client timeout per request")
+    parser.add_argument("--language", choices=["en", "zh"], default="en")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="Skip the untimed request before each level")
+    parser.add_argument("--latency", type=float, default=1.0, help="Seconds the stand-in backend waits per chat completion")
+    parser.add_argument("--backend-url", default=None, help="OpenAI-compatible backend instead of the local stand-in")
+    parser.add_argument("--model", default="gpt-4o", help="Model name sent to the backend")
+    parser.add_argument("--url", default=None, help="Load-test a running service instead of serving create_app in-process")
+    parser.add_argument("--output", default=None, help="Also write the results as JSON to this file")
+    add_log_arguments(parser, default="WARNING")
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+    mock, server = None, None
+    if args.url:
+        base_url = args.url
+    else:
+        backend_url = args.backend_url
+        if backend_url is None:
+            from src.mock_openai import start_mock_server
+
+            mock, backend_url = start_mock_server(latency=args.latency)
+        server = InProcessServer(backend_url, os.getenv("OPENAI_API_KEY", "mock"), args.model)
+        server.start()
+        base_url = server.url
+    try:
+        rows = asyncio.run(sweep(args, base_url, server))
+    finally:
+        if server:
+            server.stop()
+        if mock:
+            mock.shutdown()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows}, f, indent=2)
+            f.write("\n")
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
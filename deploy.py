@@ -1,47 +1,56 @@
 import os
-
-import uvicorn
-from langchain_openai import ChatOpenAI
-
-from src.app.api import create_app
-from src.model_langchain import HTPModel
 import argparse
 
+from src.log_config import add_log_arguments
+from src.profiling import add_profile_arguments, profile_session
+
 def get_parse():
     parser = argparse.ArgumentParser(description="HTP Model")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Interface to bind, 0.0.0.0 for all")
     parser.add_argument("--port", type=int, default=9557, help="Port number")
-    
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: number of cores)")
+    parser.add_argument("--graceful_timeout", type=float, default=None,
+                        help="Seconds to finish in-flight analyses on SIGTERM or reload (default: PSYDRAW_GRACEFUL_TIMEOUT or 300)")
+    add_log_arguments(parser)
+    # The profile covers the server's whole lifetime and is written on shutdown (Ctrl+C);
+    # profiling runs a single in-process worker. Requests are analyzed in the threadpool,
+    # which only the sampling profiler sees
+    add_profile_arguments(parser, default_mode="sampling")
+
     return parser.parse_args()
 
 
-TEXT_MODEL = "gpt-4-turbo"
-MULTIMODAL_MODEL = "gpt-4-vision-preview"
-
-text_model = ChatOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_BASE_URL"),
-    model = TEXT_MODEL,
-    temperature=0.2,
-    top_p = 0.75,
-    seed=42,
-)
-multimodal_model = ChatOpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_BASE_URL"),
-    model = MULTIMODAL_MODEL,
-    temperature=0.2,
-    top_p = 0.75,
-    seed=42,
-)
-
-model = HTPModel(
-    text_model=text_model,
-    multimodal_model=multimodal_model,
-    language="zh",
-    use_cache=True
-)
-
-config = get_parse()
-
-app = create_app(model)
-uvicorn.run(app, host="127.0.0.1", port=config.port, log_level="info")
\ No newline at end of file
+def main():
+    # Parse arguments before the server and model stack are imported
+    config = get_parse()
+
+    if config.log_level:
+        # Worker processes configure their logging from the environment
+        os.environ["PSYDRAW_LOG_LEVEL"] = config.log_level
+
+    from src.log_config import configure_logging
+
+    configure_logging(config.log_level)
+
+    from src.app.server import GRACEFUL_TIMEOUT, serve
+
+    graceful_timeout = config.graceful_timeout if config.graceful_timeout is not None else GRACEFUL_TIMEOUT
+
+    if config.profile:
+        import uvicorn
+
+        from src.app.server import create_server_app
+
+        # Build the app (and import the model stack) before profiling: allocation
+        # tracing slows imports down a lot, and they are not what is being profiled
+        app = create_server_app()
+        with profile_session(config.profile, config.profile_mode):
+            uvicorn.run(app, host=config.host, port=config.port, log_level="info",
+                        timeout_graceful_shutdown=graceful_timeout)
+    else:
+        serve(config.host, config.port, config.workers, graceful_timeout)
+
+
+# Worker processes are spawned and re-import this module: only the supervisor runs main()
+if __name__ == "__main__":
+    main()
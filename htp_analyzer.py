@@ -1,13 +1,76 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import os
-from PIL import Image, ImageTk
-from langchain_openai import ChatOpenAI
+import queue
+import threading
 from datetime import datetime
 import webbrowser
 import traceback
 
-from src.model_langchain import HTPModel
+# PIL, langchain_openai and the HTP model stack are imported on first use so the
+# window appears without waiting for them to load.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+POLL_INTERVAL_MS = 100
+
+
+class AnalysisWorker(threading.Thread):
+    """后台分析线程：从任务队列依次取出图片进行分析，结果放入结果队列由主线程轮询"""
+
+    def __init__(self, get_model, results):
+        super().__init__(daemon=True)
+        self.get_model = get_model
+        self.jobs = queue.Queue()
+        self.results = results
+        # Bumped on cancel; queued and in-flight jobs from an older generation are dropped
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def submit(self, image_path, settings):
+        with self._lock:
+            self.jobs.put((self.generation, image_path, settings))
+
+    def cancel(self):
+        """取消排队中的任务；正在进行的请求无法中断，其结果会被丢弃"""
+        with self._lock:
+            self.generation += 1
+        dropped = 0
+        while True:
+            try:
+                self.jobs.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                break
+        return dropped
+
+    def stop(self):
+        self.cancel()
+        self.jobs.put(None)
+
+    def is_current(self, generation):
+        with self._lock:
+            return generation == self.generation
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            generation, image_path, settings = job
+            if not self.is_current(generation):
+                continue
+            self.results.put(("started", generation, image_path, None))
+            try:
+                model = self.get_model(settings)
+                result = model.workflow(image_path=image_path, language=settings["language"])
+                if result.get("status", "ok") != "ok":
+                    # Don't save the error text as a report
+                    self.results.put(("error", generation, image_path, result["final"]))
+                    continue
+                self.results.put(("done", generation, image_path, result))
+            except Exception:
+                self.results.put(("error", generation, image_path, traceback.format_exc()))
+
 
 class HTPAnalyzer:
     def __init__(self, root):
@@ -56,12 +119,34 @@ class HTPAnalyzer:
         )
         self.analyze_btn.grid(row=2, column=0, pady=10)
         
+        queue_frame = ttk.Frame(right_frame)
+        queue_frame.grid(row=3, column=0, pady=(0, 10))
+        ttk.Button(
+            queue_frame,
+            text="Queue Folder / 批量分析文件夹",
+            command=self.queue_folder
+        ).grid(row=0, column=0, padx=5)
+        ttk.Button(
+            queue_frame,
+            text="Cancel / 取消",
+            command=self.cancel_analysis
+        ).grid(row=0, column=1, padx=5)
+        
         # 状态栏放在最底部
         self.create_status_bar()
         
         self.setup_tooltips()
         self.image_path = None
         
+        # 模型实例按API配置缓存复用，分析在后台线程执行，主线程通过after()轮询结果
+        self._models = {}
+        self._models_lock = threading.Lock()
+        self.pending = 0
+        self.results = queue.Queue()
+        self.worker = AnalysisWorker(self.get_model, self.results)
+        self.worker.start()
+        self.root.after(POLL_INTERVAL_MS, self.poll_results)
+        
         # 配置根窗口的网格权重
         self.root.grid_rowconfigure(0, weight=1)
         self.root.grid_columnconfigure(0, weight=1)
@@ -208,7 +293,8 @@ HTP Drawing Analyzer Help / HTP绘画分析器帮助
 
 3. Analysis / 分析
    - Click "Analyze Drawing" to start / 点击"分析绘画"开始
-   - Wait for the analysis to complete / 等待分析完成
+   - Click "Queue Folder" to analyze every image in a folder / 点击"批量分析文件夹"分析文件夹中的所有图片
+   - The window stays usable while analyses run; "Cancel" drops queued images / 分析在后台进行，点击"取消"移除排队中的图片
    - Results will be saved automatically / 结果将自动保存
 
 For more information, visit our website / 更多信息，请访问我们的网站
@@ -229,84 +315,154 @@ For more information, visit our website / 更多信息，请访问我们的网
     def update_status(self, message):
         """更新状态栏消息"""
         self.status_bar.config(text=message)
-        self.root.update()
+
+    def get_model(self, settings):
+        """返回与当前API配置对应的模型实例，相同配置的多次分析复用同一实例（在后台线程调用）"""
+        key = (settings["api_key"], settings["base_url"], settings["language"])
+        with self._models_lock:
+            model = self._models.get(key)
+            if model is not None:
+                return model
+
+        from langchain_openai import ChatOpenAI
+        from src.model_langchain import HTPModel
+
+        # 创建模型实例
+        text_model = ChatOpenAI(
+            api_key=settings["api_key"],
+            base_url=settings["base_url"],
+            # model="claude-3-5-sonnet-20241022",
+            model="gpt-4o-2024-08-06",
+            temperature=0.2,
+            top_p=0.75,
+            seed=42,
+            max_retries=5,
+        )
+        
+        multimodal_model = ChatOpenAI(
+            api_key=settings["api_key"],
+            base_url=settings["base_url"],
+            model="gpt-4o-2024-08-06",
+            temperature=0.2,
+            top_p=0.75,
+            seed=42,
+            max_retries=5,
+        )
+        
+        model = HTPModel(
+            text_model=text_model,
+            multimodal_model=multimodal_model,
+            language=settings["language"],  # 使用选择的语言
+            use_cache=True
+        )
+        with self._models_lock:
+            return self._models.setdefault(key, model)
+
+    def current_settings(self):
+        """在主线程读取界面上的配置，后台线程不能访问Tk变量"""
+        return {
+            "api_key": self.api_key.get(),
+            "base_url": self.base_url.get(),
+            "language": self.language.get(),
+        }
+
+    def enqueue(self, image_paths):
+        if not self.api_key.get():
+            messagebox.showerror("Error", "Please enter your API key! / 请输入API密钥！")
+            return
+        settings = self.current_settings()
+        for image_path in image_paths:
+            self.worker.submit(image_path, settings)
+        self.pending += len(image_paths)
+        self.update_status(f"Queued {len(image_paths)} image(s), {self.pending} pending / 已加入队列，待分析：{self.pending}")
 
     def analyze_image(self):
-        """分析图片并更新预览"""
+        """将当前图片加入分析队列"""
         if not self.image_path:
             messagebox.showerror("Error", "Please upload an image first! / 请先上传图片！")
             return
-            
-        if not self.api_key.get():
-            messagebox.showerror("Error", "Please enter your API key! / 请输入API密钥！")
+        self.enqueue([self.image_path])
+
+    def queue_folder(self):
+        """将文件夹中的所有图片加入分析队列"""
+        dir_path = filedialog.askdirectory()
+        if not dir_path:
             return
-            
+        image_paths = sorted(
+            os.path.join(dir_path, name) for name in os.listdir(dir_path)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not image_paths:
+            messagebox.showinfo("Info", "No images found in this folder / 文件夹中没有图片")
+            return
+        self.enqueue(image_paths)
+
+    def cancel_analysis(self):
+        """取消排队中的分析"""
+        dropped = self.worker.cancel()
+        self.pending = 0
+        self.update_status(f"Cancelled, {dropped} queued image(s) dropped / 已取消，移除{dropped}个排队任务")
+
+    def poll_results(self):
+        """轮询后台线程的结果队列并更新界面"""
         try:
-            self.update_status("Analyzing... / 分析中...")
-            # 创建模型实例
-            text_model = ChatOpenAI(
-                api_key=self.api_key.get(),
-                base_url=self.base_url.get(),
-                # model="claude-3-5-sonnet-20241022",
-                model="gpt-4o-2024-08-06",
-                temperature=0.2,
-                top_p=0.75,
-                seed=42,
-                max_retries=5,
-            )
-            
-            multimodal_model = ChatOpenAI(
-                api_key=self.api_key.get(),
-                base_url=self.base_url.get(),
-                model="gpt-4o-2024-08-06",
-                temperature=0.2,
-                top_p=0.75,
-                seed=42,
-                max_retries=5,
-            )
-            
-            model = HTPModel(
-                text_model=text_model,
-                multimodal_model=multimodal_model,
-                language=self.language.get(),  # 使用选择的语言
-                use_cache=True
-            )
-            
-            # 分析图片
-            result = model.workflow(
-                image_path=self.image_path,
-                language=self.language.get()  # 使用选择的语言
-            )
-            
-            # 生成报告文件名
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            report_filename = os.path.join(self.output_dir, f"htp_report_{timestamp}.txt")
-            usage = result.get("usage", "")
-            # 保存报告
-            if result["classification"] is True:
-                signal = result.get('signal', '')
-                final_report = result.get('final', '').replace("<output>", "").replace("</output>", "")
-                disclaimer = "注意：本报告由AI生成，仅供参考。不能替代医学诊断。"
-                export_data = f"{disclaimer}\n\n{signal}\n\n{final_report}"
-            else:
-                signal = result.get('fix_signal', '')
-                disclaimer = "注意：本报告由AI生成，仅供参考。不能替代医学诊断。"
-                export_data = f"{disclaimer}\n\n{signal}"
-                
-            with open(report_filename, "w", encoding="utf-8") as f:
-                f.write(export_data)
-          
-            self.preview_text.config(state='normal')
-            self.preview_text.delete('1.0', tk.END)
-            self.preview_text.insert('1.0', export_data)
-            self.preview_text.config(state='disabled')
-            
-            self.update_status(f"Analysis complete. Saved to: {report_filename} / 分析完成。已保存至：{report_filename}, Usage: {usage}")
-            
-        except Exception as e:
+            while True:
+                event, generation, image_path, payload = self.results.get_nowait()
+                if not self.worker.is_current(generation):
+                    continue
+                try:
+                    self.handle_event(event, image_path, payload)
+                except Exception as e:
+                    # One bad result must not stop the polling of the others
+                    error_info = traceback.format_exc()
+                    self.update_status("Analysis failed / 分析失败")
+                    messagebox.showerror("Error", f"Analysis failed: {str(e)}\n\n{error_info}")
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(POLL_INTERVAL_MS, self.poll_results)
+
+    def handle_event(self, event, image_path, payload):
+        if event == "started":
+            self.update_status(f"Analyzing {os.path.basename(image_path)}, {self.pending} pending... / 分析中...")
+        elif event == "done":
+            self.pending = max(self.pending - 1, 0)
+            self.show_result(image_path, payload)
+        else:
+            self.pending = max(self.pending - 1, 0)
             self.update_status("Analysis failed / 分析失败")
-            error_info = traceback.format_exc()
-            messagebox.showerror("Error", f"Analysis failed: {str(e)}\n\n{error_info}")
+            messagebox.showerror("Error", f"Analysis failed: {os.path.basename(image_path)}\n\n{payload}")
+
+    def show_result(self, image_path, result):
+        """保存报告并更新预览"""
+        # 生成报告文件名
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        image_name = os.path.splitext(os.path.basename(image_path))[0]
+        report_filename = os.path.join(self.output_dir, f"htp_report_{image_name}_{timestamp}.txt")
+        from src.model_langchain import report_text
+
+        usage = result.get("usage", "")
+        # 保存报告
+        if result["classification"] is True:
+            signal = result.get('signal', '')
+            final_report = report_text(result, "final")
+            disclaimer = "注意：本报告由AI生成，仅供参考。不能替代医学诊断。"
+            export_data = f"{disclaimer}\n\n{signal}\n\n{final_report}"
+        else:
+            signal = result.get('fix_signal', '')
+            disclaimer = "注意：本报告由AI生成，仅供参考。不能替代医学诊断。"
+            export_data = f"{disclaimer}\n\n{signal}"
+            
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(report_filename, "w", encoding="utf-8") as f:
+            f.write(export_data)
+      
+        self.preview_text.config(state='normal')
+        self.preview_text.delete('1.0', tk.END)
+        self.preview_text.insert('1.0', export_data)
+        self.preview_text.config(state='disabled')
+        
+        self.update_status(f"Analysis complete. Saved to: {report_filename} / 分析完成。已保存至：{report_filename}, Usage: {usage}, {self.pending} pending")
 
     def create_language_selector(self, parent):
         lang_frame = ttk.Frame(parent)
@@ -422,6 +578,8 @@ For more information, visit our website / 更多信息，请访问我们的网
             filetypes=[("Image files", "*.png *.jpg *.jpeg")]
         )
         if file_path:
+            from PIL import Image, ImageTk
+
             self.image_path = file_path
             # 显示图片预览
             image = Image.open(file_path)
@@ -431,9 +589,13 @@ For more information, visit our website / 更多信息，请访问我们的网
             self.image_label.image = photo
             
 def main():
+    from src.log_config import configure_logging
+
+    configure_logging()
     root = tk.Tk()
     app = HTPAnalyzer(root)
     root.mainloop()
+    app.worker.stop()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
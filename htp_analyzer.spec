@@ -11,7 +11,13 @@ a = Analysis(
     datas=[
         ('src', 'src')
     ],
-    hiddenimports=['pydantic.deprecated.decorator', 'langchain_openai', 'langchain', 'langchain_core'],
+    # The model stack is imported lazily inside htp_analyzer.py, list it so it is still bundled
+    hiddenimports=[
+        'pydantic.deprecated.decorator', 'langchain_openai', 'langchain', 'langchain_core',
+        'langchain_community.cache', 'langchain_community.callbacks',
+        'PIL.Image', 'PIL.ImageTk',
+        'src.model_langchain', 'src.custom_chat_openai', 'src.image_store', 'src.payload', 'src.serialization',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -3,22 +3,11 @@ import json
 import os
 import logging
 import sys
-from dotenv import load_dotenv
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-# Use our custom ChatOpenAI wrapper instead of the original
-from src.custom_chat_openai import ChatOpenAI
+from src.log_config import add_log_arguments, configure_logging
+from src.profiling import add_profile_arguments, profile_session
 
-from src.model_langchain import HTPModel
-
-# Attempt to disable proxy settings that might be causing issues
-import openai
-if hasattr(openai, '_client'):
-    if hasattr(openai._client, 'proxies'):
-        delattr(openai._client, 'proxies')
+logger = logging.getLogger(__name__)
 
 # Use only OpenAI models for both text and multimodal
 TEXT_MODEL = "gpt-4o"
@@ -30,13 +19,25 @@ def get_args():
     parser.add_argument("--save_path", type=str, help="Path to save the result")
     parser.add_argument("--language", type=str, default="zh", help="Language of the analysis report")
     parser.add_argument("--use_cache", action="store_true", help="Enable caching (disabled by default)")
-    
+    add_profile_arguments(parser)
+    add_log_arguments(parser)
+
     return parser.parse_args()
 
-try:
+def main():
+    # Arguments are parsed before the model stack (langchain, pydantic, requests) is imported,
+    # so --help and argument errors return immediately.
+    config = get_args()
+    configure_logging(config.log_level)
+
+    from dotenv import load_dotenv
+
+    # Use our custom ChatOpenAI wrapper instead of the original
+    from src.custom_chat_openai import ChatOpenAI
+    from src.model_langchain import HTPModel
+
     logger.info("Loading environment variables")
     load_dotenv()
-    config = get_args()
 
     logger.info(f"Arguments: image_file={config.image_file}, save_path={config.save_path}, language={config.language}")
     assert config.language in ["zh", "en"], "Language should be either 'zh' or 'en'."
@@ -47,7 +48,7 @@ try:
     if not api_key:
         logger.error("OPENAI_API_KEY environment variable not set.")
         sys.exit(1)
-    
+
     logger.info(f"Using API key (first 4 chars): {api_key[:4]}...")
     logger.info(f"Using base URL: {base_url or 'default OpenAI API'}")
 
@@ -58,7 +59,7 @@ try:
         model_name=TEXT_MODEL,
         temperature=0.2,
     )
-    
+
     logger.info("Initializing multimodal model")
     multimodal_model = ChatOpenAI(
         api_key=api_key,
@@ -76,18 +77,22 @@ try:
     )
 
     logger.info("Running HTP workflow")
-    result = model.workflow(
-        image_path=config.image_file,
-        language=config.language
-    )
+    with profile_session(config.profile, config.profile_mode):
+        result = model.workflow(
+            image_path=config.image_file,
+            language=config.language
+        )
 
     # save the result to a file
     logger.info(f"Saving results to {config.save_path}")
     with open(config.save_path, "w", encoding="utf-8") as f:
         f.write(json.dumps(result, indent=4, ensure_ascii=False))
-        
+
     logger.info("Analysis completed successfully")
 
-except Exception as e:
-    logger.error(f"Error running HTP analysis: {str(e)}", exc_info=True)
-    sys.exit(1)
\ No newline at end of file
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        logger.error(f"Error running HTP analysis: {str(e)}", exc_info=True)
+        sys.exit(1)
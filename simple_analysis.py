@@ -1,14 +1,16 @@
-import base64
 import os
 import sys
 import argparse
 import requests
 from dotenv import load_dotenv
 
+from src.image_store import get_data_url, get_image_store
+from src.payload import encode_chat_body
+
 def encode_image(image_path):
-    """Encode image to base64 string"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    """Encode image to a base64 data URL, reading it through the shared image store"""
+    digest = get_image_store().put_file(image_path)
+    return get_data_url(digest)
 
 def analyze_image(image_path, language="en"):
     """Send image to GPT-4o for psychological analysis"""
@@ -20,7 +22,7 @@ def analyze_image(image_path, language="en"):
         sys.exit(1)
     
     # Encode image
-    image_b64 = encode_image(image_path)
+    image_url = encode_image(image_path)
     
     # Select prompt based on language
     if language == "zh":
@@ -69,7 +71,7 @@ Please provide a professional, balanced analysis while avoiding overinterpretati
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_b64}"
+                            "url": image_url
                         }
                     }
                 ]
@@ -81,7 +83,7 @@ Please provide a professional, balanced analysis while avoiding overinterpretati
     # Make the API call
     try:
         print("Sending image to GPT-4o for analysis...")
-        response = requests.post(url, headers=headers, json=payload)
+        response = requests.post(url, headers=headers, data=encode_chat_body(payload))
         response.raise_for_status()  # Raise an exception for HTTP errors
         
         # Extract and return the content
@@ -1,53 +1,193 @@
+import logging
+import math
+import os
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
 from requests import JSONDecodeError
-from src.app.models import HTPInput, HTPOutput, Usage, MethodList, AnalysisOutput
-from fastapi import FastAPI, HTTPException, status
+from src.app.models import CompactHTPOutput, HTPInput, HTPOutput, MethodList, UsageReport, to_compact_output, to_htp_output, to_usage_report
+from src.app.responses import CompressionMiddleware, FastJSONResponse
+from src.circuit_breaker import breaker_states
+from src.image_store import image_ref, store_image_input
+from src.model_langchain import load_image
+from src.phash import get_drawing_index
+from src.quota import RateLimited, UnknownAPIKey, get_quota_limiter
+from fastapi import FastAPI, HTTPException, Query, Request, status
+from starlette.concurrency import run_in_threadpool
 
+logger = logging.getLogger(__name__)
+
+
+def api_key_of(request: Request) -> Optional[str]:
+    """The caller's API key, from X-API-Key or an "Authorization: Bearer" header."""
+    api_key = request.headers.get("x-api-key")
+    authorization = request.headers.get("authorization", "")
+    if not api_key and authorization.lower().startswith("bearer "):
+        api_key = authorization[7:].strip()
+    return api_key or None
+
+
+# Output models of the ?view= options of /v1/predict
+VIEWS = {"full": HTPOutput, "compact": CompactHTPOutput}
+
+
+def parse_fields(view: str, fields: Optional[str]) -> Optional[List[str]]:
+    """The field names of ?fields=a,b (None for all), checked against the view's model."""
+    if not fields:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in VIEWS[view].model_fields]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields {unknown} for view '{view}', choose from {list(VIEWS[view].model_fields)}"
+        )
+    return names
+
+
+def shape_output(output: HTPOutput, view: str, fields: Optional[List[str]]) -> Dict[str, Any]:
+    if view == "compact":
+        content = to_compact_output(output).model_dump(mode="json", exclude_none=True)
+    else:
+        content = output.model_dump(mode="json")
+    if fields:
+        content = {name: content[name] for name in fields if name in content}
+    return content
+
+
+def rate_limited(error: RateLimited) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(error),
+        headers={"Retry-After": str(math.ceil(error.retry_after))}
+    )
+
+
+def create_app(model=None, model_factory: Optional[Callable[[], Any]] = None, on_ready: Optional[Callable[[], None]] = None):
+    """
+    Build the API around an HTPModel, or around model_factory, which is called
+    when the app starts so every worker process builds its own clients.
+    on_ready is called once the model exists and requests can be served.
+    """
+    if model is None and model_factory is None:
+        raise ValueError("create_app needs a model or a model_factory")
+    state = {"model": model, "error": None, "in_flight": 0}
+    limiter = get_quota_limiter()
+    model_lock = threading.Lock()
+
+    def get_model():
+        if state["model"] is None:
+            with model_lock:
+                if state["model"] is None:
+                    state["model"] = model_factory()
+                    state["error"] = None
+        return state["model"]
+
+    @asynccontextmanager
+    async def lifespan(app):
+        try:
+            await run_in_threadpool(get_model)
+        except Exception as e:
+            # Stay up but not ready; the first request retries the build
+            state["error"] = str(e)
+            logger.exception("Building the model failed")
+        else:
+            if on_ready is not None:
+                on_ready()
+        yield
+        logger.info(f"Worker {os.getpid()} stopped")
 
-def create_app(model):
     app = FastAPI(
         title = "HTP Test",
         description = "A simple web application that uses the House-Tree-Person test to analyze an image.",
+        default_response_class=FastJSONResponse,
+        lifespan=lifespan,
     )
+    # gzip, or brotli when installed, as the client's Accept-Encoding allows
+    app.add_middleware(CompressionMiddleware)
+
+    def tenant_of(request: Request) -> str:
+        try:
+            return limiter.tenant(api_key_of(request), request.client.host if request.client else None)
+        except UnknownAPIKey as e:
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
 
     @app.post("/v1/predict", response_model=HTPOutput, status_code=status.HTTP_200_OK)
-    async def predict(data: HTPInput):
+    async def predict(
+        data: HTPInput,
+        request: Request,
+        view: str = Query("full", pattern="^(full|compact)$", description="'compact' drops placeholder and repeated texts"),
+        fields: Optional[str] = Query(None, description="Comma-separated fields of the view to return"),
+    ):
+        # Reject bad field names before the analysis is paid for
+        selected = parse_fields(view, fields)
+        tenant = tenant_of(request)
+        try:
+            await run_in_threadpool(limiter.check_request, tenant)
+            # Waits for a free slot, taking turns with the other API keys' queued requests
+            async with limiter.scheduler.slot(tenant):
+                # The workflow blocks on the LLM calls: run it in the threadpool so the
+                # event loop keeps serving other requests and health checks meanwhile
+                state["in_flight"] += 1
+                try:
+                    output = await run_in_threadpool(run_predict, data, tenant)
+                finally:
+                    state["in_flight"] -= 1
+        except RateLimited as e:
+            raise rate_limited(e)
+        if view == "full" and not selected:
+            return output
+        return FastJSONResponse(content=shape_output(output, view, selected))
+
+    def run_predict(data: HTPInput, tenant: str):
         try:
             assert data.language in ["en", "zh"], "Language must be either 'en' or 'zh'."
-            result = model.workflow(
-                image_path=data.image_path,
-                language=data.language
-            )
-            result = HTPOutput(
-                usage=Usage(
-                    total_tokens=result["usage"]["total"],
-                    prompt_tokens=result["usage"]["prompt"],
-                    completion_tokens=result["usage"]["completion"]
-                ),
-                overall=AnalysisOutput(
-                    feature=result["overall"]["feature"],
-                    analysis=result["overall"]["analysis"],
-                ),
-                house=AnalysisOutput(
-                    feature=result["house"]["feature"],
-                    analysis=result["house"]["analysis"],
-                ),
-                tree=AnalysisOutput(
-                    feature=result["tree"]["feature"],
-                    analysis=result["tree"]["analysis"],
-                ),
-                person=AnalysisOutput(
-                    feature=result["person"]["feature"],
-                    analysis=result["person"]["analysis"],
-                ),
-                merge=result["merge"],
-                final=result["final"],
-                signal=result["signal"],
-                classification=result["classification"],
-                fix_signal=result["fix_signal"]
-            )
+            # Drawings are only stored, hashed and indexed (with their report) when the caller opted in
+            digest = store_image_input(data.image_path) if data.reuse_duplicates else None
+            index = get_drawing_index(tenant) if digest else None
+            match = index.find(digest) if digest else None
+            if match:
+                result = match["result"]
+                result["duplicate_of"] = image_ref(match["digest"])
+                result["usage"] = {"total": 0, "prompt": 0, "completion": 0, "cached": 0}
+                # The stored trace belongs to the original analysis
+                result.pop("trace", None)
+                limiter.settle(tenant, 0, result["usage"])
+            else:
+                model = get_model()
+                image_path = image_ref(digest) if digest else data.image_path
+                # Charge the analysis' planned tokens to the API key before any LLM call
+                reserved = 0
+                if limiter.limits_tokens:
+                    planned = sum(reservation.total for reservation in model.plan_workflow(load_image(image_path)[0], data.structured_output))
+                    reserved = limiter.reserve_tokens(tenant, planned)
+                result = None
+                try:
+                    result = model.workflow(
+                        image_path=image_path,
+                        language=data.language,
+                        structured=data.structured_output,
+                        timeout=data.timeout
+                    )
+                finally:
+                    limiter.settle(tenant, reserved, result["usage"] if result else None)
+                if result.get("status") == "unavailable":
+                    # The LLM upstream's circuit breaker is open: tell the client when to retry
+                    raise HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail=result["final"],
+                        headers={"Retry-After": str(math.ceil(result.get("retry_after", 1)))}
+                    )
+                if result.get("status") == "timeout":
+                    raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=result["final"])
+                if digest and result.get("status", "ok") == "ok":
+                    index.add(digest, result)
+            result = to_htp_output(result)
 
             return result
         
+        except (HTTPException, RateLimited):
+            raise
         except JSONDecodeError as e:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
         except Exception as e:
@@ -59,5 +199,33 @@ def create_app(model):
         return MethodList(
             method=["predict"]
         )
-        
+
+    @app.get("/v1/usage", response_model=UsageReport, status_code=status.HTTP_200_OK)
+    async def usage(request: Request):
+        tenant = tenant_of(request)
+        today = await run_in_threadpool(limiter.store.usage, tenant)
+        total = await run_in_threadpool(limiter.store.usage, tenant, "all")
+        return to_usage_report(tenant, today, total)
+
+    @app.get("/healthz", status_code=status.HTTP_200_OK)
+    async def liveness():
+        # Answered by the event loop alone: fails only when the worker is stuck
+        return {"status": "alive", "pid": os.getpid(), "in_flight": state["in_flight"]}
+
+    @app.get("/readyz", status_code=status.HTTP_200_OK)
+    async def readiness():
+        if state["model"] is None:
+            return FastJSONResponse(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                content={"status": "error" if state["error"] else "starting", "pid": os.getpid(), "detail": state["error"]},
+            )
+        # An open upstream breaker is reported but keeps the worker ready: every worker shares the upstream
+        return {
+            "status": "ready",
+            "pid": os.getpid(),
+            "in_flight": state["in_flight"],
+            "queued": limiter.scheduler.queued(),
+            "breakers": breaker_states(),
+        }
+
     return app
\ No newline at end of file
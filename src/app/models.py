@@ -1,5 +1,7 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
+
+from src.model_langchain import HTPReport, RiskFlags
 
 class MethodList(BaseModel):
     method: List[str]
@@ -12,10 +14,30 @@ class Usage(BaseModel):
     total_tokens: int
     prompt_tokens: int
     completion_tokens: int
+    # Prompt tokens served from the provider's prompt cache (part of prompt_tokens)
+    cached_tokens: int = 0
+
+class UsageReport(BaseModel):
+    # Fingerprint of the API key ("anonymous" without one)
+    tenant: str
+    requests_today: int
+    today: Usage
+    requests_total: int
+    total: Usage
+
+class StructuredReports(BaseModel):
+    initial: HTPReport
+    final: HTPReport
 
 class HTPInput(BaseModel):
     image_path: str
     language: str = "zh"
+    # Return the stored result of a perceptually near-identical drawing instead of re-analyzing
+    reuse_duplicates: bool = False
+    # Ask for typed report sections and risk flags (JSON-schema structured output)
+    structured_output: bool = False
+    # Time budget of the analysis in seconds; on expiry a partial result (status "partial") or 504 is returned
+    timeout: Optional[float] = None
     
 class HTPOutput(BaseModel):
     overall: AnalysisOutput
@@ -27,4 +49,95 @@ class HTPOutput(BaseModel):
     signal: str
     usage: Usage
     classification: Optional[bool]
-    fix_signal: Optional[str] = None
\ No newline at end of file
+    fix_signal: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    # "ok"; "partial" when only the initial analysis finished within the timeout;
+    # "error", "timeout" or "unavailable" (upstream circuit open) when the report fields hold the error message
+    status: str = "ok"
+    # Time spent per span of the analysis (see src/tracing.py)
+    trace: Optional[Dict[str, Any]] = None
+    # Only set in structured output mode
+    report: Optional[StructuredReports] = None
+    risk: Optional[RiskFlags] = None
+
+
+class CompactHTPOutput(BaseModel):
+    """
+    HTPOutput without repeated text (?view=compact): the house, tree and person
+    placeholders are dropped, and texts equal to "final" are omitted, as are null fields.
+    """
+    # The first-stage analysis (overall.analysis and merge of HTPOutput); omitted when equal to final
+    initial: Optional[str] = None
+    final: str
+    # Omitted when equal to final
+    signal: Optional[str] = None
+    usage: Usage
+    classification: Optional[bool]
+    fix_signal: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    status: str = "ok"
+    trace: Optional[Dict[str, Any]] = None
+    report: Optional[StructuredReports] = None
+    risk: Optional[RiskFlags] = None
+
+
+def to_htp_output(result: Dict[str, Any]) -> HTPOutput:
+    """Convert a HTPModel.workflow() result dict into the API output model."""
+    return HTPOutput(
+        usage=Usage(
+            total_tokens=result["usage"]["total"],
+            prompt_tokens=result["usage"]["prompt"],
+            completion_tokens=result["usage"]["completion"],
+            cached_tokens=result["usage"].get("cached", 0)
+        ),
+        overall=AnalysisOutput(**result["overall"]),
+        house=AnalysisOutput(**result["house"]),
+        tree=AnalysisOutput(**result["tree"]),
+        person=AnalysisOutput(**result["person"]),
+        merge=result["merge"],
+        final=result["final"],
+        signal=result["signal"],
+        classification=result["classification"],
+        fix_signal=result["fix_signal"],
+        duplicate_of=result.get("duplicate_of"),
+        status=result.get("status", "ok"),
+        trace=result.get("trace"),
+        report=result.get("report"),
+        risk=result.get("risk")
+    )
+
+
+def to_compact_output(output: HTPOutput) -> CompactHTPOutput:
+    return CompactHTPOutput(
+        initial=output.merge if output.merge != output.final else None,
+        final=output.final,
+        signal=output.signal if output.signal != output.final else None,
+        usage=output.usage,
+        classification=output.classification,
+        fix_signal=output.fix_signal,
+        duplicate_of=output.duplicate_of,
+        status=output.status,
+        trace=output.trace,
+        report=output.report,
+        risk=output.risk
+    )
+
+def _to_usage(counters: Dict[str, int]) -> Usage:
+    return Usage(
+        total_tokens=counters["total"],
+        prompt_tokens=counters["prompt"],
+        completion_tokens=counters["completion"],
+        cached_tokens=counters["cached"]
+    )
+
+
+def to_usage_report(tenant: str, today: Dict[str, int], total: Dict[str, int]) -> UsageReport:
+    """Convert the usage store's counters (see src/quota.py) into the API output model."""
+    return UsageReport(
+        tenant=tenant,
+        requests_today=today["requests"],
+        today=_to_usage(today),
+        requests_total=total["requests"],
+        total=_to_usage(total)
+    )
+
@@ -0,0 +1,210 @@
+"""
+Multi-worker launcher of the API (used by deploy.py).
+
+Each worker process imports this module and builds the app with
+create_server_app(), so model clients are created per worker after the
+fork, never in the supervisor. Signals to the supervisor:
+
+- SIGTERM / SIGINT: every worker stops accepting connections and finishes
+  its in-flight analyses (up to the graceful timeout), then the server exits.
+- SIGHUP: zero-downtime reload. Each worker is replaced in turn: the new one
+  is started and awaited until ready, then the old one is drained. Signals
+  keep being handled during a reload: SIGTERM cuts it short and another
+  SIGHUP queues one more reload.
+- SIGTTIN / SIGTTOU: add or remove a worker.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import List, Optional
+
+import uvicorn
+from uvicorn.supervisors.multiprocess import Multiprocess, Process
+
+logger = logging.getLogger(__name__)
+
+TEXT_MODEL = "gpt-4-turbo"
+MULTIMODAL_MODEL = "gpt-4-vision-preview"
+
+# Seconds a worker may spend finishing in-flight analyses after SIGTERM
+GRACEFUL_TIMEOUT = float(os.getenv("PSYDRAW_GRACEFUL_TIMEOUT", "300"))
+# Seconds a reload waits for a replacement worker to become ready before keeping the old one
+READY_TIMEOUT = float(os.getenv("PSYDRAW_READY_TIMEOUT", "60"))
+# Set by the supervisor for reload replacements: they create a file named after their pid here once ready
+READY_DIR_ENV = "PSYDRAW_READY_DIR"
+
+
+def build_model():
+    """
+    The HTPModel of one worker, configured from OPENAI_API_KEY and OPENAI_BASE_URL.
+    Its clients time each request out within the workflow deadline and share
+    the upstream's circuit breaker.
+    """
+    from src.custom_chat_openai import ChatOpenAI
+    from src.model_langchain import HTPModel
+
+    text_model = ChatOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=os.getenv("OPENAI_BASE_URL"),
+        model_name = TEXT_MODEL,
+        temperature=0.2,
+        top_p = 0.75,
+        seed=42,
+    )
+    multimodal_model = ChatOpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        base_url=os.getenv("OPENAI_BASE_URL"),
+        model_name = MULTIMODAL_MODEL,
+        temperature=0.2,
+        top_p = 0.75,
+        seed=42,
+    )
+    return HTPModel(
+        text_model=text_model,
+        multimodal_model=multimodal_model,
+        language="zh",
+        use_cache=True
+    )
+
+
+def _notify_ready() -> None:
+    ready_dir = os.getenv(READY_DIR_ENV)
+    if ready_dir:
+        open(os.path.join(ready_dir, str(os.getpid())), "w").close()
+    logger.info(f"Worker {os.getpid()} ready")
+
+
+def create_server_app():
+    """uvicorn app factory, called once in every worker process."""
+    from src.app.api import create_app
+    from src.log_config import configure_logging
+
+    configure_logging()
+    return create_app(model_factory=build_model, on_ready=_notify_ready)
+
+
+class DrainingMultiprocess(Multiprocess):
+    """
+    uvicorn's worker supervisor with a reload that never lowers capacity:
+    replacements are started and ready before the old workers are drained,
+    and draining workers are reaped in the background.
+    """
+
+    def __init__(self, config: uvicorn.Config, target, sockets, ready_timeout: float = READY_TIMEOUT):
+        super().__init__(config, target, sockets)
+        self.ready_timeout = ready_timeout
+        self.draining: List[Process] = []
+        self.ready_dir = tempfile.mkdtemp(prefix="psydraw-ready-")
+        self.reloading = False
+        self.reload_pending = False
+
+    def _marker(self, process: Process) -> str:
+        return os.path.join(self.ready_dir, str(process.pid))
+
+    def _start_replacement(self) -> Process:
+        # Only replacements report readiness: spawned workers inherit the environment at start
+        os.environ[READY_DIR_ENV] = self.ready_dir
+        try:
+            process = Process(self.config, self.target, self.sockets)
+            process.start()
+        finally:
+            del os.environ[READY_DIR_ENV]
+        return process
+
+    def _wait_ready(self, process: Process) -> bool:
+        """
+        Wait for a replacement to report ready, consuming its marker. Signals and
+        worker checks keep being handled meanwhile; a shutdown ends the wait.
+        """
+        marker = self._marker(process)
+        deadline = time.monotonic() + self.ready_timeout
+        next_check = time.monotonic()
+        while time.monotonic() < deadline:
+            if os.path.exists(marker):
+                os.remove(marker)
+                return True
+            if not process.process.is_alive():
+                return False
+            self.handle_signals()
+            if self.should_exit.is_set():
+                return False
+            if time.monotonic() >= next_check:
+                self.keep_subprocess_alive()
+                next_check = time.monotonic() + 0.5
+            time.sleep(0.1)
+        return False
+
+    def _replace_all(self) -> None:
+        for old in list(self.processes):
+            if self.should_exit.is_set():
+                logger.info("Reload interrupted by shutdown")
+                return
+            new = self._start_replacement()
+            ready = self._wait_ready(new)
+            # The old worker may have died and been respawned, or been removed by SIGTTOU, meanwhile
+            if not ready or old not in self.processes:
+                if not ready and not self.should_exit.is_set():
+                    logger.error(f"Replacement worker [{new.pid}] did not become ready, keeping worker [{old.pid}]")
+                new.terminate()
+                self.draining.append(new)
+                continue
+            self.processes[self.processes.index(old)] = new
+            # The old worker stops accepting and finishes its in-flight requests
+            old.terminate()
+            self.draining.append(old)
+        logger.info("Reload finished")
+
+    def restart_all(self) -> None:
+        self.reloading = True
+        try:
+            self._replace_all()
+            while self.reload_pending and not self.should_exit.is_set():
+                self.reload_pending = False
+                self._replace_all()
+        finally:
+            self.reloading = self.reload_pending = False
+
+    def handle_hup(self) -> None:
+        if self.reloading:
+            logger.info("Received SIGHUP during a reload, reloading again once it finishes.")
+            self.reload_pending = True
+            return
+        super().handle_hup()
+
+    def reap_draining(self) -> None:
+        for process in list(self.draining):
+            if not process.process.is_alive():
+                process.join()
+                self.draining.remove(process)
+                # A replacement that reported ready too late leaves its marker behind
+                if os.path.exists(self._marker(process)):
+                    os.remove(self._marker(process))
+
+    def keep_subprocess_alive(self) -> None:
+        self.reap_draining()
+        super().keep_subprocess_alive()
+
+    def join_all(self) -> None:
+        super().join_all()
+        for process in self.draining:
+            process.join()
+        shutil.rmtree(self.ready_dir, ignore_errors=True)
+
+
+def serve(host: str = "127.0.0.1", port: int = 9557, workers: Optional[int] = None,
+          graceful_timeout: float = GRACEFUL_TIMEOUT, log_level: str = "info") -> None:
+    """Run the API with workers processes (default: one per core) under the draining supervisor."""
+    config = uvicorn.Config(
+        "src.app.server:create_server_app",
+        factory=True,
+        host=host,
+        port=port,
+        workers=workers or os.cpu_count() or 1,
+        timeout_graceful_shutdown=graceful_timeout,
+        log_level=log_level,
+    )
+    server = uvicorn.Server(config)
+    sock = config.bind_socket()
+    DrainingMultiprocess(config, target=server.run, sockets=[sock]).run()
@@ -0,0 +1,35 @@
+import base64
+import os
+from functools import lru_cache
+
+try:
+    from src.image_store import sniff_mime
+except ImportError:
+    from image_store import sniff_mime
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS_DIR = os.path.join(PROJECT_ROOT, "assets")
+
+
+def get_asset_path(filename: str) -> str:
+    return os.path.join(ASSETS_DIR, filename)
+
+
+@lru_cache(maxsize=None)
+def asset_bytes(filename: str) -> bytes:
+    """Raw bytes of a static asset, read once per process."""
+    with open(get_asset_path(filename), "rb") as f:
+        return f.read()
+
+
+@lru_cache(maxsize=None)
+def asset_data_uri(filename: str) -> str:
+    """Base64 data URI of a static asset, encoded once per process without decoding the image."""
+    data = asset_bytes(filename)
+    return f"data:{sniff_mime(data[:12], default='image/png')};base64,{base64.b64encode(data).decode()}"
+
+
+@lru_cache(maxsize=None)
+def asset_img_tag(filename: str, alt: str, width: str = "100%") -> str:
+    """HTML <img> tag embedding a static asset, for st.markdown(..., unsafe_allow_html=True)."""
+    return f'<img src="{asset_data_uri(filename)}" alt="{alt}" width="{width}">'
@@ -0,0 +1,404 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    from src.deadline import CONNECT_TIMEOUT, READ_TIMEOUT, Deadline
+    from src.image_store import get_data_url, get_image_store
+    from src.payload import encode_chat_body
+    from src.serialization import dumps
+except ImportError:
+    from deadline import CONNECT_TIMEOUT, READ_TIMEOUT, Deadline
+    from image_store import get_data_url, get_image_store
+    from payload import encode_chat_body
+    from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+# Statuses after which a provider batch will not change any more
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+POLL_INTERVAL = float(os.getenv("PSYDRAW_BATCH_POLL_INTERVAL", "60"))
+# Provider limits per input file (OpenAI: 50,000 requests and 200 MB), with some headroom
+MAX_BATCH_REQUESTS = int(os.getenv("PSYDRAW_BATCH_MAX_REQUESTS", "10000"))
+MAX_BATCH_BYTES = int(os.getenv("PSYDRAW_BATCH_MAX_BYTES", str(180 * 1024 * 1024)))
+# Image profile sent in batch requests, the same one the Batch page uses
+BATCH_IMAGE_PROFILE = "jpeg"
+
+_BODY_PLACEHOLDER = b'"__psydraw_body__"'
+
+
+def request_line(custom_id: str, body: Dict[str, Any]) -> bytes:
+    """One line of a batch input file, with the request body spliced in by encode_chat_body."""
+    envelope = dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": "__psydraw_body__"})
+    return envelope.replace(_BODY_PLACEHOLDER, encode_chat_body(body)) + b"\n"
+
+
+def write_request_files(lines: Iterable[bytes], prefix: str) -> List[str]:
+    """Write request lines to prefix-<n>.jsonl files that respect the provider limits."""
+    paths = []
+    f = None
+    count = size = 0
+    try:
+        for line in lines:
+            if f is None or count >= MAX_BATCH_REQUESTS or size + len(line) > MAX_BATCH_BYTES:
+                if f is not None:
+                    f.close()
+                paths.append(f"{prefix}-{len(paths)}.jsonl")
+                f = open(paths[-1], "wb")
+                count = size = 0
+            f.write(line)
+            count += 1
+            size += len(line)
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+def parse_output_line(line: Dict[str, Any]) -> Tuple[Optional[str], Dict[str, int], Optional[str]]:
+    """Return (content, usage, error) of one batch output line."""
+    response = line.get("response") or {}
+    body = response.get("body") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        error = line.get("error") or body.get("error") or {"message": f"HTTP {response.get('status_code')}"}
+        return None, {}, error.get("message", str(error)) if isinstance(error, dict) else str(error)
+    usage = body.get("usage") or {}
+    try:
+        content = body["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None, {}, "Malformed batch response"
+    return content, {
+        "total": usage.get("total_tokens", 0),
+        "prompt": usage.get("prompt_tokens", 0),
+        "completion": usage.get("completion_tokens", 0),
+        "cached": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+    }, None
+
+
+def _read_jsonl(lines: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    outputs = {}
+    for line in lines:
+        if line.strip():
+            item = json.loads(line)
+            outputs[item["custom_id"]] = item
+    return outputs
+
+
+class BatchProvider(ABC):
+    """
+    Interface of a provider-side batch API.
+
+    A provider accepts a JSONL file of chat completion requests, processes it
+    asynchronously and returns one output line per custom_id in the OpenAI
+    batch output format ({"custom_id", "response": {"status_code", "body"}, "error"}).
+    """
+
+    @abstractmethod
+    def submit(self, requests_path: str, metadata: Optional[Dict[str, str]] = None) -> str:
+        """Upload a request file and start a batch, returning its id."""
+
+    @abstractmethod
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        """Return the batch object; its "status" ends in one of TERMINAL_STATUSES."""
+
+    @abstractmethod
+    def results(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        """Return the output lines of a finished batch, keyed by custom_id."""
+
+    @abstractmethod
+    def cancel(self, batch_id: str) -> None:
+        """Ask the provider to stop a batch that is no longer needed."""
+
+    def wait(self, batch_id: str, poll_interval: float = POLL_INTERVAL, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Poll until the batch reaches a terminal status."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            batch = self.retrieve(batch_id)
+            status = batch.get("status")
+            counts = batch.get("request_counts") or {}
+            logger.info(f"Batch {batch_id}: {status} {counts.get('completed', 0)}/{counts.get('total', '?')}")
+            if status in TERMINAL_STATUSES:
+                return batch
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Batch {batch_id} did not finish within {timeout} seconds")
+            time.sleep(poll_interval)
+
+
+class OpenAIBatchProvider(BatchProvider):
+    """OpenAI Batch API (or a compatible gateway) through the files and batches endpoints."""
+
+    def __init__(self, api_key: str, base_url: Optional[str] = None, completion_window: str = "24h"):
+        import requests
+
+        self.api_key = api_key
+        self.api_root = self._api_root(base_url)
+        self.completion_window = completion_window
+        self._session = requests.Session()
+        self._session.headers["Authorization"] = f"Bearer {api_key}"
+
+    @staticmethod
+    def _api_root(base_url: Optional[str]) -> str:
+        root = (base_url or "https://api.openai.com/v1").rstrip("/")
+        if root.endswith("/chat/completions"):
+            root = root[:-len("/chat/completions")]
+        if not root.endswith("/v1"):
+            root += "/v1"
+        return root
+
+    def _request(self, method: str, path: str, **kwargs):
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+        response = self._session.request(method, f"{self.api_root}{path}", **kwargs)
+        if response.status_code >= 400:
+            logger.error(f"Batch API error: {response.text[:500]}")
+        response.raise_for_status()
+        return response
+
+    def submit(self, requests_path: str, metadata: Optional[Dict[str, str]] = None) -> str:
+        with open(requests_path, "rb") as f:
+            uploaded = self._request(
+                "POST", "/files",
+                files={"file": (os.path.basename(requests_path), f, "application/jsonl")},
+                data={"purpose": "batch"},
+            ).json()
+        batch = self._request("POST", "/batches", json={
+            "input_file_id": uploaded["id"],
+            "endpoint": BATCH_ENDPOINT,
+            "completion_window": self.completion_window,
+            "metadata": metadata or {},
+        }).json()
+        logger.info(f"Submitted batch {batch['id']} from {requests_path}")
+        return batch["id"]
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        return self._request("GET", f"/batches/{batch_id}").json()
+
+    def results(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        batch = self.retrieve(batch_id)
+        outputs = {}
+        # Failed requests are reported in the error file, successful ones in the output file
+        for file_id in (batch.get("error_file_id"), batch.get("output_file_id")):
+            if file_id:
+                outputs.update(_read_jsonl(self._request("GET", f"/files/{file_id}/content").text.splitlines()))
+        return outputs
+
+    def cancel(self, batch_id: str) -> None:
+        self._request("POST", f"/batches/{batch_id}/cancel")
+        logger.info(f"Cancelled batch {batch_id}")
+
+
+def echo_handler(body: Dict[str, Any]) -> str:
+    """Default LocalBatchProvider handler: a canned completion that names the request."""
+    has_image = any(
+        isinstance(item, dict) and item.get("type") == "image_url"
+        for message in body.get("messages", [])
+        if isinstance(message.get("content"), list)
+        for item in message["content"]
+    )
+    return f"Local batch stand-in response from {body.get('model')} ({'image' if has_image else 'text'} request)."
+
+
+class LocalBatchProvider(BatchProvider):
+    """
+    In-process stand-in for a batch provider, for tests and dry runs.
+
+    Each request body is passed to handler(body), which returns the completion
+    text or raises to produce a failed line. Batches report "in_progress" on
+    the first retrieve and are processed on the next one, so callers exercise
+    their polling path.
+    """
+
+    def __init__(self, handler: Callable[[Dict[str, Any]], str] = echo_handler):
+        self.handler = handler
+        self._batches: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, requests_path: str, metadata: Optional[Dict[str, str]] = None) -> str:
+        with open(requests_path, "r", encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        batch_id = f"batch_local_{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._batches[batch_id] = {
+                "id": batch_id, "status": "validating", "metadata": metadata or {},
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+                "input": lines, "output": {},
+            }
+        return batch_id
+
+    def _process(self, batch: Dict[str, Any]) -> None:
+        for line in batch["input"]:
+            try:
+                content = self.handler(line["body"])
+                output = {"custom_id": line["custom_id"], "error": None, "response": {"status_code": 200, "body": {
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                }}}
+                batch["request_counts"]["completed"] += 1
+            except Exception as e:
+                output = {"custom_id": line["custom_id"], "response": None, "error": {"code": "handler_error", "message": str(e)}}
+                batch["request_counts"]["failed"] += 1
+            batch["output"][line["custom_id"]] = output
+        batch["status"] = "completed"
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        with self._lock:
+            batch = self._batches[batch_id]
+            if batch["status"] == "validating":
+                batch["status"] = "in_progress"
+            elif batch["status"] == "in_progress":
+                self._process(batch)
+            return {key: value for key, value in batch.items() if key not in ("input", "output")}
+
+    def results(self, batch_id: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return dict(self._batches[batch_id]["output"])
+
+    def cancel(self, batch_id: str) -> None:
+        with self._lock:
+            batch = self._batches[batch_id]
+            if batch["status"] not in TERMINAL_STATUSES:
+                batch["status"] = "cancelled"
+
+
+class BatchScreening:
+    """
+    Offline two-stage HTP screening through a batch provider.
+
+    The multimodal stage of every drawing is written to JSONL request files
+    and submitted as provider batches; once they finish, the successful
+    analyses are turned into text-stage requests and submitted the same way.
+    Both stages use the request bodies HTPModel would send interactively.
+    Submitted batch ids are saved in work_dir/state.json, so an interrupted
+    run resumes polling instead of paying for the same requests again.
+
+    With a deadline (seconds for the whole run), batches still unfinished when
+    it passes are cancelled and dropped from the state, so a later run submits
+    them again. Drawings whose first stage finished get "partial" results, the
+    others "timeout".
+    """
+
+    def __init__(
+        self,
+        model,
+        provider: BatchProvider,
+        work_dir: str,
+        poll_interval: float = POLL_INTERVAL,
+        resume: bool = True,
+        deadline: Optional[float] = None,
+    ):
+        self.model = model
+        self.deadline = deadline
+        self.resume = resume
+        self.provider = provider
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.state_path = os.path.join(work_dir, "state.json")
+        os.makedirs(work_dir, exist_ok=True)
+
+    def _load_state(self, digests: List[str]) -> Dict[str, Any]:
+        if self.resume and os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("digests") == digests:
+                logger.info(f"Resuming batch run from {self.state_path}")
+                return state
+            logger.warning(f"{self.state_path} belongs to a different set of drawings, starting over")
+        return {"digests": digests, "stages": {}}
+
+    def _save_state(self, state: Dict[str, Any]) -> None:
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _run_stage(
+        self,
+        state: Dict[str, Any],
+        stage: str,
+        lines: Callable[[], Iterable[bytes]],
+        deadline: Optional[Deadline] = None,
+    ) -> Tuple[Dict[str, Dict[str, Any]], bool]:
+        """
+        Submit a stage once (lines is only consumed on first submission), wait
+        for it and collect its outputs. Returns (outputs, expired), where expired
+        means the deadline passed and the unfinished batches were cancelled.
+        """
+        batch_ids = state["stages"].get(stage)
+        if batch_ids is None:
+            paths = write_request_files(lines(), os.path.join(self.work_dir, stage))
+            batch_ids = [self.provider.submit(path, metadata={"psydraw_stage": stage}) for path in paths]
+            state["stages"][stage] = batch_ids
+            self._save_state(state)
+        outputs = {}
+        for position, batch_id in enumerate(batch_ids):
+            try:
+                batch = self.provider.wait(batch_id, self.poll_interval, timeout=deadline and max(deadline.remaining(), 0))
+            except TimeoutError:
+                logger.warning(f"Deadline passed during the {stage} stage, cancelling its unfinished batches")
+                for unfinished in batch_ids[position:]:
+                    try:
+                        self.provider.cancel(unfinished)
+                    except Exception as e:
+                        logger.error(f"Could not cancel batch {unfinished}: {str(e)}")
+                del state["stages"][stage]
+                self._save_state(state)
+                return outputs, True
+            if batch.get("status") != "completed":
+                logger.error(f"Batch {batch_id} ended with status {batch.get('status')}")
+            outputs.update(self.provider.results(batch_id))
+        return outputs, False
+
+    def run(self, image_paths: List[str]) -> List[Dict[str, Any]]:
+        """Screen the drawings and return one workflow()-shaped result per input, in input order."""
+        store = get_image_store()
+        digests = [store.put_file(path) for path in image_paths]
+        state = self._load_state(digests)
+        deadline = Deadline(self.deadline) if self.deadline else None
+
+        def multimodal_lines():
+            for i, digest in enumerate(digests):
+                data_url = get_data_url(digest, BATCH_IMAGE_PROFILE)
+                yield request_line(f"drawing-{i}", self.model.multimodal_model.request_body(self.model.multimodal_messages(data_url)))
+
+        stage1, expired = self._run_stage(state, "multimodal", multimodal_lines, deadline)
+        initial = {i: self._output(stage1, i) for i in range(len(digests))}
+
+        def text_lines():
+            for i, (content, _, error) in initial.items():
+                if error is None:
+                    yield request_line(f"drawing-{i}", self.model.text_model.request_body(self.model.text_messages(content)))
+
+        stage2 = {}
+        if not expired:
+            stage2, expired = self._run_stage(state, "text", text_lines, deadline)
+
+        results = []
+        for i, digest in enumerate(digests):
+            content, usage, error = initial[i]
+            deeper, deeper_usage = None, {}
+            if error is None:
+                deeper, deeper_usage, error = self._output(stage2, i)
+            total_usage = {key: usage.get(key, 0) + deeper_usage.get(key, 0) for key in ("total", "prompt", "completion", "cached")}
+            # Cut off by the deadline rather than failed
+            if expired and content is not None and f"drawing-{i}" not in stage2:
+                results.append(self.model.make_results(content, digest=digest, usage=total_usage, status="partial"))
+            elif expired and content is None and f"drawing-{i}" not in stage1:
+                results.append(self.model.make_results(digest=digest, usage=total_usage, status="timeout"))
+            elif error is not None:
+                logger.error(f"Drawing {image_paths[i]} failed in batch: {error}")
+                results.append(self.model.make_results(error=f"Analysis error: {error}", digest=digest, usage=total_usage))
+            else:
+                results.append(self.model.make_results(content, deeper, digest=digest, usage=total_usage))
+        return results
+
+    @staticmethod
+    def _output(outputs: Dict[str, Dict[str, Any]], index: int) -> Tuple[Optional[str], Dict[str, int], Optional[str]]:
+        line = outputs.get(f"drawing-{index}")
+        if line is None:
+            return None, {}, "Missing from batch output"
+        return parse_output_line(line)
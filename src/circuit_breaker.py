@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Consecutive upstream failures that open the breaker
+FAILURE_THRESHOLD = int(os.getenv("PSYDRAW_BREAKER_FAILURES", "5"))
+# Seconds the breaker stays open before letting a probe request through
+RECOVERY_TIMEOUT = float(os.getenv("PSYDRAW_BREAKER_RESET", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class UpstreamError(Exception):
+    """The LLM upstream failed or returned an error response."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitOpenError(UpstreamError):
+    """Rejected without calling the upstream because its circuit breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Upstream {name} is unavailable, retry in {retry_after:.0f}s", status_code=503)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one upstream.
+
+    closed: calls go through; FAILURE_THRESHOLD consecutive failures open it.
+    open: calls are rejected immediately with CircuitOpenError until
+    RECOVERY_TIMEOUT has passed.
+    half_open: a single probe call goes through; success closes the breaker,
+    failure opens it for another RECOVERY_TIMEOUT.
+
+    clock returns monotonic seconds and can be replaced in tests.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        recovery_timeout: float = RECOVERY_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError if the call must not reach the upstream."""
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            elapsed = self.clock() - self.opened_at
+            if self.state == OPEN and elapsed >= self.recovery_timeout:
+                self.state = HALF_OPEN
+                logger.info(f"Circuit breaker for {self.name} half-open, probing upstream")
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError(self.name, max(self.recovery_timeout - elapsed, 1.0))
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != CLOSED:
+                logger.info(f"Circuit breaker for {self.name} closed, upstream recovered")
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    logger.warning(f"Circuit breaker for {self.name} opened after {self.failures} failure(s)")
+                self.state = OPEN
+                self.opened_at = self.clock()
+
+    def release(self) -> None:
+        """End a call that says nothing about the upstream's health (e.g. cancelled by its own deadline)."""
+        with self._lock:
+            self._probing = False
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {"state": self.state, "failures": self.failures}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Return the process-wide breaker of an upstream, shared by every client that calls it."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def breaker_states() -> Dict[str, Dict[str, object]]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
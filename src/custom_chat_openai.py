@@ -8,17 +8,46 @@ from langchain_core.messages import (
     SystemMessage,
 )
 from typing import Any, Dict, Iterator, List, Optional, Union
-import openai
+from pydantic import PrivateAttr
 import logging
 import os
-import json
+import threading
+import time
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-import re
+
+try:
+    from src.payload import encode_chat_body
+    from src.serialization import gzip_body
+    from src.token_budget import MAX_OUTPUT_TOKENS
+    from src.circuit_breaker import CircuitOpenError, UpstreamError, get_circuit_breaker
+    from src.deadline import DeadlineExceeded, current_deadline, request_timeout
+    from src.log_config import log_request
+    from src.tracing import span
+except ImportError:
+    from payload import encode_chat_body
+    from serialization import gzip_body
+    from token_budget import MAX_OUTPUT_TOKENS
+    from circuit_breaker import CircuitOpenError, UpstreamError, get_circuit_breaker
+    from deadline import DeadlineExceeded, current_deadline, request_timeout
+    from log_config import log_request
+    from tracing import span
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Connections kept open per host; sized for a Streamlit/API process serving many sessions
+HTTP_POOL_MAXSIZE = int(os.getenv("PSYDRAW_HTTP_POOL_MAXSIZE", "32"))
+
+
+class DeadlineRetry(Retry):
+    """
+    urllib3 Retry that does not retry while a deadline is active: every attempt
+    would reuse the call's timeout and add backoff, outlasting the remaining budget.
+    """
+
+    def is_exhausted(self) -> bool:
+        return current_deadline() is not None or super().is_exhausted()
 
 # Create a custom ChatGeneration that includes the generations attribute
 class CustomChatGeneration(ChatGeneration):
@@ -42,6 +71,15 @@ class ChatOpenAI(BaseChatModel):
     api_key: str
     base_url: Optional[str] = None
     temperature: float = 0.7
+    # Sent only when set
+    top_p: Optional[float] = None
+    seed: Optional[int] = None
+    # Default output budget; callers pass a tighter per-stage max_tokens to invoke()
+    max_tokens: int = MAX_OUTPUT_TOKENS
+    # Only enable when the gateway accepts gzip-encoded request bodies
+    gzip_requests: bool = os.getenv("PSYDRAW_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
+    _session: Optional[requests.Session] = PrivateAttr(default=None)
+    _session_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
     
     def __init__(self, *args, **kwargs):
         # Check if model name is a Claude model and replace with GPT equivalent
@@ -85,93 +123,187 @@ class ChatOpenAI(BaseChatModel):
         else:
             return "https://api.openai.com/v1/chat/completions"
     
-    def _make_direct_api_call(self, messages, model, temperature=0.7, stop=None):
-        """Make a direct API call to OpenAI's chat completions endpoint."""
-        try:
-            # Create a session with retries
-            session = requests.Session()
-            retry = Retry(total=3, backoff_factor=0.5)
-            adapter = HTTPAdapter(max_retries=retry)
-            session.mount('http://', adapter)
-            session.mount('https://', adapter)
-            
-            # Always use the correct API endpoint for chat completions
-            api_url = "https://api.openai.com/v1/chat/completions"
-            
-            # Prepare headers
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.api_key}"
-            }
-            
-            # Check if any message has image content to log it
-            has_image = False
-            for msg in messages:
-                if isinstance(msg, dict) and msg.get("role") == "user" and isinstance(msg.get("content"), list):
-                    for item in msg.get("content", []):
-                        if isinstance(item, dict) and item.get("type") == "image_url":
-                            has_image = True
-                            logger.info("Detected image in message payload")
-            
-            # For multimodal messages, make sure the model can handle images
+    def _get_session(self) -> requests.Session:
+        """Return this client's HTTP session, created once so its connection pool stays warm."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    retry = DeadlineRetry(total=3, backoff_factor=0.5)
+                    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=HTTP_POOL_MAXSIZE)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+    
+    def _build_request_data(self, messages, model, temperature=0.7, stop=None, response_format=None, max_tokens=None) -> Dict[str, Any]:
+        """Build the chat completions request body for OpenAI-format messages."""
+        model_to_use = model
+        # For multimodal messages, make sure the model can handle images
+        if "gpt-4" in model and "vision" not in model and "gpt-4o" not in model:
+            has_image = any(
+                isinstance(item, dict) and item.get("type") == "image_url"
+                for msg in messages
+                if isinstance(msg, dict) and msg.get("role") == "user" and isinstance(msg.get("content"), list)
+                for item in msg["content"]
+            )
             if has_image:
-                # Make sure we're using the right model variant
-                model_to_use = model
-                if "gpt-4" in model and "vision" not in model and "gpt-4o" not in model:
-                    # Always use GPT-4o for vision capabilities as it handles this natively
-                    model_to_use = "gpt-4o"
-                    logger.info(f"Upgrading model to {model_to_use} for image analysis")
-                
-                # Prepare request body with the upgraded model
-                data = {
-                    "model": model_to_use,
-                    "messages": messages,
-                    "temperature": temperature,
-                    "max_tokens": 4096
-                }
-                
-                # Log detailed request info
-                logger.info(f"Making API call for image analysis with model {model_to_use}")
-                logger.info(f"API URL: {api_url}")
-                logger.info("Message content contains image data")
-            else:
-                # Normal text-only request
-                data = {
-                    "model": model,
-                    "messages": messages,
-                    "temperature": temperature,
-                    "max_tokens": 4096
-                }
-                logger.info(f"Making API call for text-only with model {model} to {api_url}")
-            
-            if stop:
-                data["stop"] = stop
-            
-            # Make the request
-            logger.info("Sending API request...")
-            response = session.post(api_url, headers=headers, json=data)
-            # Log response status code
-            logger.info(f"Response status code: {response.status_code}")
-            
-            # If there's an error, try to log the error message
-            if response.status_code != 200:
+                # Always use GPT-4o for vision capabilities as it handles this natively
+                model_to_use = "gpt-4o"
+                logger.info(f"Upgrading model to {model_to_use} for image analysis")
+        
+        data = {
+            "model": model_to_use,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens or self.max_tokens
+        }
+        if self.top_p is not None:
+            data["top_p"] = self.top_p
+        if self.seed is not None:
+            data["seed"] = self.seed
+        if stop:
+            data["stop"] = stop
+        if response_format:
+            data["response_format"] = response_format
+        return data
+    
+    def request_body(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        max_tokens: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """
+        Chat completions request body for LangChain messages, exactly as this client
+        would send it. Used to write provider-side batch request files.
+        """
+        return self._build_request_data(
+            self._convert_messages_to_openai_format(messages),
+            model=self.model_name,
+            temperature=self.temperature,
+            stop=stop,
+            response_format=response_format,
+            max_tokens=max_tokens
+        )
+    
+    def _make_direct_api_call(self, messages, model, temperature=0.7, stop=None, response_format=None, max_tokens=None):
+        """
+        Make a direct API call to OpenAI's chat completions endpoint.
+
+        Returns (content, usage, finish_reason), where usage is the response's usage
+        object (including prompt_tokens_details.cached_tokens when the provider reports it).
+        Raises UpstreamError on failure, and CircuitOpenError without sending the
+        request while the upstream's circuit breaker is open. Connect and read
+        timeouts come from the remaining budget of the current deadline, and the
+        session does not retry while one is active; running out of it raises
+        DeadlineExceeded.
+        """
+        # Reuse the session (and its open connections) across calls and threads
+        session = self._get_session()
+        
+        # Resolve the chat completions endpoint from base_url
+        api_url = self._get_api_url()
+        
+        # Prepare headers
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        
+        with span("serialize_request") as serialize_span:
+            data = self._build_request_data(messages, model, temperature, stop, response_format, max_tokens)
+            body = encode_chat_body(data)
+            if self.gzip_requests:
+                body = gzip_body(body)
+                headers["Content-Encoding"] = "gzip"
+            if serialize_span:
+                serialize_span.set(bytes=len(body), gzip=self.gzip_requests)
+        
+        # Everything about the call goes into one summary record, logged when it ends
+        summary = {"model": data["model"], "status": "error", "request_bytes": len(body)}
+        started = time.perf_counter()
+        with span("http_call") as call_span:
+            try:
+                timeout = request_timeout(f"calling {data['model']}")
+                # Fail fast while the upstream is known to be down instead of waiting through retries
+                breaker = get_circuit_breaker(api_url)
+                breaker.before_call()
+                # Set once the call's outcome is recorded; anything else (a parse or
+                # deadline error, a bug) must still free the breaker's half-open probe
+                settled = False
                 try:
-                    error_json = response.json()
-                    logger.error(f"API error: {error_json}")
-                except:
-                    logger.error(f"API error: {response.text[:500]}")
-                    
-            response.raise_for_status()
+                    try:
+                        response = session.post(api_url, headers=headers, data=body, timeout=timeout)
+                    except requests.Timeout as e:
+                        deadline = current_deadline()
+                        if deadline is not None and deadline.expired():
+                            # Our own budget ran out, which says nothing about the upstream's health:
+                            # leave the breaker unsettled so it is only released
+                            raise DeadlineExceeded(f"Deadline of {deadline.seconds:g}s exceeded waiting for {data['model']}") from e
+                        breaker.record_failure()
+                        settled = True
+                        raise UpstreamError(f"Request to {api_url} timed out: {e}") from e
+                    except requests.RequestException as e:
+                        breaker.record_failure()
+                        settled = True
+                        raise UpstreamError(f"Request to {api_url} failed: {e}") from e
+                    summary["http_status"] = response.status_code
+                    summary["response_bytes"] = len(response.content)
+                    # Connection retries done by the session's urllib3 Retry
+                    retries = getattr(response.raw, "retries", None)
+                    summary["retries"] = len(retries.history) if retries is not None else 0
             
-            # Process the response
-            result = response.json()
-            logger.info("API call completed successfully")
+                    if response.status_code != 200:
+                        try:
+                            error_detail = response.json()
+                        except ValueError:
+                            error_detail = response.text[:500]
+                        # Rate limits and server errors mean the upstream is unhealthy; other client errors do not
+                        if response.status_code == 429 or response.status_code >= 500:
+                            breaker.record_failure()
+                        else:
+                            breaker.record_success()
+                        settled = True
+                        raise UpstreamError(f"API error {response.status_code}: {error_detail}", status_code=response.status_code)
             
-            return result["choices"][0]["message"]["content"]
-        except Exception as e:
-            logger.error(f"Error in direct API call: {e}")
-            # Return user-friendly error message instead of actual error
-            return "无法分析图像。请确保您上传了清晰的图像，并检查网络连接。 (Unable to analyze the image. Please ensure you've uploaded a clear image and check your network connection.)"
+                    breaker.record_success()
+                    settled = True
+                    try:
+                        with span("parse_response"):
+                            result = response.json()
+                            choice = result["choices"][0]
+                            content = choice["message"]["content"]
+                    except (ValueError, KeyError, IndexError, TypeError) as e:
+                        raise UpstreamError(f"Malformed API response: {response.text[:500]}", status_code=response.status_code) from e
+                    usage = result.get("usage") or {}
+                    summary.update(
+                        status="ok",
+                        prompt_tokens=usage.get("prompt_tokens", 0),
+                        cached_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+                        completion_tokens=usage.get("completion_tokens", 0),
+                        finish_reason=choice.get("finish_reason"),
+                    )
+                finally:
+                    if not settled:
+                        breaker.release()
+            except CircuitOpenError:
+                summary["status"] = "unavailable"
+                raise
+            except DeadlineExceeded:
+                summary["status"] = "timeout"
+                raise
+            except UpstreamError as e:
+                summary["error"] = str(e)
+                raise
+            finally:
+                summary["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                if call_span:
+                    call_span.set(**summary)
+                log_request(logger, "chat completion", logging.INFO if summary["status"] == "ok" else logging.WARNING, **summary)
+        
+        return content, usage, choice.get("finish_reason")
     
     def _convert_messages_to_openai_format(self, messages: List[BaseMessage]) -> List[Dict[str, Any]]:
         """Convert LangChain messages to OpenAI format."""
@@ -185,7 +317,6 @@ class ChatOpenAI(BaseChatModel):
                     if isinstance(item, dict):
                         if "type" in item and "text" in item and item["type"] == "text":
                             content_list.append({"type": "text", "text": item["text"]})
-                            logger.info(f"Added text content: {item['text'][:50]}...")
                         elif "type" in item and "image_url" in item and item["type"] == "image_url":
                             # Ensure image_url is correctly formatted
                             img_url = item["image_url"]
@@ -194,17 +325,6 @@ class ChatOpenAI(BaseChatModel):
                                     "type": "image_url",
                                     "image_url": img_url
                                 })
-                                # Log image info but not the full base64 data
-                                url_start = img_url["url"][:30]
-                                logger.info(f"Added image with URL starting: {url_start}...")
-                                
-                                # Log if it contains base64 data
-                                if "base64" in img_url["url"]:
-                                    logger.info("Image contains base64 data")
-                                    # Get the MIME type
-                                    mime_match = re.search(r"data:(.*?);base64,", img_url["url"])
-                                    if mime_match:
-                                        logger.info(f"Image MIME type: {mime_match.group(1)}")
                             else:
                                 # Handle direct URL string
                                 url_to_use = {"url": img_url}
@@ -212,9 +332,10 @@ class ChatOpenAI(BaseChatModel):
                                     "type": "image_url",
                                     "image_url": url_to_use
                                 })
-                                logger.info(f"Added image with direct URL: {img_url[:30]}...")
                 message_dict = {"role": "user", "content": content_list}
-                logger.info(f"Created multimodal message with {len(content_list)} content items")
+                if logger.isEnabledFor(logging.DEBUG):
+                    # Item types only, never payload fragments
+                    logger.debug(f"Multimodal message with items: {[item['type'] for item in content_list]}")
             else:
                 # Handle text-only messages
                 message_dict = {"role": "", "content": message.content}
@@ -237,36 +358,24 @@ class ChatOpenAI(BaseChatModel):
         run_manager: Optional[CallbackManagerForLLMRun] = None,
         **kwargs: Any,
     ) -> CustomChatGeneration:
-        """Generate a response using direct OpenAI client."""
-        logger.info(f"Generating with model {self.model_name}")
-        try:
-            openai_messages = self._convert_messages_to_openai_format(messages)
-            logger.info(f"Converted {len(openai_messages)} messages to OpenAI format")
+        """Generate a response using direct OpenAI client. Upstream failures raise UpstreamError."""
+        with span("ChatOpenAI._generate", model=self.model_name):
+            with span("convert_messages", messages=len(messages)):
+                openai_messages = self._convert_messages_to_openai_format(messages)
             
-            content = self._make_direct_api_call(
+            content, token_usage, finish_reason = self._make_direct_api_call(
                 messages=openai_messages,
                 model=self.model_name,
                 temperature=self.temperature,
-                stop=stop
+                stop=stop,
+                # Structured output mode passes a JSON schema through invoke(..., response_format=...)
+                response_format=kwargs.get("response_format"),
+                max_tokens=kwargs.get("max_tokens")
             )
-            
-            # If the response contains our error message, log it but still return a valid response
-            if content == "无法分析图像。请确保您上传了清晰的图像，并检查网络连接。 (Unable to analyze the image. Please ensure you've uploaded a clear image and check your network connection.)":
-                logger.warning("Returning friendly error message from API call")
-            
-            return CustomChatGeneration(
-                message=AIMessage(content=content),
-                generation_info={"finish_reason": "stop"},
-            )
-        except Exception as e:
-            logger.error(f"Error generating response: {e}")
-            logger.error(f"Error type: {type(e).__name__}")
-            logger.error(f"Error details: {str(e)}")
-            logger.error(f"API Key provided: {'Yes (length: ' + str(len(self.api_key)) + ')' if self.api_key else 'No'}")
-            logger.error(f"Base URL provided: {self.base_url or 'No (using default)'}")
-            logger.error(f"Model requested: {self.model_name}")
-            # Return a user-friendly error message
-            return CustomChatGeneration(
-                message=AIMessage(content="无法分析图像。请确保您上传了清晰的图像，并检查网络连接。 (Unable to analyze the image. Please ensure you've uploaded a clear image and check your network connection.)"),
-                generation_info={"finish_reason": "error"},
-            ) 
\ No newline at end of file
+        
+        return CustomChatGeneration(
+            message=AIMessage(content=content, response_metadata={
+                "token_usage": token_usage, "model_name": self.model_name, "finish_reason": finish_reason
+            }),
+            generation_info={"finish_reason": finish_reason},
+        )
@@ -6,7 +6,6 @@ import logging
 from types import ModuleType
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def create_clean_openai_client(**kwargs):
     """Create a clean OpenAI client without proxy settings."""
@@ -0,0 +1,80 @@
+import contextvars
+import os
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Tuple
+
+# Seconds to establish a connection to the upstream
+CONNECT_TIMEOUT = float(os.getenv("PSYDRAW_CONNECT_TIMEOUT", "10"))
+# Longest wait for a response without a deadline, so a stuck connection cannot hang a worker forever
+READ_TIMEOUT = float(os.getenv("PSYDRAW_READ_TIMEOUT", "300"))
+# Default time budget of a whole workflow in seconds, unset for none
+WORKFLOW_TIMEOUT = float(os.getenv("PSYDRAW_WORKFLOW_TIMEOUT", "0")) or None
+
+
+class DeadlineExceeded(TimeoutError):
+    """The workflow's time budget ran out before a stage could finish."""
+
+
+class Deadline:
+    """A point in time by which a workflow must finish, measured on the monotonic clock."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, what: str = "request") -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline of {self.seconds:g}s exceeded before {what}")
+
+    def __repr__(self) -> str:
+        return f"Deadline({self.seconds:g}s, remaining={self.remaining():.1f}s)"
+
+
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("psydraw_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]) -> Iterator[Optional[Deadline]]:
+    """
+    Run the block under a deadline of seconds from now; None keeps the
+    enclosing deadline. A nested scope can only shorten the enclosing one.
+    """
+    enclosing = _current.get()
+    if seconds is None or (enclosing is not None and enclosing.remaining() <= seconds):
+        yield enclosing
+        return
+    token = _current.set(Deadline(seconds))
+    try:
+        yield _current.get()
+    finally:
+        _current.reset(token)
+
+
+def request_timeout(what: str = "request") -> Tuple[float, float]:
+    """
+    (connect, read) timeouts for an upstream call, derived from the remaining
+    budget of the current deadline. Raises DeadlineExceeded if it already passed.
+    """
+    deadline = _current.get()
+    if deadline is None:
+        return CONNECT_TIMEOUT, READ_TIMEOUT
+    deadline.check(what)
+    remaining = deadline.remaining()
+    return min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUT, remaining)
+
+
+def submit_with_deadline(executor: Executor, fn: Callable, *args, **kwargs) -> Future:
+    """executor.submit that carries the caller's deadline into the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
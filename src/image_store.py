@@ -0,0 +1,312 @@
+import base64
+import binascii
+import hashlib
+import logging
+import mmap
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_DIR = os.getenv("PSYDRAW_IMAGE_STORE", "image_store")
+REF_PREFIX = "sha256:"
+ORIGINAL = "original"
+
+# JPEG quality of the re-encoded profiles; 75 is PIL's default, which the pages used before the store
+JPEG_QUALITY = int(os.getenv("PSYDRAW_JPEG_QUALITY", "75"))
+
+# Preprocessing profiles. "model" is the 800px re-encode the HTP Test page sends
+# to the model, "jpeg" the full-size re-encode of the Batch page.
+PROFILES = {
+    ORIGINAL: None,
+    "model": {"max_size": (800, 800), "format": "JPEG", "quality": JPEG_QUALITY},
+    "jpeg": {"max_size": None, "format": "JPEG", "quality": JPEG_QUALITY},
+    "thumbnail": {"max_size": (200, 200), "format": "JPEG", "quality": 85},
+}
+
+_REF_PATTERN = re.compile(r"^sha256:([0-9a-f]{64})(?::([a-z_]+))?$")
+
+_MAGIC_NUMBERS = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def image_ref(digest: str, profile: str = ORIGINAL) -> str:
+    """Build a reference string such as 'sha256:<hex>' or 'sha256:<hex>:model'."""
+    if profile == ORIGINAL:
+        return f"{REF_PREFIX}{digest}"
+    return f"{REF_PREFIX}{digest}:{profile}"
+
+
+def parse_image_ref(value) -> Optional[Tuple[str, str]]:
+    """Return (digest, profile) if value is an image reference, otherwise None."""
+    if not isinstance(value, str) or not value.startswith(REF_PREFIX):
+        return None
+    match = _REF_PATTERN.match(value)
+    if not match:
+        return None
+    return match.group(1), match.group(2) or ORIGINAL
+
+
+def sniff_mime(header: bytes, default: str = "image/jpeg") -> str:
+    """Detect the image MIME type from the first bytes of the file."""
+    header = bytes(header[:12])
+    for magic, mime in _MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return mime
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return default
+
+
+def _preprocess(data, spec: dict) -> bytes:
+    """Apply a preprocessing profile to raw image bytes."""
+    from PIL import Image
+
+    image = Image.open(BytesIO(data))
+    if spec.get("max_size"):
+        max_size = spec["max_size"]
+        if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
+            image.thumbnail(max_size)
+    if spec["format"] == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffered = BytesIO()
+    image.save(buffered, format=spec["format"], quality=spec.get("quality", JPEG_QUALITY))
+    return buffered.getvalue()
+
+
+class ImageStore:
+    """
+    Content-addressed local image store.
+
+    Files are keyed by the SHA-256 of the original bytes and sharded as
+    <root>/ab/cd/<digest>. Preprocessed variants live next to the original as
+    <digest>.<profile>, so each drawing is stored and preprocessed only once.
+
+    Images put as transient (user session uploads) are reference counted in
+    this process and deleted with their variants once the last holder
+    releases them, unless they were also stored for good.
+    """
+
+    def __init__(self, root: str = DEFAULT_STORE_DIR):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._holds: Dict[str, int] = {}
+
+    def path(self, digest: str, profile: str = ORIGINAL) -> str:
+        shard = os.path.join(self.root, digest[:2], digest[2:4])
+        name = digest if profile == ORIGINAL else f"{digest}.{profile}"
+        spec = PROFILES.get(profile)
+        if spec and spec.get("quality"):
+            # A changed quality setting creates new variants instead of reusing old ones
+            name += f".q{spec['quality']}"
+        return os.path.join(shard, name)
+
+    def contains(self, digest: str, profile: str = ORIGINAL) -> bool:
+        return os.path.exists(self.path(digest, profile))
+
+    def _write_atomic(self, path: str, data) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, data, transient: bool = False) -> str:
+        """
+        Store raw image bytes and return their digest. Duplicates are not re-written.
+        A transient put takes a hold on the image that release() gives back; an image
+        that was already stored for good is never held, and a later non-transient
+        put keeps a held one for good.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        with self._lock:
+            exists = os.path.exists(path)
+            if not transient:
+                self._holds.pop(digest, None)
+            elif digest in self._holds or not exists:
+                self._holds[digest] = self._holds.get(digest, 0) + 1
+            if not exists:
+                self._write_atomic(path, data)
+                logger.info(f"Stored image {digest[:12]} ({len(data)} bytes)")
+        return digest
+
+    def release(self, digest: str) -> None:
+        """Give back one transient hold; the last one deletes the image and its variants."""
+        with self._lock:
+            holds = self._holds.get(digest)
+            if holds is None:
+                return
+            if holds > 1:
+                self._holds[digest] = holds - 1
+                return
+            del self._holds[digest]
+            shard = os.path.dirname(self.path(digest))
+            for name in os.listdir(shard) if os.path.isdir(shard) else ():
+                if name == digest or name.startswith(digest + "."):
+                    os.remove(os.path.join(shard, name))
+        logger.info(f"Deleted image {digest[:12]} and its variants")
+
+    def put_file(self, file_path: str) -> str:
+        """Store an image file by content and return its digest."""
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        with self._lock:
+            self._holds.pop(digest, None)
+        if not self.contains(digest):
+            with open(file_path, "rb") as f:
+                self._write_atomic(self.path(digest), f.read())
+            logger.info(f"Stored image {digest[:12]} from {file_path}")
+        return digest
+
+    @contextmanager
+    def open(self, digest: str, profile: str = ORIGINAL) -> Iterator[memoryview]:
+        """Memory-map a stored image (or variant) for zero-copy reads."""
+        if profile != ORIGINAL:
+            self.variant(digest, profile)
+        path = self.path(digest, profile)
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield memoryview(b"")
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mm)
+            try:
+                yield view
+            finally:
+                view.release()
+                mm.close()
+
+    def read(self, digest: str, profile: str = ORIGINAL) -> bytes:
+        """Read a stored image (or variant) into memory."""
+        with self.open(digest, profile) as view:
+            return bytes(view)
+
+    def variant(self, digest: str, profile: str) -> str:
+        """Return the path of a preprocessed variant, creating it on first use."""
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown preprocessing profile: {profile}")
+        path = self.path(digest, profile)
+        if profile == ORIGINAL or os.path.exists(path):
+            return path
+        with self._lock:
+            if not os.path.exists(path):
+                with self.open(digest) as view:
+                    data = _preprocess(view, PROFILES[profile])
+                self._write_atomic(path, data)
+                logger.info(f"Created '{profile}' variant of {digest[:12]} ({len(data)} bytes)")
+        return path
+
+    def mime_type(self, digest: str, profile: str = ORIGINAL) -> str:
+        with open(self.variant(digest, profile), "rb") as f:
+            return sniff_mime(f.read(12))
+
+
+class DataURLCache:
+    """
+    Bounded LRU cache of ready-to-send data URLs keyed by (digest, profile).
+
+    Both the entry count and the total size are capped, so a handful of large
+    drawings cannot pin an unbounded amount of memory.
+    """
+
+    def __init__(self, max_entries: int = 16, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, store: ImageStore, digest: str, profile: str = ORIGINAL) -> str:
+        key = (digest, profile)
+        with self._lock:
+            data_url = self._entries.get(key)
+            if data_url is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data_url
+            self.misses += 1
+
+        with store.open(digest, profile) as image_data:
+            mime_type = sniff_mime(image_data[:12])
+            data_url = f"data:{mime_type};base64," + base64.b64encode(image_data).decode("ascii")
+
+        with self._lock:
+            if key not in self._entries and len(data_url) <= self.max_bytes:
+                self._entries[key] = data_url
+                self._size += len(data_url)
+                while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return data_url
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+def to_data_url(image_b64: str) -> str:
+    """Wrap a bare base64 string (or pass through a data URL) without decoding it fully."""
+    if image_b64.startswith("data:"):
+        return image_b64
+    try:
+        header = base64.b64decode(image_b64[:16])
+    except (binascii.Error, ValueError):
+        header = b""
+    return f"data:{sniff_mime(header)};base64,{image_b64}"
+
+
+_default_store = None
+_default_data_urls = DataURLCache()
+_default_store_lock = threading.Lock()
+
+
+def get_image_store() -> ImageStore:
+    """Return the process-wide image store."""
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = ImageStore()
+    return _default_store
+
+
+def store_image_input(image_input: str) -> Optional[str]:
+    """Return the digest for an image reference, file path or base64 string, storing it if needed."""
+    ref = parse_image_ref(image_input)
+    if ref is not None:
+        return ref[0]
+    if os.path.isfile(image_input):
+        return get_image_store().put_file(image_input)
+    payload = image_input.split(",", 1)[1] if image_input.startswith("data:") else image_input
+    try:
+        return get_image_store().put(base64.b64decode(payload, validate=True))
+    except (binascii.Error, ValueError):
+        return None
+
+
+def get_data_url(digest: str, profile: str = ORIGINAL) -> str:
+    """Return the cached data URL for a stored image, encoding it at most once."""
+    return _default_data_urls.get(get_image_store(), digest, profile)
@@ -0,0 +1,84 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+from typing import Any, Optional
+
+# Level of the psydraw loggers, e.g. DEBUG for per-message details of every request
+LOG_LEVEL = os.getenv("PSYDRAW_LOG_LEVEL", "INFO").upper()
+# "text" for human-readable lines, "json" for one JSON object per line
+LOG_FORMAT = os.getenv("PSYDRAW_LOG_FORMAT", "text").lower()
+# Fraction of successful request summaries that are logged; failures are always logged
+LOG_SAMPLE_RATE = float(os.getenv("PSYDRAW_LOG_SAMPLE_RATE", "1.0"))
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the structured fields of log_request() at the top level."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            # Summary records carry their fields separately, so keep the message short
+            "message": getattr(record, "event", None) or record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def log_level(level: str) -> str:
+    """Upper-case name of a log level given in any case; raises ValueError for unknown names."""
+    name = str(level).strip().upper()
+    if name not in LOG_LEVELS:
+        raise ValueError(f"Unknown log level {level!r}, expected one of {', '.join(LOG_LEVELS)}")
+    return name
+
+
+def add_log_arguments(parser: argparse.ArgumentParser, default: Optional[str] = None) -> None:
+    """The --log_level option shared by the entry points, accepted in any case."""
+    parser.add_argument("--log_level", type=str.upper, choices=LOG_LEVELS, default=default,
+                        help=f"Log level (default: {default or 'PSYDRAW_LOG_LEVEL or INFO'})")
+
+
+def configure_logging(level: Optional[str] = None, fmt: Optional[str] = None, force: bool = False) -> None:
+    """
+    Set up the root handler once per process. Entry points call this; library
+    modules only create loggers, so importing them never changes logging.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured and not force:
+            return
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter() if (fmt or LOG_FORMAT) == "json" else logging.Formatter(TEXT_FORMAT))
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(log_level(level or LOG_LEVEL))
+        _configured = True
+
+
+def log_request(logger: logging.Logger, message: str, level: int = logging.INFO, **fields: Any) -> None:
+    """
+    Emit the single summary record of a request. Successful ones are sampled
+    at LOG_SAMPLE_RATE; the fields are free when the level is disabled.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING and LOG_SAMPLE_RATE < 1.0 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    summary = " ".join(f"{key}={value}" for key, value in fields.items() if value is not None)
+    logger.log(level, f"{message} {summary}", extra={"event": message, "fields": fields})
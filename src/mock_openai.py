@@ -0,0 +1,127 @@
+"""
+Local OpenAI-compatible chat completions server with canned answers, for
+profiling, benchmarks and load tests without calling a real model.
+
+    python -m src.mock_openai --port 8011 --latency 0.5
+
+then point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8011/v1.
+"""
+import argparse
+import gzip
+import json
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ANALYSIS_TEXT = (
+    "In this drawing I can see a small house with a door and two windows on the left, "
+    "a tall tree with a full crown in the middle and a standing person on the right. "
+    "The lines are steady and the figures are placed near the bottom of the page. "
+    "The house appears closed but intact, the tree is rooted and the person is smiling, "
+    "which together suggest a generally stable presentation with a need for security."
+)
+DRAWING_ID = re.compile(r"Drawing ID: (\S+)")
+
+
+def _texts(body: Dict[str, Any]) -> str:
+    parts = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            parts.append(content)
+        elif isinstance(content, list):
+            parts.extend(item.get("text", "") for item in content if isinstance(item, dict) and item.get("type") == "text")
+    return "\n".join(parts)
+
+
+def mock_completion(body: Dict[str, Any]) -> str:
+    """Answer a chat completions body the way the workflow expects: packed JSON, structured report or free text."""
+    text = _texts(body)
+    ids = DRAWING_ID.findall(text)
+    if ids:
+        return json.dumps({"drawings": [{"id": drawing_id, "analysis": ANALYSIS_TEXT} for drawing_id in ids]})
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return json.dumps({
+            "sections": [{"title": "Overall", "content": ANALYSIS_TEXT}],
+            "summary": "A generally stable presentation.",
+            "risk": {"concerning_content": False, "unable_to_analyze": False, "recommend_professional": False, "indicators": []},
+        })
+    return ANALYSIS_TEXT
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        if not self.path.endswith("/chat/completions"):
+            self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        body = json.loads(data)
+        if self.latency:
+            time.sleep(self.latency)
+        content = mock_completion(body)
+        prompt_tokens = len(data) // 4
+        completion_tokens = len(content) // 4
+        self._send(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        })
+
+    def _send(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def start_mock_server(port: int = 0, latency: float = 0.0, host: str = "127.0.0.1") -> Tuple[ThreadingHTTPServer, str]:
+    """Serve in a daemon thread; returns the server and its base URL (pass it as OPENAI_BASE_URL)."""
+    handler = type("Handler", (MockOpenAIHandler,), {"latency": latency})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/v1"
+
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before answering each request")
+    config = parser.parse_args(argv)
+
+    handler = type("Handler", (MockOpenAIHandler,), {"latency": config.latency})
+    server = ThreadingHTTPServer((config.host, config.port), handler)
+    server.daemon_threads = True
+    print(f"Mock OpenAI server on http://{config.host}:{config.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
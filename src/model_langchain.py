@@ -1,23 +1,40 @@
 import base64
+import json
 import logging
 import os
 import re
+import sys
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Optional, Dict, Tuple
 
-import openai
-# Override any proxy settings that might be configured in the environment or elsewhere
-if hasattr(openai, '_client'):
-    if hasattr(openai._client, 'proxies'):
-        delattr(openai._client, 'proxies')
+# Override any proxy settings if openai has already been imported by the caller.
+# openai itself is not imported here: it is only needed by the langchain_openai fallback.
+_openai = sys.modules.get("openai")
+if _openai is not None and hasattr(_openai, '_client'):
+    if hasattr(_openai._client, 'proxies'):
+        delattr(_openai._client, 'proxies')
 
-from langchain_community.cache import SQLiteCache
-from langchain_community.callbacks import get_openai_callback
-from langchain_core.globals import set_llm_cache
-from langchain_core.prompts import ChatPromptTemplate
+# SQLiteCache, get_openai_callback and ChatPromptTemplate are imported where they are
+# used, so importing this module does not pull in langchain_community.
 from pydantic import BaseModel, Field
 from langchain_core.messages import HumanMessage
 
+try:
+    from src.image_store import get_data_url, get_image_store, image_ref, parse_image_ref, to_data_url
+    from src.token_budget import Reservation, get_token_budget_planner
+    from src.circuit_breaker import CircuitOpenError
+    from src.deadline import WORKFLOW_TIMEOUT, DeadlineExceeded, current_deadline, deadline_scope, submit_with_deadline
+    from src.log_config import log_request
+    from src.tracing import span, trace, trace_summary
+except ImportError:
+    from image_store import get_data_url, get_image_store, image_ref, parse_image_ref, to_data_url
+    from token_budget import Reservation, get_token_budget_planner
+    from circuit_breaker import CircuitOpenError
+    from deadline import WORKFLOW_TIMEOUT, DeadlineExceeded, current_deadline, deadline_scope, submit_with_deadline
+    from log_config import log_request
+    from tracing import span, trace, trace_summary
+
 # Import our custom ChatOpenAI wrapper instead
 try:
     from src.custom_chat_openai import ChatOpenAI
@@ -28,10 +45,9 @@ except ImportError:
     except ImportError:
         # Last resort, use the original (might cause issues)
         from langchain_openai import ChatOpenAI
-        logging.warning("Using original ChatOpenAI, which might cause proxy issues")
+        logging.getLogger(__name__).warning("Using original ChatOpenAI, which might cause proxy issues")
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def is_base64_or_path(input_string):
     # Remove possible prefix (like "data:image/jpeg;base64,")
@@ -54,13 +70,125 @@ def is_base64_or_path(input_string):
     return "unknown"
 
 def encode_image(image_path):
-  with open(image_path, "rb") as image_file:
-    return base64.b64encode(image_file.read()).decode('utf-8')
+    store = get_image_store()
+    digest = store.put_file(image_path)
+    with store.open(digest) as image_data:
+        return base64.b64encode(image_data).decode('utf-8')
+
+def load_image(image_input: str) -> Tuple[str, Optional[str]]:
+    """
+    Resolve an image reference, file path or base64 string to a data URL.
+
+    Returns (data URL, digest). Files are added to the image store so later runs
+    can reference them by digest, and stored images are encoded at most once
+    per process thanks to the shared data-URL cache.
+    """
+    ref = parse_image_ref(image_input)
+    if ref is None and os.path.isfile(image_input):
+        ref = (get_image_store().put_file(image_input), "original")
+    if ref is None:
+        # Assume it's already base64
+        return to_data_url(image_input), None
+
+    digest, profile = ref
+    data_url = get_data_url(digest, profile)
+    logger.debug(f"Image {digest[:12]} ({profile}) ready, data URL length: {len(data_url)}")
+    return data_url, digest
 
 class ClfResult(BaseModel):
     """Classification result."""
     result: bool = Field(description="true or flase, classification result.")
 
+class RiskFlags(BaseModel):
+    """Risk signals of an analysis."""
+    concerning_content: bool = Field(description="true if the drawing shows signs of distress, trauma, self-harm, violence or other serious concerns.")
+    unable_to_analyze: bool = Field(description="true if the drawing could not be seen or analyzed properly.")
+    recommend_professional: bool = Field(description="true if consulting a professional psychologist is strongly recommended.")
+    indicators: List[str] = Field(description="Short phrases naming each concerning indicator observed, empty if none.")
+
+    def merge(self, other: "RiskFlags") -> "RiskFlags":
+        return RiskFlags(
+            concerning_content=self.concerning_content or other.concerning_content,
+            unable_to_analyze=self.unable_to_analyze or other.unable_to_analyze,
+            recommend_professional=self.recommend_professional or other.recommend_professional,
+            indicators=self.indicators + [item for item in other.indicators if item not in self.indicators],
+        )
+
+class ReportSection(BaseModel):
+    """One titled section of a report."""
+    title: str = Field(description="Section heading.")
+    content: str = Field(description="Section text.")
+
+class HTPReport(BaseModel):
+    """Structured analysis report returned in structured output mode."""
+    sections: List[ReportSection] = Field(description="The analysis, one entry per part of the requested structure, in order.")
+    summary: str = Field(description="A short overall summary of the analysis.")
+    risk: RiskFlags
+
+    def to_text(self) -> str:
+        """Render the report as the markdown text the free-text mode would produce."""
+        parts = [f"### {section.title}\n{section.content}" for section in self.sections]
+        parts.append(f"### Summary\n{self.summary}")
+        if self.risk.recommend_professional:
+            parts.append("⚠️ WARNING! Strongly recommend consulting a professional psychologist.")
+        return "\n\n".join(parts)
+
+def strict_json_schema(model) -> Dict:
+    """JSON schema of a pydantic model in the form strict structured outputs require."""
+    schema = model.model_json_schema()
+
+    def visit(node):
+        if isinstance(node, dict):
+            if node.get("type") == "object" and "properties" in node:
+                node["additionalProperties"] = False
+                node["required"] = list(node["properties"])
+            for value in node.values():
+                visit(value)
+        elif isinstance(node, list):
+            for value in node:
+                visit(value)
+
+    visit(schema)
+    return schema
+
+REPORT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "htp_report", "strict": True, "schema": strict_json_schema(HTPReport)},
+}
+
+def parse_report(content: str) -> Optional[HTPReport]:
+    """Validate a structured response, None if it does not match the schema."""
+    try:
+        return HTPReport.model_validate_json(content)
+    except ValueError as e:
+        logger.warning(f"Structured report failed validation: {str(e)[:200]}")
+        return None
+
+# Phrases the free-text reports use to flag that a professional should take over
+LIMITATION_PHRASES = [
+    "unable to properly analyze the image",
+    "unable to analyze the image",
+    "strongly recommend consulting a professional"
+]
+
+def report_text(result: Dict, key: str = "final") -> str:
+    """Report text of a workflow result for display and export."""
+    text = result.get(key, "") or ""
+    if result.get("report"):
+        # Rendered from typed fields, there are no output tags to strip
+        return text
+    for tag in ("<output>", "</output>", "<o>", "</o>"):
+        text = text.replace(tag, "")
+    return text
+
+def needs_professional(result: Dict) -> bool:
+    """Whether a workflow result says the analysis is limited and a professional should be consulted."""
+    risk = result.get("risk")
+    if risk:
+        return risk["unable_to_analyze"] or risk["recommend_professional"]
+    text = (result.get("final", "") or "").lower()
+    return any(phrase in text for phrase in LIMITATION_PHRASES)
+
 FIX_SIGNAL_EN="""### Assessment Opinion:
 Warning
 
@@ -74,13 +202,189 @@ Your well-being is paramount, and a trained expert can provide the support you m
 
 Remember, it's okay to ask for help. You're not alone in this. """
 
+ANALYSIS_PROMPT = """As an HTP test analysis expert, please analyze THIS SPECIFIC House-Tree-Person (HTP) test drawing that has been uploaded.
+
+IMPORTANT: Analyze the actual image you are seeing here. You CAN see the image. DO NOT claim you cannot see or analyze the image. 
+DESCRIBE THE VISUAL DETAILS you actually observe in the drawing before your analysis.
+
+Your analysis should include:
+1. Visual features in the image and their psychological significance (be specific about what you see)
+2. Indicators of emotional state
+3. Assessment of cognitive functioning
+4. Personality traits displayed
+5. Potential psychological needs or concerns
+6. Positive aspects and growth potential
+
+If you detect significant psychological risk signals (such as extreme anxiety, deep depression, or other concerning indicators), clearly add this warning label at the end of your analysis:
+
+"⚠️ WARNING! Strongly recommend consulting a professional psychologist."
+
+Please provide a professional, balanced analysis while avoiding overinterpretation or definitive conclusions. Organize your response in a clear format."""
+
+SINGLE_IMAGE_INSTRUCTIONS = "\n\nIMPORTANT: You MUST analyze the specific image below. You CAN see the image. DO NOT say you cannot analyze images or provide a generic framework. Describe what you actually see in this specific image and analyze it.\n\nStart by clearly describing what you VISUALLY SEE in this specific drawing - mention colors, shapes, objects, and details that are ACTUALLY PRESENT in THIS image."
+
+PACKED_IMAGE_INSTRUCTIONS = """
+
+IMPORTANT: You will receive several drawings from different people. Each drawing is preceded by a line "Drawing ID: <id>".
+Analyze EACH drawing independently and completely, as if it were the only one. Never compare drawings or mix up their details.
+For each drawing, start by clearly describing what you VISUALLY SEE in that specific drawing before your analysis.
+
+Respond with ONLY a JSON object, no other text, in exactly this form:
+{"drawings": [{"id": "<drawing id>", "analysis": "<full analysis of that drawing>"}]}
+Include exactly one entry per drawing ID."""
+
+# Phrases showing the model answered with a generic framework instead of analyzing the image
+GENERIC_PHRASES = [
+    "unable to analyze", "cannot analyze", "general framework", 
+    "i don't see any image", "no image provided", "cannot see", 
+    "i cannot see", "not able to see", "i can't see",
+    "i am unable to", "not able to analyze", "i can't analyze",
+    "refusal", "refuse to analyze", "declined to analyze",
+    "won't analyze", "will not analyze"
+]
+
+# Phrases in the initial analysis that make the second stage suggest follow-up support
+CONCERN_PHRASES = [
+    "i can't analyze", "unable to analyze", "cannot analyze",
+    "suicide", "self-harm", "harm to others", "violence", 
+    "extreme depression", "severe anxiety", "dark thoughts",
+    "traumatic", "trauma", "abuse", "neglect", "crisis",
+    "dangerous", "risk", "threat", "emergency", 
+    "i don't see any image", "no image provided", "cannot see", 
+    "i cannot see", "not able to see", "i can't see",
+    "i am unable to", "not able to analyze", "i can't analyze",
+    "refusal", "refuse to analyze", "declined to analyze",
+    "won't analyze", "will not analyze"
+]
+
+DEEPER_PROMPT = """As a school psychologist who evaluates regular school kids, provide a gentle and supportive interpretation that builds upon the initial HTP test analysis provided below.
+
+Your response should complement and extend the initial analysis, maintaining a consistent perspective while adding helpful educational insights.
+
+Focus on these supportive perspectives:
+
+1. School adjustment: Gently explore how the elements in the drawing might reflect the child's school experiences
+2. Developmental context: Highlight age-appropriate aspects of the drawing in a positive, growth-oriented way
+3. Social strengths: Identify potential social skills and positive interaction patterns suggested by the drawing
+4. Learning style: Consider how the drawing might reflect the child's unique approach to learning
+5. Strengths and resources: Emphasize positive aspects and potential areas where the child shows capability
+6. Supportive suggestions: If appropriate, offer gentle, encouraging recommendations to support the child's development
+
+Your analysis should maintain a supportive, balanced tone that acknowledges both strengths and areas for growth. Avoid speculative interpretations that aren't grounded in the initial analysis.
+Begin your response with the heading "EDUCATIONAL PERSPECTIVE".
+
+"""
+
+CONCERN_NOTE = """Note: The initial analysis identified some areas of potential concern. 
+
+While maintaining a balanced perspective, please acknowledge these areas sensitively and suggest appropriate school-based support that might benefit the child. Consider adding a gentle recommendation:
+
+"Recommendation: Consider a follow-up conversation with the school counselor to explore additional ways to support this student's emotional well-being and educational experience."
+
+Focus on strengths-based approaches while acknowledging areas where support might be beneficial.
+
+"""
+
+GENERIC_WARNING = """⚠️ IMPORTANT WARNING ⚠️
+
+The initial analysis was unable to properly analyze the image. This may be due to image quality issues or technical limitations.
+
+Please include this warning at the beginning of your response:
+
+"⚠️ WARNING: UNABLE TO PROPERLY ANALYZE THE IMAGE. STRONGLY RECOMMEND CONSULTING A PROFESSIONAL PSYCHOLOGIST. This system was unable to analyze the image clearly, which may indicate technical issues or complex elements that require professional evaluation."
+
+Focus on explaining the limitations of automated analysis and emphasize the importance of professional consultation for proper assessment.
+
+"""
+
+REFUSAL_NOTE = "⚠️ NOTE: The initial analysis detected potential refusal or inability to analyze the image. This may indicate problematic image content or technical limitations. Please verify the uploaded image is clearly visible and consider retrying or consulting a professional.\n\n"
+
+TIMEOUT_NOTE = "The analysis did not finish within its time limit. Please retry later or allow more time."
+PARTIAL_NOTE = "⚠️ NOTE: The deeper analysis did not finish within the time limit, only the initial analysis is available."
+
+STRUCTURED_INSTRUCTIONS = """
+
+Return your response as JSON matching the provided schema: put each part of your response in its own entry of "sections" (with its heading as the title), a short overall summary in "summary", and set the "risk" flags to match your assessment instead of writing warning labels into the text."""
+
+# Structured output is opt-in; callers can also choose per workflow() call
+STRUCTURED_OUTPUT = os.getenv("PSYDRAW_STRUCTURED_OUTPUT", "").lower() in ("1", "true", "yes")
+
+# Drawings packed into one multimodal request by HTPModel.pack_workflow
+PACK_SIZE = int(os.getenv("PSYDRAW_PACK_SIZE", "4"))
+# Packed analyses shorter than this are treated as truncated and re-run on their own
+MIN_PACKED_ANALYSIS_CHARS = 200
+
+def is_generic_response(text: str) -> bool:
+    lowered = text.lower()
+    return any(phrase in lowered for phrase in GENERIC_PHRASES)
+
+def assemble_prompt(static_prefix: str, *variable_sections: str) -> str:
+    """
+    Join a prompt with its static prefix first and every per-request section after it.
+
+    Provider prompt caching matches on the longest shared prefix, so the prefix
+    must be byte-identical across requests: a conditional note or input placed
+    before a static block makes every request a cache miss.
+    """
+    return static_prefix + "".join(section for section in variable_sections if section)
+
+def message_usage(message) -> Dict[str, int]:
+    """Token usage reported with a model response, including prompt tokens served from the provider cache."""
+    token_usage = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+    return {
+        "total": token_usage.get("total_tokens", 0),
+        "prompt": token_usage.get("prompt_tokens", 0),
+        "completion": token_usage.get("completion_tokens", 0),
+        "cached": (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+    }
+
+def add_usage(target: Dict[str, int], usage: Dict[str, int]) -> None:
+    for key, value in usage.items():
+        target[key] = target.get(key, 0) + value
+
+def parse_packed_response(text: str, ids: List[str]) -> Dict[str, str]:
+    """
+    Split a packed multimodal response into {drawing id: analysis}.
+
+    Every {"id": ..., "analysis": ...} object is decoded on its own, so entries
+    that survived a truncated or fenced response are still recovered. Unknown
+    ids, duplicates, empty, too short and generic analyses are left out and
+    the caller re-runs those drawings individually.
+    """
+    decoder = json.JSONDecoder()
+    expected = set(ids)
+    analyses = {}
+    for match in re.finditer(r'\{\s*"id"\s*:', text):
+        try:
+            item, _ = decoder.raw_decode(text, match.start())
+        except ValueError:
+            continue
+        item_id = str(item.get("id", "")).strip()
+        analysis = item.get("analysis")
+        if item_id not in expected or item_id in analyses or not isinstance(analysis, str):
+            continue
+        analysis = analysis.strip()
+        if len(analysis) < MIN_PACKED_ANALYSIS_CHARS or is_generic_response(analysis):
+            logger.warning(f"Packed analysis for drawing {item_id} failed validation")
+            continue
+        analyses[item_id] = analysis
+    return analyses
+
+
 class HTPModel:
-    def __init__(self, text_model, multimodal_model, language="en", use_cache=False):
+    def __init__(self, text_model, multimodal_model, language="en", use_cache=False, structured_output=STRUCTURED_OUTPUT):
         self.text_model = text_model
         self.multimodal_model = multimodal_model
+        self.structured_output = structured_output
+        # Shared by every model in the process so output-length statistics accumulate
+        self.budget = get_token_budget_planner()
         self.language = "en"  # Always set to English
         self.use_cache = use_cache
-        self.cache = SQLiteCache("cache.db") if use_cache else None
+        if use_cache:
+            from langchain_community.cache import SQLiteCache
+            self.cache = SQLiteCache("cache.db")
+        else:
+            self.cache = None
         
         # Initialize usage attribute
         self.usage = {
@@ -110,7 +414,7 @@ Provide a detailed, objective analysis of what you observe.""",
 Provide a balanced, professional analysis."""
         }
         
-        logging.info(f"Initialized HTPModel with language: en, use_cache: {use_cache}")
+        logger.info(f"Initialized HTPModel with language: en, use_cache: {use_cache}")
 
     def basic_analysis(self, image_path):
         """Perform basic analysis on the image."""
@@ -119,21 +423,17 @@ Provide a balanced, professional analysis."""
                 raise ValueError("No image provided")
             
             # Encode image
-            if os.path.isfile(image_path):
-                with open(image_path, "rb") as f:
-                    image_data = f.read()
-                image_b64 = base64.b64encode(image_data).decode()
-            else:
-                image_b64 = image_path  # Assume it's already base64
+            data_url, _ = load_image(image_path)
             
             # Get prompts for current language
             prompts = self.prompts
             
             # Format image URL correctly for GPT-4o
-            image_url = {"url": f"data:image/jpeg;base64,{image_b64}"}
+            image_url = {"url": data_url}
             
             # Get feature results using multimodal model
-            feature_result = self.multimodal_model.invoke(
+            feature_result = self._invoke(
+                "multimodal", self.multimodal_model,
                 [
                     HumanMessage(content=[
                         {"type": "text", "text": prompts["feature"]},
@@ -143,7 +443,8 @@ Provide a balanced, professional analysis."""
             )
             
             # Get analysis results using text model
-            analysis_result = self.text_model.invoke(
+            analysis_result = self._invoke(
+                "text", self.text_model,
                 [
                     HumanMessage(content=f"{prompts['analysis']}\n\nFeatures identified:\n{feature_result.content}")
                 ]
@@ -152,7 +453,7 @@ Provide a balanced, professional analysis."""
             return feature_result.content, analysis_result.content
             
         except Exception as e:
-            logging.error(f"Error in basic_analysis: {str(e)}")
+            logger.error(f"Error in basic_analysis: {str(e)}")
             raise
     
     def refresh_usage(self):
@@ -189,6 +490,8 @@ Provide a balanced, professional analysis."""
         return feature_prompt, analysis_prompt
     
     def merge_analysis(self, results: dict):
+        from langchain_core.prompts import ChatPromptTemplate
+
         logger.info("merge analysis started.")
         merge_prompt = open(f"src/prompt/en/analysis_merge.txt", "r", encoding="utf-8").read()
         merge_inputs = open(f"src/prompt/en/merge_format.txt", "r", encoding="utf-8").read()
@@ -202,21 +505,20 @@ Provide a balanced, professional analysis."""
                 ]
             )]
         )
-        with get_openai_callback() as cb:
-            chain = prompt | self.text_model
-            result = chain.invoke({
-                "overall_analysis": results["overall"]["analysis"],
-                "house_analysis": results["house"]["analysis"],
-                "tree_analysis": results["tree"]["analysis"],
-                "person_analysis": results["person"]["analysis"]
-            }).content
-
-            self.update_usage(cb)
+        messages = prompt.format_messages(
+            overall_analysis=results["overall"]["analysis"],
+            house_analysis=results["house"]["analysis"],
+            tree_analysis=results["tree"]["analysis"],
+            person_analysis=results["person"]["analysis"]
+        )
+        result = self._invoke("merge", self.text_model, messages).content
         
         logger.info("merge analysis completed.")
         return result
     
     def final_analysis(self, results: dict):
+        from langchain_core.prompts import ChatPromptTemplate
+
         logger.info("final analysis started.")
         final_prompt = open(f"src/prompt/en/final_result.txt", "r", encoding="utf-8").read()
         
@@ -227,18 +529,15 @@ Provide a balanced, professional analysis."""
             ("user", inputs)
         ])
         
-        with get_openai_callback() as cb:
-            chain = prompt | self.text_model
-            result = chain.invoke({
-                "merge_result": results["merge"]
-            }).content
-
-            self.update_usage(cb)
+        messages = prompt.format_messages(merge_result=results["merge"])
+        result = self._invoke("final", self.text_model, messages).content
         
         logger.info("final analysis completed.")
         return result
     
     def signal_analysis(self, results: dict):
+        from langchain_core.prompts import ChatPromptTemplate
+
         logger.info("signal analysis started.")
         signal_prompt = open(f"src/prompt/en/signal_judge.txt", "r", encoding="utf-8").read()
         inputs = "{final_result}"
@@ -248,13 +547,8 @@ Provide a balanced, professional analysis."""
             ("user", inputs)
         ])
         
-        with get_openai_callback() as cb:
-            chain = prompt | self.text_model
-            result = chain.invoke({
-                "final_result": results["final"]
-            }).content
-
-            self.update_usage(cb)
+        messages = prompt.format_messages(final_result=results["final"])
+        result = self._invoke("signal", self.text_model, messages).content
         
         logger.info("signal analysis completed.")
         return result
@@ -265,12 +559,9 @@ Provide a balanced, professional analysis."""
         logger.info("Classification bypassed, returning True to prevent warnings")
         return True
     
-    def workflow(self, image_path: str, language: str = "en") -> Dict:
-        """Run a simplified HTP analysis workflow using direct GPT-4o analysis."""
-        logger.info(f"Starting simplified workflow with language: en")
-        
-        # Initialize results structure
-        results = {
+    @staticmethod
+    def _new_results() -> Dict:
+        return {
             "overall": {"feature": "", "analysis": ""},
             "house": {"feature": "", "analysis": ""},
             "tree": {"feature": "", "analysis": ""},
@@ -280,228 +571,447 @@ Provide a balanced, professional analysis."""
             "signal": "",
             "classification": True,
             "fix_signal": None,
-            "usage": {"total": 0, "prompt": 0, "completion": 0}
+            "status": "ok",
+            "usage": {"total": 0, "prompt": 0, "completion": 0, "cached": 0}
         }
+
+    @staticmethod
+    def _fill_results(results: Dict, initial_analysis: str, deeper_text: str) -> None:
+        # Store the analysis in all result fields for compatibility with frontend
+        results["overall"]["feature"] = "Initial HTP Drawing Analysis"
+        results["overall"]["analysis"] = initial_analysis
+        results["house"]["feature"] = "See full report for details"
+        results["house"]["analysis"] = "See full report for details"
+        results["tree"]["feature"] = "See full report for details" 
+        results["tree"]["analysis"] = "See full report for details"
+        results["person"]["feature"] = "See full report for details"
+        results["person"]["analysis"] = "See full report for details"
+        results["merge"] = initial_analysis
+        results["final"] = deeper_text
+        results["signal"] = deeper_text
+
+    @classmethod
+    def _fill_partial(cls, results: Dict, initial_analysis: str, note: str = PARTIAL_NOTE) -> None:
+        """Keep the first stage's analysis when the second stage could not finish."""
+        cls._fill_results(results, initial_analysis, note)
+        results["status"] = "partial"
+
+    @staticmethod
+    def _fill_error(results: Dict, error_msg: str, status: str = "error") -> None:
+        results["status"] = status
+        for section in ("overall", "house", "tree", "person"):
+            results[section]["feature"] = error_msg
+            results[section]["analysis"] = error_msg
+        results["merge"] = error_msg
+        results["final"] = error_msg
+        results["signal"] = error_msg
+
+    @classmethod
+    def _fill_exception(cls, results: Dict, error: Exception, initial_analysis: Optional[str] = None) -> None:
+        """
+        Fill results for a failed stage; an open circuit breaker marks them
+        unavailable instead of failed. An expired deadline keeps initial_analysis
+        as a partial result when the first stage had finished.
+        """
+        if isinstance(error, DeadlineExceeded):
+            logger.warning(f"Analysis stopped: {error}")
+            if initial_analysis:
+                cls._fill_partial(results, initial_analysis)
+            else:
+                cls._fill_error(results, TIMEOUT_NOTE, status="timeout")
+        elif isinstance(error, CircuitOpenError):
+            logger.warning(f"Skipping analysis: {error}")
+            cls._fill_error(results, f"Analysis unavailable: {error}", status="unavailable")
+            results["retry_after"] = error.retry_after
+        else:
+            logger.error(f"Error in GPT-4o analysis: {str(error)}", exc_info=True)
+            cls._fill_error(results, f"Analysis error: {str(error)}")
+
+    def multimodal_messages(self, data_url: str, structured: bool = False) -> List[HumanMessage]:
+        """Messages of the first stage for one drawing."""
+        instructions = ANALYSIS_PROMPT + SINGLE_IMAGE_INSTRUCTIONS + (STRUCTURED_INSTRUCTIONS if structured else "")
+        return [
+            HumanMessage(content=[
+                {"type": "text", "text": instructions},
+                {"type": "image_url", "image_url": {"url": data_url}}
+            ])
+        ]
+
+    def text_messages(self, initial_analysis: str, risk: Optional[RiskFlags] = None, structured: bool = False) -> List[HumanMessage]:
+        """
+        Messages of the second stage for one initial analysis.
+
+        DEEPER_PROMPT is sent unchanged as the prefix of every request so the
+        provider can cache it; the initial analysis and the notes that depend
+        on it come after. With the risk flags of a structured first stage the
+        notes are chosen from those fields instead of scanning the text.
+        """
+        if risk is not None:
+            generic_response = risk.unable_to_analyze
+            concerning_content = risk.concerning_content
+        else:
+            generic_response = is_generic_response(initial_analysis)
+            lowered = initial_analysis.lower()
+            concerning_content = any(phrase in lowered for phrase in CONCERN_PHRASES)
+
+        notes = ""
+        # Add warning text for concerning content
+        if concerning_content:
+            notes += CONCERN_NOTE
+        # Add specific warning and refusal note if initial analysis couldn't properly analyze the image
+        if generic_response:
+            notes += GENERIC_WARNING
+            notes += REFUSAL_NOTE
+        prompt = assemble_prompt(
+            DEEPER_PROMPT + (STRUCTURED_INSTRUCTIONS.strip() + "\n\n" if structured else ""),
+            f"Initial analysis:\n{initial_analysis}",
+            f"\n\n{notes}" if notes else "",
+        )
+        return [HumanMessage(content=prompt)]
+
+    @classmethod
+    def make_results(
+        cls,
+        initial_analysis: Optional[str] = None,
+        deeper_text: Optional[str] = None,
+        error: Optional[str] = None,
+        digest: Optional[str] = None,
+        usage: Optional[Dict[str, int]] = None,
+        status: Optional[str] = None,
+    ) -> Dict:
+        """
+        Build a workflow() shaped result from stage outputs produced elsewhere, e.g. by a batch job.
+
+        status "partial" keeps initial_analysis without a deeper analysis and
+        "timeout" marks a drawing that was cut off before its first stage.
+        """
+        results = cls._new_results()
+        if digest:
+            results["image_ref"] = image_ref(digest)
+        if status == "partial":
+            cls._fill_partial(results, initial_analysis, error or PARTIAL_NOTE)
+        elif status == "timeout":
+            cls._fill_error(results, error or TIMEOUT_NOTE, status)
+        elif error is not None:
+            cls._fill_error(results, error, status or "error")
+        else:
+            cls._fill_results(results, initial_analysis, deeper_text)
+        if usage:
+            results["usage"].update(usage)
+        return results
+
+    def _invoke(self, stage: str, chat_model, messages: List, usage: Optional[Dict[str, int]] = None, items: int = 1, **kwargs):
+        """
+        Call chat_model with the planned max_tokens of stage and record the output length.
+
+        A response cut off by a tight budget is retried once with the stage
+        ceiling, so learning the budget never costs a complete report.
+        """
+        with span(stage, items=items) as stage_span, self.budget.reserve(stage, messages, items) as reservation:
+            response = self._call(stage, chat_model, messages, reservation.max_tokens, **kwargs)
+            self._record(stage, response, reservation.max_tokens, items, usage)
+            ceiling = self.budget.ceiling(items)
+            retries = 0
+            if self._truncated(response) and reservation.max_tokens < ceiling:
+                logger.warning(f"{stage} response truncated at {reservation.max_tokens} tokens, retrying with {ceiling}")
+                response = self._call(stage, chat_model, messages, ceiling, **kwargs)
+                self._record(stage, response, ceiling, items, usage)
+                retries = 1
+            if stage_span:
+                stage_span.set(
+                    input_tokens=reservation.input_tokens,
+                    max_tokens=reservation.max_tokens,
+                    completion_tokens=message_usage(response)["completion"],
+                    retries=retries,
+                )
+        return response
+
+    @staticmethod
+    def _call(stage: str, chat_model, messages: List, max_tokens: int, **kwargs):
+        """
+        One chat_model call under the current deadline. Clients that do not
+        time out their own requests are still cut off at the call's end: a
+        response arriving after the deadline raises DeadlineExceeded.
+        """
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check(f"the {stage} stage")
+        response = chat_model.invoke(messages, max_tokens=max_tokens, **kwargs)
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceeded(f"Deadline of {deadline.seconds:g}s exceeded waiting for the {stage} stage")
+        return response
+
+    @staticmethod
+    def _truncated(response) -> bool:
+        return (getattr(response, "response_metadata", None) or {}).get("finish_reason") == "length"
+
+    def _record(self, stage: str, response, max_tokens: int, items: int, usage: Optional[Dict[str, int]]) -> None:
+        response_usage = message_usage(response)
+        if usage is not None:
+            add_usage(usage, response_usage)
+        add_usage(self.usage, {key: response_usage[key] for key in ("total", "prompt", "completion")})
+        self.budget.observe(stage, response_usage["completion"], self._truncated(response), max_tokens, items)
+
+    def multimodal_stage(self, data_url: str, usage: Optional[Dict[str, int]] = None) -> str:
+        """First stage: analyze one drawing with the multimodal model. Token usage is added to usage."""
+        logger.debug("Sending multimodal message with text and image to GPT-4o")
+        analysis_result = self._invoke("multimodal", self.multimodal_model, self.multimodal_messages(data_url), usage)
+        analysis_text = analysis_result.content if hasattr(analysis_result, 'content') else str(analysis_result)
+        if is_generic_response(analysis_text):
+            logger.warning("GPT-4o returned a generic framework response instead of analyzing the specific image")
+        return analysis_text
+
+    def packed_multimodal_stage(self, drawings: List[Tuple[str, str]], usage: Optional[Dict[str, int]] = None) -> Dict[str, str]:
+        """
+        First stage for several drawings in one multimodal request.
+
+        drawings is a list of (drawing id, data URL). The analysis prompt is sent
+        once for the whole pack and the model answers with one JSON entry per id.
+        Returns the analyses that passed validation, keyed by id.
+        """
+        content = [{"type": "text", "text": ANALYSIS_PROMPT + PACKED_IMAGE_INSTRUCTIONS}]
+        for drawing_id, data_url in drawings:
+            content.append({"type": "text", "text": f"Drawing ID: {drawing_id}"})
+            content.append({"type": "image_url", "image_url": {"url": data_url}})
+        logger.debug(f"Sending packed multimodal message with {len(drawings)} drawings")
+        response = self._invoke("multimodal", self.multimodal_model, [HumanMessage(content=content)], usage, items=len(drawings))
+        text = response.content if hasattr(response, 'content') else str(response)
+        return parse_packed_response(text, [drawing_id for drawing_id, _ in drawings])
+
+    def structured_stage(
+        self,
+        stage: str,
+        chat_model,
+        messages: List[HumanMessage],
+        usage: Optional[Dict[str, int]] = None,
+    ) -> Tuple[str, Optional[HTPReport]]:
+        """
+        Run one stage in structured output mode.
+
+        Returns (report text, report). A response that does not validate
+        against HTPReport is kept as free text with report None, so the caller
+        falls back to the text-scanning path.
+        """
+        response = self._invoke(stage, chat_model, messages, usage, response_format=REPORT_RESPONSE_FORMAT)
+        content = response.content if hasattr(response, 'content') else str(response)
+        report = parse_report(content)
+        if report is None:
+            return content, None
+        return report.to_text(), report
+
+    def text_stage(self, initial_analysis: str, usage: Optional[Dict[str, int]] = None) -> str:
+        """Second stage: educational interpretation of the initial analysis with the text model."""
+        deeper_analysis = self._invoke("text", self.text_model, self.text_messages(initial_analysis), usage)
+        return deeper_analysis.content if hasattr(deeper_analysis, 'content') else str(deeper_analysis)
+
+    def plan_workflow(self, data_url: str, structured: Optional[bool] = None) -> List[Reservation]:
+        """
+        Token reservations a workflow() call for this drawing will make, for
+        schedulers that admit work against a tokens-per-minute budget.
+        """
+        structured = self.structured_output if structured is None else structured
+        prefix = "structured_" if structured else ""
+        first = self.budget.plan(prefix + "multimodal", self.multimodal_messages(data_url, structured))
+        # The second stage's input is the first stage's output, at most its max_tokens
+        second = self.budget.plan(prefix + "text", self.text_messages("", structured=structured))
+        second.input_tokens += first.max_tokens
+        return [first, second]
+
+    def workflow(self, image_path: str, language: str = "en", structured: Optional[bool] = None, timeout: Optional[float] = None) -> Dict:
+        """
+        Run a simplified HTP analysis workflow using direct GPT-4o analysis.
+
+        With structured output (structured, or the model default when None)
+        both stages answer with an HTPReport; the result then also carries
+        "report" (both reports as dicts) and "risk" (their merged risk flags).
+        results["status"] is "ok", "error", or "unavailable" when the upstream's
+        circuit breaker is open (with "retry_after" in seconds).
+
+        timeout (default WORKFLOW_TIMEOUT) is the time budget of the whole
+        workflow in seconds; each request's timeouts come from what is left of
+        it. When it runs out the status is "partial" if the first stage
+        finished (its analysis is kept) and "timeout" otherwise.
+
+        results["trace"] holds the time spent per span (image loading, stages,
+        serialization, HTTP calls, parsing); the full spans are exported when
+        PSYDRAW_TRACE_FILE is set.
+        """
+        structured = self.structured_output if structured is None else structured
+        with trace("workflow", structured=structured) as root:
+            results = self._workflow(image_path, structured, timeout)
+            root.set(status=results["status"], image_ref=results.get("image_ref"))
+        results["trace"] = trace_summary(root)
+        return results
+
+    def _workflow(self, image_path: str, structured: bool, timeout: Optional[float]) -> Dict:
+        started = time.perf_counter()
+        
+        results = self._new_results()
         
         try:
-            # Load and validate the image
-            if os.path.isfile(image_path):
-                with open(image_path, "rb") as f:
-                    image_data = f.read()
-                image_b64 = base64.b64encode(image_data).decode()
-                logger.info(f"Image loaded from file: {image_path}, size: {len(image_data)} bytes")
-            else:
-                logger.info("Using provided base64 image data")
-                image_b64 = image_path  # Assume it's already base64
-            
-            # Try to detect the image type
-            mime_type = "image/jpeg"  # Default
-            if isinstance(image_path, str):
-                if image_path.lower().endswith('.png'):
-                    mime_type = "image/png"
-                elif image_path.lower().endswith('.gif'):
-                    mime_type = "image/gif"
-            
-            logger.info(f"Using MIME type: {mime_type}")
-            image_url = {
-                "url": f"data:{mime_type};base64,{image_b64}"
-            }
-            
-            prompt = """As an HTP test analysis expert, please analyze THIS SPECIFIC House-Tree-Person (HTP) test drawing that has been uploaded.
-
-IMPORTANT: Analyze the actual image you are seeing here. You CAN see the image. DO NOT claim you cannot see or analyze the image. 
-DESCRIBE THE VISUAL DETAILS you actually observe in the drawing before your analysis.
-
-Your analysis should include:
-1. Visual features in the image and their psychological significance (be specific about what you see)
-2. Indicators of emotional state
-3. Assessment of cognitive functioning
-4. Personality traits displayed
-5. Potential psychological needs or concerns
-6. Positive aspects and growth potential
-
-If you detect significant psychological risk signals (such as extreme anxiety, deep depression, or other concerning indicators), clearly add this warning label at the end of your analysis:
-
-"⚠️ WARNING! Strongly recommend consulting a professional psychologist."
-
-Please provide a professional, balanced analysis while avoiding overinterpretation or definitive conclusions. Organize your response in a clear format."""
+            # Load and validate the image (file path, store reference or base64)
+            with span("load_image") as load_span:
+                data_url, digest = load_image(image_path)
+                if load_span:
+                    load_span.set(bytes=len(data_url))
+            if digest:
+                results["image_ref"] = image_ref(digest)
+        except Exception as e:
+            logger.error(f"Error running simplified HTP analysis: {str(e)}", exc_info=True)
+            self._fill_error(results, "Due to some system failure, the image can't be analysed...")
+            self._log_summary("workflow", [results], started, structured=structured)
+            return results
 
-            # Direct analysis using multimodal model
-            logger.info("Performing direct GPT-4o analysis")
-            try:
-                # Create a very explicit prompt message
-                prompt_message = [
-                    {
-                        "type": "text", 
-                        "text": prompt + "\n\nIMPORTANT: You MUST analyze the specific image below. You CAN see the image. DO NOT say you cannot analyze images or provide a generic framework. Describe what you actually see in this specific image and analyze it.\n\nStart by clearly describing what you VISUALLY SEE in this specific drawing - mention colors, shapes, objects, and details that are ACTUALLY PRESENT in THIS image."
-                    },
-                    {
-                        "type": "image_url", 
-                        "image_url": image_url
-                    }
-                ]
-                
-                logger.info("Sending multimodal message with text and image to GPT-4o")
-                
-                # Call the model
-                analysis_result = self.multimodal_model.invoke(
-                    [
-                        HumanMessage(content=prompt_message)
-                    ]
-                )
-                
-                if hasattr(analysis_result, 'content'):
-                    analysis_text = analysis_result.content
+        try:
+            with deadline_scope(WORKFLOW_TIMEOUT if timeout is None else timeout):
+                if structured:
+                    self._structured_workflow(data_url, results)
                 else:
-                    analysis_text = str(analysis_result)
-                
-                # Check if the response contains generic framework text
-                generic_response = any(phrase in analysis_text.lower() for phrase in [
-                    "unable to analyze", "cannot analyze", "general framework", 
-                    "i don't see any image", "no image provided", "cannot see", 
-                    "i cannot see", "not able to see", "i can't see",
-                    "i am unable to", "not able to analyze", "i can't analyze",
-                    "refusal", "refuse to analyze", "declined to analyze",
-                    "won't analyze", "will not analyze"
-                ])
-                
-                # If it's a generic response, try one more time with an even more explicit prompt
-                if generic_response:
-                    logger.warning("GPT-4o returned a generic framework response instead of analyzing the specific image")
-                
-                # Store the initial analysis results
-                initial_analysis = analysis_text
-                
-                # Check for concerning content in the initial analysis
-                concerning_content = any(phrase in initial_analysis.lower() for phrase in [
-                    "i can't analyze", "unable to analyze", "cannot analyze",
-                    "suicide", "self-harm", "harm to others", "violence", 
-                    "extreme depression", "severe anxiety", "dark thoughts",
-                    "traumatic", "trauma", "abuse", "neglect", "crisis",
-                    "dangerous", "risk", "threat", "emergency", 
-                    "i don't see any image", "no image provided", "cannot see", 
-                    "i cannot see", "not able to see", "i can't see",
-                    "i am unable to", "not able to analyze", "i can't analyze",
-                    "refusal", "refuse to analyze", "declined to analyze",
-                    "won't analyze", "will not analyze"
-                ])
-                
-                # If the AI refused to analyze, add a specific note about refusal
-                refusal_detected = generic_response
-                refusal_note = ""
-                if refusal_detected:
-                    refusal_note = "⚠️ NOTE: The initial analysis detected potential refusal or inability to analyze the image. This may indicate problematic image content or technical limitations. Please verify the uploaded image is clearly visible and consider retrying or consulting a professional.\n\n"
-                
-                # Perform deeper psychological analysis as a second stage
-                logger.info("Performing deeper psychological analysis on initial results")
-                
-                deeper_prompt = """As a school psychologist who evaluates regular school kids, provide a gentle and supportive interpretation that builds upon the initial HTP test analysis provided below.
-
-Your response should complement and extend the initial analysis, maintaining a consistent perspective while adding helpful educational insights.
-
-Focus on these supportive perspectives:
-
-1. School adjustment: Gently explore how the elements in the drawing might reflect the child's school experiences
-2. Developmental context: Highlight age-appropriate aspects of the drawing in a positive, growth-oriented way
-3. Social strengths: Identify potential social skills and positive interaction patterns suggested by the drawing
-4. Learning style: Consider how the drawing might reflect the child's unique approach to learning
-5. Strengths and resources: Emphasize positive aspects and potential areas where the child shows capability
-6. Supportive suggestions: If appropriate, offer gentle, encouraging recommendations to support the child's development
-
-Your analysis should maintain a supportive, balanced tone that acknowledges both strengths and areas for growth. Avoid speculative interpretations that aren't grounded in the initial analysis.
-Begin your response with the heading "EDUCATIONAL PERSPECTIVE".
-
-"""
-                # Add warning text for concerning content
-                if concerning_content:
-                    deeper_prompt += """Note: The initial analysis identified some areas of potential concern. 
-
-While maintaining a balanced perspective, please acknowledge these areas sensitively and suggest appropriate school-based support that might benefit the child. Consider adding a gentle recommendation:
-
-"Recommendation: Consider a follow-up conversation with the school counselor to explore additional ways to support this student's emotional well-being and educational experience."
-
-Focus on strengths-based approaches while acknowledging areas where support might be beneficial.
-
-"""
-                # Add specific warning if initial analysis couldn't properly analyze the image
-                if generic_response:
-                    deeper_prompt += """⚠️ IMPORTANT WARNING ⚠️
-
-The initial analysis was unable to properly analyze the image. This may be due to image quality issues or technical limitations.
-
-Please include this warning at the beginning of your response:
-
-"⚠️ WARNING: UNABLE TO PROPERLY ANALYZE THE IMAGE. STRONGLY RECOMMEND CONSULTING A PROFESSIONAL PSYCHOLOGIST. This system was unable to analyze the image clearly, which may indicate technical issues or complex elements that require professional evaluation."
-
-Focus on explaining the limitations of automated analysis and emphasize the importance of professional consultation for proper assessment.
+                    logger.debug("Performing direct GPT-4o analysis")
+                    initial_analysis = self.multimodal_stage(data_url, results["usage"])
+                    results["merge"] = initial_analysis
+                    
+                    logger.debug("Performing deeper psychological analysis on initial results")
+                    deeper_text = self.text_stage(initial_analysis, results["usage"])
+                    logger.debug("Deeper psychological analysis completed")
+                    
+                    self._fill_results(results, initial_analysis, deeper_text)
+        except Exception as e:
+            # A failed first stage skips the text stage that depends on it
+            self._fill_exception(results, e, results["merge"])
+        
+        self._log_summary("workflow", [results], started, structured=structured, image_bytes=len(data_url))
+        return results
+
+    @staticmethod
+    def _log_summary(event: str, all_results: List[Dict], started: float, **fields) -> None:
+        """One summary record per workflow call: status, timing and token totals."""
+        statuses = [results["status"] for results in all_results]
+        log_request(
+            logger, event,
+            logging.INFO if all(status == "ok" for status in statuses) else logging.WARNING,
+            status=statuses[0] if len(statuses) == 1 else ",".join(f"{statuses.count(s)}x{s}" for s in sorted(set(statuses))),
+            duration_ms=round((time.perf_counter() - started) * 1000, 1),
+            prompt_tokens=sum(results["usage"]["prompt"] for results in all_results),
+            cached_tokens=sum(results["usage"].get("cached", 0) for results in all_results),
+            completion_tokens=sum(results["usage"]["completion"] for results in all_results),
+            **fields,
+        )
 
-"""
-                # Add refusal note if detected
-                if refusal_detected:
-                    deeper_prompt += refusal_note
-                
-                deeper_prompt += "Initial analysis:\n{initial_analysis}"
-                
-                # Get deeper analysis using text model
-                deeper_analysis = self.text_model.invoke(
-                    [
-                        HumanMessage(content=deeper_prompt.format(initial_analysis=initial_analysis))
-                    ]
-                )
-                
-                if hasattr(deeper_analysis, 'content'):
-                    deeper_text = deeper_analysis.content
-                else:
-                    deeper_text = str(deeper_analysis)
-                
-                logger.info("Deeper psychological analysis completed")
-                
-                # Store the analysis in all result fields for compatibility with frontend
-                results["overall"]["feature"] = "Initial HTP Drawing Analysis"
-                results["overall"]["analysis"] = initial_analysis
-                results["house"]["feature"] = "See full report for details"
-                results["house"]["analysis"] = "See full report for details"
-                results["tree"]["feature"] = "See full report for details" 
-                results["tree"]["analysis"] = "See full report for details"
-                results["person"]["feature"] = "See full report for details"
-                results["person"]["analysis"] = "See full report for details"
-                results["merge"] = initial_analysis
-                results["final"] = deeper_text
-                results["signal"] = deeper_text
-                
-                logger.info("Two-stage GPT-4o analysis completed successfully")
+    def _structured_workflow(self, data_url: str, results: Dict) -> None:
+        logger.debug("Performing structured GPT-4o analysis")
+        initial_analysis, initial_report = self.structured_stage(
+            "structured_multimodal", self.multimodal_model, self.multimodal_messages(data_url, structured=True), results["usage"]
+        )
+        results["merge"] = initial_analysis
+        risk = initial_report.risk if initial_report else None
+        logger.debug("Performing structured deeper analysis on initial results")
+        deeper_text, final_report = self.structured_stage(
+            "structured_text", self.text_model, self.text_messages(initial_analysis, risk=risk, structured=True), results["usage"]
+        )
+        self._fill_results(results, initial_analysis, deeper_text)
+        if initial_report and final_report:
+            results["report"] = {"initial": initial_report.model_dump(), "final": final_report.model_dump()}
+            results["risk"] = initial_report.risk.merge(final_report.risk).model_dump()
+        else:
+            logger.warning("Structured output unavailable, returning the free-text reports")
+
+    def pack_workflow(
+        self,
+        image_paths: List[str],
+        language: str = "en",
+        pack_size: int = PACK_SIZE,
+        timeout: Optional[float] = None,
+    ) -> List[Dict]:
+        """
+        Run the workflow for several drawings, packing up to pack_size of them
+        into each multimodal request.
+
+        The large analysis prompt is paid once per pack instead of once per
+        drawing, and bulk screening makes far fewer requests. Drawings whose
+        packed analysis is missing or fails validation fall back to their own
+        multimodal request. The text stage still runs per drawing, concurrently.
+        Once the upstream's circuit breaker opens, the remaining drawings are
+        marked unavailable without further requests. timeout is the budget of
+        the whole call, with the same partial results as workflow().
+        Returns one result dict per input, in input order, shaped like workflow().
+        """
+        started = time.perf_counter()
+        with trace("pack_workflow", drawings=len(image_paths), pack_size=pack_size) as root:
+            with deadline_scope(WORKFLOW_TIMEOUT if timeout is None else timeout):
+                all_results = self._pack_workflow(image_paths, pack_size)
+        self._log_summary("pack_workflow", all_results, started, drawings=len(image_paths), pack_size=pack_size)
+        # The trace covers the whole call, every drawing gets the same summary
+        summary = trace_summary(root)
+        for results in all_results:
+            results["trace"] = summary
+        return all_results
+
+    def _pack_workflow(self, image_paths: List[str], pack_size: int) -> List[Dict]:
+        logger.debug(f"Starting packed workflow for {len(image_paths)} drawings, pack size {pack_size}")
+        all_results = [self._new_results() for _ in image_paths]
+        loaded = {}
+        for i, image_path in enumerate(image_paths):
+            try:
+                with span("load_image", drawing=i):
+                    data_url, digest = load_image(image_path)
+                if digest:
+                    all_results[i]["image_ref"] = image_ref(digest)
+                loaded[i] = data_url
             except Exception as e:
-                logger.error(f"Error in GPT-4o analysis: {str(e)}", exc_info=True)
-                error_msg = f"Analysis error: {str(e)}"
-                results["overall"]["feature"] = error_msg
-                results["overall"]["analysis"] = error_msg
-                results["house"]["feature"] = error_msg
-                results["house"]["analysis"] = error_msg
-                results["tree"]["feature"] = error_msg
-                results["tree"]["analysis"] = error_msg
-                results["person"]["feature"] = error_msg
-                results["person"]["analysis"] = error_msg
-                results["merge"] = error_msg
-                results["final"] = error_msg
-                results["signal"] = error_msg
-            
-            return results
-            
-        except Exception as e:
-            logger.error(f"Error running simplified HTP analysis: {str(e)}", exc_info=True)
-            
-            # Fill results with error message
-            error_msg = "Due to some system failure, the image can't be analysed..."
-            results["overall"]["feature"] = error_msg
-            results["overall"]["analysis"] = error_msg
-            results["house"]["feature"] = error_msg
-            results["house"]["analysis"] = error_msg
-            results["tree"]["feature"] = error_msg
-            results["tree"]["analysis"] = error_msg
-            results["person"]["feature"] = error_msg
-            results["person"]["analysis"] = error_msg
-            results["merge"] = error_msg
-            results["final"] = error_msg
-            results["signal"] = error_msg
-            
-            return results
\ No newline at end of file
+                logger.error(f"Error loading drawing {i}: {str(e)}", exc_info=True)
+                self._fill_error(all_results[i], "Due to some system failure, the image can't be analysed...")
+
+        initial = {}
+        unavailable = None
+        pending = list(loaded)
+        for start in range(0, len(pending), max(pack_size, 1)):
+            pack = pending[start:start + pack_size]
+            if unavailable is not None:
+                for i in pack:
+                    self._fill_exception(all_results[i], unavailable)
+                continue
+            if len(pack) > 1:
+                pack_usage = {}
+                try:
+                    analyses = self.packed_multimodal_stage([(str(i), loaded[i]) for i in pack], pack_usage)
+                    initial.update({int(drawing_id): analysis for drawing_id, analysis in analyses.items()})
+                except CircuitOpenError as e:
+                    unavailable = e
+                except Exception as e:
+                    logger.error(f"Packed multimodal request failed, falling back per drawing: {str(e)}", exc_info=True)
+                # The packed request's usage is shared evenly, any remainder goes to the first drawing
+                for position, i in enumerate(pack):
+                    add_usage(all_results[i]["usage"], {
+                        key: value // len(pack) + (value % len(pack) if position == 0 else 0)
+                        for key, value in pack_usage.items()
+                    })
+            for i in pack:
+                if i in initial:
+                    continue
+                if unavailable is not None:
+                    self._fill_exception(all_results[i], unavailable)
+                    continue
+                if len(pack) > 1:
+                    logger.warning(f"Drawing {i} missing from packed response, analyzing it on its own")
+                try:
+                    initial[i] = self.multimodal_stage(loaded[i], all_results[i]["usage"])
+                except Exception as e:
+                    if isinstance(e, CircuitOpenError):
+                        unavailable = e
+                    self._fill_exception(all_results[i], e)
+
+        with ThreadPoolExecutor(max_workers=max(pack_size, 1)) as executor:
+            futures = {
+                submit_with_deadline(executor, self.text_stage, analysis, all_results[i]["usage"]): i
+                for i, analysis in initial.items()
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    self._fill_results(all_results[i], initial[i], future.result())
+                except Exception as e:
+                    logger.warning(f"Deeper analysis of drawing {i} failed")
+                    self._fill_exception(all_results[i], e, initial[i])
+
+        return all_results
@@ -0,0 +1,79 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Distinct (API key, base URL, model) combinations kept alive per process
+MAX_POOL_SIZE = int(os.getenv("PSYDRAW_MODEL_POOL_SIZE", "32"))
+
+
+class ModelPool:
+    """
+    Process-wide, thread-safe pool of configured HTPModel instances.
+
+    Models are keyed by API key, base URL, model names and client options, so
+    every Streamlit session (or API request) using the same configuration shares
+    the same ChatOpenAI clients and their warm HTTP connection pools. The least
+    recently used configuration is dropped once the pool is full.
+    """
+
+    def __init__(self, max_size: int = MAX_POOL_SIZE):
+        self.max_size = max_size
+        self._models = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(api_key, base_url, text_model, multimodal_model, use_cache, client_kwargs):
+        # Keep only a fingerprint of the API key in the pool key
+        key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+        return (key_hash, base_url, text_model, multimodal_model, use_cache, tuple(sorted(client_kwargs.items())))
+
+    def get(
+        self,
+        api_key: str,
+        base_url: Optional[str],
+        text_model: str,
+        multimodal_model: str,
+        use_cache: bool = False,
+        **client_kwargs: Any,
+    ):
+        """Return the pooled HTPModel for this configuration, building it on first use."""
+        key = self._key(api_key, base_url, text_model, multimodal_model, use_cache, client_kwargs)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model
+
+            from src.custom_chat_openai import ChatOpenAI
+            from src.model_langchain import HTPModel
+
+            logger.info(f"Creating pooled model clients for {text_model}/{multimodal_model} at {base_url or 'default'}")
+            model = HTPModel(
+                text_model=ChatOpenAI(model_name=text_model, api_key=api_key, base_url=base_url, **client_kwargs),
+                multimodal_model=ChatOpenAI(model_name=multimodal_model, api_key=api_key, base_url=base_url, **client_kwargs),
+                use_cache=use_cache,
+            )
+            self._models[key] = model
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+            return model
+
+    def clear(self) -> None:
+        with self._lock:
+            self._models.clear()
+
+    def __len__(self) -> int:
+        return len(self._models)
+
+
+_default_pool = ModelPool()
+
+
+def get_model_pool() -> ModelPool:
+    """Return the process-wide model pool."""
+    return _default_pool
@@ -1,14 +1,7 @@
-import base64
 import os
-import shutil
-import tempfile
 import time
-import zipfile
-from io import BytesIO
 
 import streamlit as st
-from docx import Document
-from PIL import Image
 
 # Use our custom ChatOpenAI wrapper instead of the original
 import sys
@@ -16,8 +9,12 @@ import sys
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
-from src.custom_chat_openai import ChatOpenAI
-from src.model_langchain import HTPModel
+from src.assets import asset_img_tag
+from src.model_langchain import PACK_SIZE
+from src.model_pool import get_model_pool
+from src.phash import get_drawing_index
+from src.report_export import results_zip
+from src.session_images import get_session_images
 
 # Add monkey patch to disable proxies in OpenAI
 import openai
@@ -26,20 +23,6 @@ if hasattr(openai, '_client'):
     if hasattr(openai._client, 'proxies'):
         delattr(openai._client, 'proxies')
 
-def img_to_bytes(img_path):
-    img = Image.open(img_path)
-    buffered = BytesIO()
-    img.save(buffered, format=img.format)
-    return base64.b64encode(buffered.getvalue()).decode()
-
-# Setup paths
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
-ASSETS_DIR = os.path.join(PROJECT_ROOT, "assets")
-
-def get_asset_path(filename):
-    return os.path.join(ASSETS_DIR, filename)
-
 SUPPORTED_LANGUAGES = {
     "English": "en"
 }
@@ -94,71 +77,33 @@ LANGUAGES = {
     "batch_results": "Batch Analysis Finished, Please download the results. Successful: {} | Failed: {}",
     "download_batch_results": "Download Batch Results (ZIP)",
     "ai_disclaimer": "NOTE: AI-generated content, for reference only. Not a substitute for medical diagnosis.",
+    "reuse_duplicates": "Reuse results for near-duplicate drawings",
+    "reuse_duplicates_help": "Re-scans or re-photographed copies of a drawing already analyzed in this session reuse the earlier result instead of being analyzed again.",
+    "duplicates_reused": "{} near-duplicate drawing(s) reused earlier results.",
+    "pack_drawings": "Pack drawings into shared requests",
+    "pack_drawings_help": "Analyze up to {} drawings per image request to cut prompt overhead and request count. Drawings the model misses in a pack are re-analyzed on their own.",
     }
 }
 
-@st.cache_resource
-def get_uploaded_files():
-    return []
-
-def pil_to_base64(image: Image.Image, format: str = "JPEG") -> str:
-    """Convert PIL image to base64 string."""
-    buffered = BytesIO()
-    image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
 def get_text(key):
     return LANGUAGES[st.session_state['language_code']][key]
 
+def upload_names(uploaded_files):
+    """Names of the uploads in order, with a " (2)", " (3)"... suffix on repeated file names."""
+    names = []
+    for uploaded_file in uploaded_files:
+        stem, ext = os.path.splitext(uploaded_file.name)
+        name, n = uploaded_file.name, 1
+        while name in names:
+            n += 1
+            name = f"{stem} ({n}){ext}"
+        names.append(name)
+    return names
+
 def save_results(results):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for result in results:
-            file_name = result['file_name']
-            file_name_without_ext = os.path.splitext(file_name)[0]
-            
-            result_folder = os.path.join(temp_dir, file_name_without_ext)
-            os.makedirs(result_folder, exist_ok=True)
-            
-            # 保存上传的图片
-            if result['image']:
-                image_path = os.path.join(result_folder, file_name)
-                result['image'].save(image_path)
-            
-            doc = Document()
-            if result['success']:
-                doc.add_paragraph(get_text("ai_disclaimer"))
-                if result['analysis_result']['classification'] is True:
-                    signal = result['analysis_result']['signal']
-                    final = result['analysis_result']['final']
-                    doc.add_paragraph(signal)
-                    doc.add_paragraph(final)
-                else:
-                    signal = result['analysis_result']['fix_signal']
-                    doc.add_paragraph(signal)
-            else:
-                doc.add_paragraph("failed")
-            doc_path = os.path.join(result_folder, f"{file_name_without_ext}.docx")
-            doc.save(doc_path)
-        
-        failed_path = os.path.join(temp_dir, "failed.txt")
-        with open(failed_path, "w") as f:
-            for result in results:
-                if not result['success']:
-                    f.write(f"{result['file_name']}\n")
-                    
-        zip_path = os.path.join(temp_dir, "results.zip")
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, _, files in os.walk(temp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_dir)
-                    zipf.write(file_path, arcname)
-        with open(zip_path, "rb") as f:
-            zip_content = f.read()
-    
-    return zip_content    
+    return results_zip(results, get_text("ai_disclaimer"))
         
-def batch_analyze(uploaded_files):
+def batch_analyze(file_names):
     results = []
     
     MULTIMODAL_MODEL = "gpt-4-vision-preview"
@@ -170,92 +115,101 @@ def batch_analyze(uploaded_files):
         st.error("❌ Please enter your API key in the sidebar before starting the analysis.")
         return [], 0
     
-    # Create custom ChatOpenAI instances with explicit parameters
+    # Reuse the process-wide clients for this API configuration
     try:
-        print(f"Initializing ChatOpenAI with API Key: {'Yes (length: ' + str(len(api_key)) + ')' if api_key else 'No'}")
+        print(f"Getting pooled model with API Key: {'Yes (length: ' + str(len(api_key)) + ')' if api_key else 'No'}")
         print(f"Base URL: {st.session_state.base_url or 'default'}")
         
-        text_model = ChatOpenAI(
-            model_name=TEXT_MODEL,
+        model = get_model_pool().get(
             api_key=api_key,
             base_url=st.session_state.base_url,
+            text_model=TEXT_MODEL,
+            multimodal_model=MULTIMODAL_MODEL,
+            use_cache=True,
             temperature=0.2,
         )
-        
-        multimodal_model = ChatOpenAI(
-            model_name=MULTIMODAL_MODEL,
-            api_key=api_key,
-            base_url=st.session_state.base_url,
-            temperature=0.2,
-        )
-        
-        model = HTPModel(
-            text_model=text_model,
-            multimodal_model=multimodal_model,
-            language=st.session_state['language_code'],
-            use_cache=True
-        )
-        print("HTPModel initialized successfully")
+        print("HTPModel ready")
     except Exception as e:
         print(f"Error during initialization: {str(e)}")
         st.error(f"Error initializing models: {str(e)}")
         return [], 0
         
-    progress_bar = st.progress(0, text=f"Progressing: 0/{len(uploaded_files)}")
+    images = get_session_images()
+    reuse_duplicates = st.session_state.get('reuse_duplicates', False)
+    # Results are only indexed, and reused, within this session when the user opted in
+    index = get_drawing_index(images.session_id) if reuse_duplicates else None
+    # Packing sends several drawings per multimodal request, one at a time otherwise
+    step = PACK_SIZE if st.session_state.get('pack_drawings', False) else 1
+    progress_bar = st.progress(0, text=f"Progressing: 0/{len(file_names)}")
     start_time = time.time()
     success = 0
-    for i, uploaded_file in enumerate(uploaded_files):
+    reused = 0
+    for start in range(0, len(file_names), step):
+        chunk = file_names[start:start + step]
+        responses = {}
+        error = ""
         try:
-            print(f"Processing file {i+1}/{len(uploaded_files)}: {uploaded_file.name}")
-            image = Image.open(uploaded_file)
-            image_data = pil_to_base64(image)
-            print(f"Image converted to base64 string (length: {len(image_data)})")
+            print(f"Processing files {start + 1}-{start + len(chunk)}/{len(file_names)}: {', '.join(chunk)}")
             
-            print(f"Starting workflow analysis with language: {st.session_state['language_code']}")
-            response = model.workflow(image_path=image_data, language=st.session_state['language_code'])
-            print(f"Analysis completed successfully for {uploaded_file.name}")
+            pending = []
+            for file_name in chunk:
+                match = index.find(images.digest(file_name)) if reuse_duplicates else None
+                if match:
+                    print(f"Reusing result of near-duplicate {match['digest'][:12]} (distance {match['distance']})")
+                    responses[file_name] = match["result"]
+                    reused += 1
+                else:
+                    pending.append(file_name)
             
-            results.append({
-                "file_name": uploaded_file.name,
-                "analysis_result": response,
-                "success": True,
-                "image": image
-            })
-            success += 1
+            print(f"Starting workflow analysis with language: {st.session_state['language_code']}")
+            refs = [images.ref(file_name, "jpeg") for file_name in pending]
+            if len(refs) > 1:
+                analyzed = model.pack_workflow(refs, language=st.session_state['language_code'], pack_size=step)
+            else:
+                analyzed = [model.workflow(image_path=ref, language=st.session_state['language_code']) for ref in refs]
+            for file_name, response in zip(pending, analyzed):
+                if reuse_duplicates and response.get("status", "ok") == "ok":
+                    index.add(images.digest(file_name), response)
+                responses[file_name] = response
+            print(f"Analysis completed successfully for {', '.join(chunk)}")
         except Exception as e:
-            print(f"Error processing {uploaded_file.name}: {str(e)}")
+            print(f"Error processing {', '.join(chunk)}: {str(e)}")
             import traceback
             print(f"Traceback: {traceback.format_exc()}")
-            
+            error = str(e)
+        
+        for file_name in chunk:
+            # Failed and unavailable (upstream circuit open) drawings keep their error text in the result
+            analyzed_ok = file_name in responses and responses[file_name].get("status", "ok") == "ok"
             results.append({
-                "file_name": uploaded_file.name,
-                "analysis_result": str(e),
-                "success": False,
-                "image": image
+                "file_name": file_name,
+                "analysis_result": responses.get(file_name, error),
+                "success": analyzed_ok,
+                "image_ref": images.digest(file_name)
             })
+            success += analyzed_ok
         
+        done = start + len(chunk)
         elapsed_time = time.time() - start_time
-        progress = (i + 1) / len(uploaded_files)
+        progress = done / len(file_names)
         estimated_total_time = elapsed_time / progress if progress > 0 else 0
         remaining_time = estimated_total_time - elapsed_time
         
         elapsed_str = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
         remaining_str = time.strftime("%H:%M:%S", time.gmtime(remaining_time))
         
-        progress_bar.progress(progress, text=f"Progressing: {i + 1}/{len(uploaded_files)} | Elapsed: {elapsed_str} | Remaining: {remaining_str}")
+        progress_bar.progress(progress, text=f"Progressing: {done}/{len(file_names)} | Elapsed: {elapsed_str} | Remaining: {remaining_str}")
     
-    st.success(get_text("batch_results").format(success, len(uploaded_files) - success))
+    st.success(get_text("batch_results").format(success, len(file_names) - success))
+    if reused:
+        st.info(get_text("duplicates_reused").format(reused))
     
     return results, success
 
 def sidebar() -> None:
     """Render sidebar components."""
     with st.sidebar:
-        logo_path = get_asset_path("logo-3.png")
-        st.markdown(
-            f'<img src="data:image/png;base64,{img_to_bytes(logo_path)}" alt="logo" width="100%">',
-            unsafe_allow_html=True
-        )
+        st.markdown(asset_img_tag("logo-3.png", "logo"), unsafe_allow_html=True)
         
     st.sidebar.markdown(f"## {get_text('model_settings')}")
     
@@ -286,6 +240,18 @@ def sidebar() -> None:
     st.session_state['language'] = "English"
     st.session_state['language_code'] = "en"
     
+    st.session_state['reuse_duplicates'] = st.sidebar.checkbox(
+        get_text("reuse_duplicates"),
+        value=st.session_state.get('reuse_duplicates', False),
+        help=get_text("reuse_duplicates_help")
+    )
+    
+    st.session_state['pack_drawings'] = st.sidebar.checkbox(
+        get_text("pack_drawings"),
+        value=st.session_state.get('pack_drawings', False),
+        help=get_text("pack_drawings_help").format(PACK_SIZE)
+    )
+    
     st.sidebar.markdown("---")
     if st.sidebar.button("Start Analysis"):
         st.session_state.start_analysis = True
@@ -317,10 +283,24 @@ def main():
     
     uploaded_files = st.file_uploader(get_text("upload_images"), accept_multiple_files=True, type=['png', 'jpg', 'jpeg'], key="file_uploader")
     status_placeholder = st.empty()
+    # Uploads are held by this session's image manager (one copy each, spilled to disk
+    # past the memory limit) and kept in sync with the uploader widget
+    images = get_session_images()
+    current_names = upload_names(uploaded_files or [])
+    # Uploader file_id of each image held, so reruns skip hashing and copying it again
+    tracked = st.session_state.setdefault('batch_uploads', {})
+    for name in images.names():
+        if name not in current_names:
+            images.remove(name)
+            tracked.pop(name, None)
+    for name, uploaded_file in zip(current_names, uploaded_files or []):
+        if tracked.get(name) != uploaded_file.file_id or images.digest(name) is None:
+            images.add(name, uploaded_file.getvalue())
+            tracked[name] = uploaded_file.file_id
     if uploaded_files:
-        cached_files = get_uploaded_files()
-        cached_files.extend(uploaded_files)
-        status_placeholder.success(get_text("images_uploaded").format(len(cached_files)))
+        status_placeholder.success(get_text("images_uploaded").format(len(images)))
+        stats = images.stats()
+        st.caption(f"Session images: {stats['images']} ({stats['memory_bytes'] / 1024 / 1024:.1f} MB in memory)")
         
     if st.session_state.get('start_analysis'):
         # Check if API key is set in environment
@@ -328,7 +308,7 @@ def main():
         if not api_key:
             st.error("❌ Please enter your API key in the sidebar before starting the analysis.")
         elif uploaded_files:
-            results, success = batch_analyze(uploaded_files=uploaded_files)
+            results, success = batch_analyze(file_names=current_names)
             
             zip_content = save_results(results)
             st.download_button(
@@ -1,6 +1,4 @@
-import base64
 import os
-from io import BytesIO
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -8,7 +6,6 @@ load_dotenv()
 
 import requests
 import streamlit as st
-from PIL import Image
 
 # Use our custom ChatOpenAI wrapper instead of the original
 import sys
@@ -16,8 +13,10 @@ import sys
 # Add parent directory to path for imports
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
 
-from src.custom_chat_openai import ChatOpenAI
-from src.model_langchain import HTPModel
+from src.assets import asset_img_tag
+from src.model_langchain import needs_professional, report_text
+from src.model_pool import get_model_pool
+from src.session_images import get_session_images
 
 # Add monkey patch to disable proxies in OpenAI
 import openai
@@ -28,7 +27,9 @@ if hasattr(openai, '_client'):
 
 # Constants
 BASE_URL = "https://api.openai.com/v1"
-MAX_IMAGE_SIZE = (800, 800)
+# Drawings are downscaled to 800x800 by the image store's "model" profile
+IMAGE_PROFILE = "model"
+DRAWING_KEY = "drawing"
 
 # Supported languages and their codes
 SUPPORTED_LANGUAGES = {
@@ -83,6 +84,8 @@ LANGUAGES = {
         "report_language": "Report Language:",
         "upload_drawing": "🖼️ Upload Your Drawing:",
         "start_analysis": "🚀 Start Analysis",
+        "structured_output": "Structured report",
+        "structured_output_help": "Ask the model for a report with typed sections, summary and risk flags instead of free text.",
         "reset": "♻️ Reset",
         "download_report": "⬇️ Download Report",
         "download_help": "Download the analysis report as a text file.",
@@ -103,21 +106,8 @@ LANGUAGES = {
 def get_text(key):
     return LANGUAGES[st.session_state['language_code']][key]
 
-# Helper functions
-def pil_to_base64(image: Image.Image, format: str = "JPEG") -> str:
-    """Convert PIL image to base64 string."""
-    buffered = BytesIO()
-    image.save(buffered, format=format)
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    
-def resize_image(image: Image.Image, max_size: tuple = MAX_IMAGE_SIZE) -> Image.Image:
-    """Resize image if it exceeds max_size."""
-    if image.size[0] > max_size[0] or image.size[1] > max_size[1]:
-        image.thumbnail(max_size)
-    return image
-
 def get_model():
-    """Initialize and return the HTP model with current API settings."""
+    """Return the pooled HTP model for the current API settings."""
     try:
         # Get API key and base URL from environment variables
         api_key = os.getenv("OPENAI_API_KEY")
@@ -126,36 +116,18 @@ def get_model():
         if not api_key:
             return None
             
-        # Initialize text model
-        text_model = ChatOpenAI(
-            model_name=TEXT_MODEL,
-            api_key=api_key,
-            base_url=base_url,
-            temperature=0.2,
-            max_tokens=4096,
-            cache=False
-        )
-        
-        # Initialize multimodal model
-        multimodal_model = ChatOpenAI(
-            model_name=MULTIMODAL_MODEL,
+        # Clients are shared by every session with the same settings (see src/model_pool.py)
+        return get_model_pool().get(
             api_key=api_key,
             base_url=base_url,
+            text_model=TEXT_MODEL,
+            multimodal_model=MULTIMODAL_MODEL,
+            use_cache=False,
             temperature=0.2,
             max_tokens=4096,
             cache=False
         )
         
-        # Initialize HTP model
-        model = HTPModel(
-            text_model=text_model,
-            multimodal_model=multimodal_model,
-            language=st.session_state.language_code,
-            use_cache=False
-        )
-        
-        return model
-        
     except Exception as e:
         st.error(f"Error initializing model: {str(e)}")
         return None
@@ -180,7 +152,8 @@ def analyze_image() -> None:
 
         inputs = {
             "image_path": st.session_state['image_data'],
-            "language": st.session_state['language_code']
+            "language": st.session_state['language_code'],
+            "structured": st.session_state.get('structured_output', False)
         }
 
         with st.spinner(get_text("analyzing_image")):
@@ -191,16 +164,17 @@ def analyze_image() -> None:
 
 def reset_session() -> None:
     """Reset session state."""
-    for key in ['image_data', 'image_display', 'analysis_result', 'current_sample', 'image_source']:
+    for key in ['image_data', 'analysis_result', 'current_sample', 'image_source']:
         if key in st.session_state:
             del st.session_state[key]
+    get_session_images().remove(DRAWING_KEY)
     st.success(get_text("session_reset"))
 
 def export_report() -> None:
     if st.session_state.get('analysis_result'):
         if st.session_state["analysis_result"]['classification'] is True:
             merge_analysis = st.session_state['analysis_result'].get('merge', '')
-            final_report = st.session_state['analysis_result'].get('final', '').replace("<o>", "").replace("</o>", "")
+            final_report = report_text(st.session_state['analysis_result'], "final")
             disclaimer = get_text("ai_disclaimer")
             
             export_data = f"{disclaimer}\n\n"
@@ -219,29 +193,11 @@ def export_report() -> None:
             help=get_text("download_help")
         )
 
-def img_to_bytes(img_path):
-    img = Image.open(img_path)
-    buffered = BytesIO()
-    img.save(buffered, format=img.format)
-    return base64.b64encode(buffered.getvalue()).decode()
-
-# Setup paths
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
-ASSETS_DIR = os.path.join(PROJECT_ROOT, "assets")
-
-def get_asset_path(filename):
-    return os.path.join(ASSETS_DIR, filename)
-
 # UI components
 def sidebar() -> None:
     """Render sidebar components."""
     with st.sidebar:
-        logo_path = get_asset_path("logo-3.png")
-        st.markdown(
-            f'<img src="data:image/png;base64,{img_to_bytes(logo_path)}" alt="logo" width="100%">',
-            unsafe_allow_html=True
-        )
+        st.markdown(asset_img_tag("logo-3.png", "logo"), unsafe_allow_html=True)
     
     # Initialize source tracking if not present
     if 'image_source' not in st.session_state:
@@ -259,12 +215,10 @@ def sidebar() -> None:
                 if 'analysis_result' in st.session_state:
                     del st.session_state['analysis_result']
                 
-                # Load the sample image
+                # Load the sample image; the session keeps only the preprocessed bytes and
+                # the model reads the same stored variant by reference
                 with open(sample_path, "rb") as f:
-                    image = Image.open(f)
-                    image = resize_image(image)
-                    st.session_state['image_data'] = pil_to_base64(image)
-                    st.session_state['image_display'] = image
+                    st.session_state['image_data'] = get_session_images().add(DRAWING_KEY, f.read(), IMAGE_PROFILE)
                     st.session_state['current_sample'] = sample_name
                     # Track that the current image came from a sample
                     st.session_state['image_source'] = 'sample'
@@ -289,17 +243,21 @@ def sidebar() -> None:
         if 'analysis_result' in st.session_state:
             del st.session_state['analysis_result']
             
-        # Load the uploaded image
-        image = Image.open(uploaded_file)
-        image = resize_image(image)
-        st.session_state['image_data'] = pil_to_base64(image)
-        st.session_state['image_display'] = image
+        # Load the uploaded image; the session keeps only the preprocessed bytes and
+        # the model reads the same stored variant by reference
+        st.session_state['image_data'] = get_session_images().add(DRAWING_KEY, uploaded_file.getvalue(), IMAGE_PROFILE)
         # Clear current sample when uploading own image
         if 'current_sample' in st.session_state:
             del st.session_state['current_sample']
         # Track that the current image came from an upload
         st.session_state['image_source'] = 'upload'
     
+    st.session_state['structured_output'] = st.sidebar.checkbox(
+        get_text("structured_output"),
+        value=st.session_state.get('structured_output', False),
+        help=get_text("structured_output_help")
+    )
+    
     # Buttons
     st.sidebar.markdown("---")
     if st.sidebar.button(get_text("start_analysis"), key=f"analyze_button_{st.session_state.get('image_source', 'init')}"):
@@ -321,20 +279,21 @@ def main_content() -> None:
         st.markdown(get_text("instructions"))
 
     # Display Uploaded Image or Placeholder
-    if st.session_state.get('image_display'):
+    image_bytes = get_session_images().get_bytes(DRAWING_KEY) if st.session_state.get('image_data') else None
+    if image_bytes:
         # Check Streamlit version for parameter compatibility
         import streamlit as st_version_check
         try:
             # Try with use_container_width first (newer versions)
             st.image(
-                st.session_state['image_display'],
+                image_bytes,
                 caption=get_text("uploaded_drawing"),
                 use_container_width=True
             )
         except TypeError:
             # Fall back to use_column_width for older versions
             st.image(
-                st.session_state['image_display'],
+                image_bytes,
                 caption=get_text("uploaded_drawing"),
                 use_column_width=True
             )
@@ -345,15 +304,8 @@ def main_content() -> None:
     if st.session_state.get('analysis_result'):
         st.success(get_text("analysis_complete"))
         
-        # Check if the analysis contains a warning about inability to analyze
-        analysis_text = st.session_state['analysis_result'].get('final', '')
-        unable_to_analyze = any(phrase in analysis_text.lower() for phrase in [
-            "unable to properly analyze the image",
-            "unable to analyze the image",
-            "strongly recommend consulting a professional"
-        ])
-        
-        if unable_to_analyze:
+        # Risk flags of a structured report, or a scan of the free-text report
+        if needs_professional(st.session_state['analysis_result']):
             st.error("""
             ⚠️ **WARNING: ANALYSIS LIMITATIONS DETECTED** ⚠️
             
@@ -395,7 +347,7 @@ def main() -> None:
         st.session_state['language'] = 'English'
     if 'language_code' not in st.session_state:
         st.session_state['language_code'] = 'en'
-    for key in ['image_data', 'image_display', 'analysis_result', 'image_source']:
+    for key in ['image_data', 'analysis_result', 'image_source']:
         if key not in st.session_state:
             st.session_state[key] = None
 
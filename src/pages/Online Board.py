@@ -1,15 +1,25 @@
 import io
+import zlib
 import numpy as np
 import streamlit as st
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
-import base64
 import os
-from io import BytesIO
+import sys
+
+# Add parent directory to path for imports
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+from src.assets import asset_img_tag
+from src.model_pool import get_model_pool
+from src.session_images import get_session_images
 
 # Constants
 CANVAS_WIDTH = 800
 CANVAS_HEIGHT = 600
+CANVAS_KEY = "canvas"
+TEXT_MODEL = "gpt-4o"
+MULTIMODAL_MODEL = "gpt-4o"
 
 # Supported languages and their codes
 SUPPORTED_LANGUAGES = {
@@ -31,18 +41,26 @@ LANGUAGES = {
             - **Important Note**: It's recommended to use paper and pencil if possible for the best results.
             ### How to Use:
             1. Use the tools on the sidebar to draw your picture.
-            2. When finished, click the **Download Drawing** button on the sidebar to save your drawing.
-            3. Upload the saved image for analysis in the main test.
+            2. When finished, click **Analyze This Drawing** on the sidebar to analyze it directly.
+            3. To keep a copy, click **Prepare Download** and then **Download Drawing**.
             """,
+        "prepare_download": "📦 Prepare Download",
         "download_button": "💾 Download Drawing",
         "download_filename": "htp_drawing.png",
         "download_help": "Save your drawing as a PNG image.",
         "reminder_title": "⭕ Reminder",
         "reminder": """
-            - After drawing, don't forget to download your image.
-            - Return to the main test page to upload and analyze your drawing.
+            - You can analyze the drawing here, without downloading and uploading it again.
+            - If you keep drawing, prepare the download again to include your latest strokes.
             """,
-        "language_label": "Language:"
+        "language_label": "Language:",
+        "analyze_button": "🚀 Analyze This Drawing",
+        "analyzing": "Analyzing drawing, please wait...",
+        "empty_canvas": "Please draw something before starting the analysis.",
+        "error_no_api_key": "❌ Internal error: Unable to connect to AI service. Please try again later.",
+        "error_analysis": "Error during analysis: ",
+        "initial_analysis": "Initial HTP Drawing Analysis",
+        "deeper_analysis": "In-Depth Psychological Analysis",
     }
 }
 
@@ -59,19 +77,43 @@ def numpy_to_bytes(array, format="PNG"):
     image.save(byte_io, format=format)
     return byte_io.getvalue()
 
-def img_to_bytes(img_path):
-    img = Image.open(img_path)
-    buffered = BytesIO()
-    img.save(buffered, format=img.format)
-    return base64.b64encode(buffered.getvalue()).decode()
+def canvas_fingerprint(array):
+    """Cheap checksum of the canvas pixels, used to tell whether a prepared export is stale."""
+    return zlib.crc32(np.ascontiguousarray(array).data)
 
-# Setup paths
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-PROJECT_ROOT = os.path.dirname(os.path.dirname(SCRIPT_DIR))
-ASSETS_DIR = os.path.join(PROJECT_ROOT, "assets")
+def canvas_to_model_bytes(array):
+    """Flatten the RGBA canvas onto white and encode it as a compact grayscale PNG for the model."""
+    if array.dtype != np.uint8:
+        array = (array * 255).astype(np.uint8)
+    rgba = Image.fromarray(array, mode="RGBA")
+    flattened = Image.new("RGBA", rgba.size, (255, 255, 255, 255))
+    flattened.alpha_composite(rgba)
+    byte_io = io.BytesIO()
+    flattened.convert("L").save(byte_io, format="PNG", optimize=True)
+    return byte_io.getvalue()
 
-def get_asset_path(filename):
-    return os.path.join(ASSETS_DIR, filename)
+def analyze_canvas(array):
+    """Send the current canvas straight to the model and keep the result in the session."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        st.error(get_text("error_no_api_key"))
+        return
+    if not np.any(array[..., 3]):
+        st.warning(get_text("empty_canvas"))
+        return
+    try:
+        image_path = get_session_images().add(CANVAS_KEY, canvas_to_model_bytes(array))
+        model = get_model_pool().get(
+            api_key=api_key,
+            base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+            text_model=TEXT_MODEL,
+            multimodal_model=MULTIMODAL_MODEL,
+            temperature=0.2,
+        )
+        with st.spinner(get_text("analyzing")):
+            st.session_state['canvas_analysis'] = model.workflow(image_path=image_path, language=st.session_state['language_code'])
+    except Exception as e:
+        st.error(f"{get_text('error_analysis')}{str(e)}")
 
 def main():
     # Page Configuration
@@ -127,16 +169,34 @@ def main():
         key="canvas",
     )
 
-    # Download Button
+    # Export and analysis only encode the canvas when asked to, not on every stroke
     if canvas_result.image_data is not None:
-        img_bytes = numpy_to_bytes(canvas_result.image_data)
-        st.sidebar.download_button(
-            get_text("download_button"),
-            data=img_bytes,
-            file_name=get_text("download_filename"),
-            mime="image/png",
-            help=get_text("download_help")
-        )
+        st.sidebar.markdown("---")
+        if st.sidebar.button(get_text("analyze_button")):
+            analyze_canvas(canvas_result.image_data)
+
+        if st.sidebar.button(get_text("prepare_download")):
+            st.session_state['canvas_export'] = (
+                canvas_fingerprint(canvas_result.image_data),
+                numpy_to_bytes(canvas_result.image_data),
+            )
+        export = st.session_state.get('canvas_export')
+        if export and export[0] == canvas_fingerprint(canvas_result.image_data):
+            st.sidebar.download_button(
+                get_text("download_button"),
+                data=export[1],
+                file_name=get_text("download_filename"),
+                mime="image/png",
+                help=get_text("download_help")
+            )
+
+    # Analysis Results
+    result = st.session_state.get('canvas_analysis')
+    if result:
+        with st.expander(get_text("initial_analysis"), expanded=True):
+            st.write(result.get('merge', ''))
+        with st.expander(get_text("deeper_analysis"), expanded=True):
+            st.write(result.get('final', ''))
 
     # Reminder
     with st.expander(get_text("reminder_title"), expanded=True):
@@ -144,11 +204,7 @@ def main():
 
 def sidebar():
     with st.sidebar:
-        logo_path = get_asset_path("logo-3.png")
-        st.markdown(
-            f'<img src="data:image/png;base64,{img_to_bytes(logo_path)}" alt="logo" width="100%">',
-            unsafe_allow_html=True
-        )
+        st.markdown(asset_img_tag("logo-3.png", "logo"), unsafe_allow_html=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,75 @@
+import secrets
+from typing import Any, Dict, List
+
+try:
+    from src.serialization import dumps
+except ImportError:
+    from serialization import dumps
+
+# Data URLs shorter than this are cheap enough to go through the JSON encoder.
+SPLICE_THRESHOLD = 4096
+
+# Placeholders carry a random nonce per body, so no message text can contain one
+_PLACEHOLDER = "__psydraw_image_{nonce}_{index}__"
+
+
+def _can_splice(url: Any) -> bool:
+    """A data URL can be written verbatim if it needs no JSON escaping."""
+    return (
+        isinstance(url, str)
+        and len(url) >= SPLICE_THRESHOLD
+        and url.startswith("data:")
+        and url.isascii()
+        and '"' not in url
+        and "\\" not in url
+    )
+
+
+def _strip_images(messages: List[Dict[str, Any]], images: List[str], nonce: str) -> List[Dict[str, Any]]:
+    """Shallow-copy the messages, replacing large data URLs with placeholders."""
+    stripped = []
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            stripped.append(message)
+            continue
+        new_content = []
+        for item in content:
+            image_url = item.get("image_url") if isinstance(item, dict) else None
+            url = image_url.get("url") if isinstance(image_url, dict) else None
+            if _can_splice(url):
+                images.append(url)
+                item = dict(item, image_url=dict(image_url, url=_PLACEHOLDER.format(nonce=nonce, index=len(images) - 1)))
+            new_content.append(item)
+        stripped.append(dict(message, content=new_content))
+    return stripped
+
+
+def encode_chat_body(data: Dict[str, Any]) -> bytes:
+    """
+    Serialize a chat completions request body to bytes.
+
+    Large base64 data URLs are kept out of the JSON encoder: the small skeleton
+    is serialized with placeholders and the images are spliced in when the
+    final buffer is joined, so each image is copied once instead of being
+    escaped, re-encoded and copied again by the HTTP library.
+    """
+    images: List[str] = []
+    nonce = secrets.token_hex(16)
+    skeleton = dict(data, messages=_strip_images(data.get("messages", []), images, nonce))
+    encoded = dumps(skeleton)
+    if not images:
+        return encoded
+
+    # Split on each serialized placeholder, JSON quotes included, so only the string value itself matches
+    needles = [b'"' + _PLACEHOLDER.format(nonce=nonce, index=index).encode("ascii") + b'"' for index in range(len(images))]
+    if any(encoded.count(needle) != 1 for needle in needles):
+        return dumps(data)
+    parts = []
+    rest = encoded
+    for needle, url in zip(needles, images):
+        head, _, rest = rest.partition(needle)
+        parts.append(head)
+        parts.extend((b'"', url.encode("ascii"), b'"'))
+    parts.append(rest)
+    return b"".join(parts)
@@ -0,0 +1,286 @@
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    from src.image_store import get_image_store
+except ImportError:
+    from image_store import get_image_store
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 16
+# Maximum Hamming distance (out of 256 bits) for two drawings to be compared pixel by pixel.
+# Distinct line drawings sit 50+ bits apart, re-encodes and rescans within about 10
+DUPLICATE_DISTANCE = int(os.getenv("PSYDRAW_DUPLICATE_DISTANCE", "20"))
+# Minimum structural similarity of the thumbnails for a candidate to count as the same drawing
+DUPLICATE_SSIM = float(os.getenv("PSYDRAW_DUPLICATE_SSIM", "0.95"))
+THUMB_SIZE = 64
+SSIM_WINDOW = 8
+
+
+def _dct_matrix(n: int):
+    import numpy as np
+
+    k = np.arange(n)
+    matrix = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def phash(data, hash_size: int = HASH_SIZE, highfreq_factor: int = 4) -> int:
+    """
+    Perceptual hash of an image: the signs of the lowest hash_size x hash_size
+    DCT coefficients of a grayscale thumbnail against their median. Robust to
+    re-encoding, rescaling and small exposure changes from re-scans or photos.
+    """
+    import numpy as np
+    from PIL import Image
+
+    size = hash_size * highfreq_factor
+    image = Image.open(BytesIO(data))
+    # Let the JPEG decoder downscale while decoding, the hash only needs a small thumbnail
+    image.draft("L", (size * 4, size * 4))
+    pixels = np.asarray(image.convert("L").resize((size, size), Image.LANCZOS), dtype=np.float64)
+    dct = _dct_matrix(size)
+    low = (dct @ pixels @ dct.T)[:hash_size, :hash_size].ravel()
+    # The DC term only measures brightness
+    bits = low > np.median(low[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def thumbnail(data, size: int = THUMB_SIZE) -> bytes:
+    """Grayscale PNG thumbnail of an image, kept to confirm hash matches."""
+    from PIL import Image
+
+    image = Image.open(BytesIO(data))
+    image.draft("L", (size * 4, size * 4))
+    buffer = BytesIO()
+    image.convert("L").resize((size, size), Image.LANCZOS).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def ssim(a: bytes, b: bytes, window: int = SSIM_WINDOW) -> float:
+    """
+    Mean structural similarity of two thumbnails over window x window blocks,
+    slightly blurred first so thin strokes a pixel apart still line up.
+    """
+    import numpy as np
+    from PIL import Image, ImageFilter
+
+    def blocks(data):
+        image = Image.open(BytesIO(data)).convert("L").filter(ImageFilter.GaussianBlur(1))
+        pixels = np.asarray(image, dtype=np.float64)
+        h, w = pixels.shape
+        return pixels.reshape(h // window, window, w // window, window).transpose(0, 2, 1, 3).reshape(-1, window * window)
+
+    x, y = blocks(a), blocks(b)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mx, my = x.mean(axis=1), y.mean(axis=1)
+    covariance = ((x - mx[:, None]) * (y - my[:, None])).mean(axis=1)
+    similarity = ((2 * mx * my + c1) * (2 * covariance + c2)) / ((mx ** 2 + my ** 2 + c1) * (x.var(axis=1) + y.var(axis=1) + c2))
+    return float(similarity.mean())
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing over perceptual hashes for sub-millisecond Hamming radius queries.
+
+    The hash is split into `chunks` substrings, each with its own table. By the
+    pigeonhole principle any hash within distance d of the query is within
+    d // chunks of it on at least one substring, so a query only probes the
+    few buckets near each substring instead of scanning the whole index.
+    """
+
+    def __init__(self, bits: int = HASH_SIZE * HASH_SIZE, chunks: int = 16, max_distance: int = DUPLICATE_DISTANCE):
+        self.bits = bits
+        self.chunks = chunks
+        self.chunk_bits = bits // chunks
+        self.max_distance = max_distance
+        self.tables: List[Dict[int, List[Tuple[int, Any]]]] = [{} for _ in range(chunks)]
+        self._masks = self._flip_masks(self.chunk_bits, max_distance // chunks)
+        self.size = 0
+
+    @staticmethod
+    def _flip_masks(width: int, radius: int) -> List[int]:
+        masks = [0]
+        for _ in range(radius):
+            masks = sorted({mask | (1 << bit) for mask in masks for bit in range(width)} | set(masks))
+        return masks
+
+    def _split(self, value: int) -> List[int]:
+        mask = (1 << self.chunk_bits) - 1
+        return [(value >> (i * self.chunk_bits)) & mask for i in range(self.chunks)]
+
+    def add(self, value: int, item: Any) -> None:
+        for table, chunk in zip(self.tables, self._split(value)):
+            table.setdefault(chunk, []).append((value, item))
+        self.size += 1
+
+    def search(self, value: int, max_distance: Optional[int] = None) -> List[Tuple[int, Any]]:
+        """Return (distance, item) pairs within max_distance, closest first."""
+        max_distance = self.max_distance if max_distance is None else max_distance
+        if max_distance > self.max_distance:
+            # Probing radius was sized for self.max_distance; larger radii need a full scan
+            candidates = (entry for bucket in self.tables[0].values() for entry in bucket)
+        else:
+            candidates = (
+                entry
+                for table, chunk in zip(self.tables, self._split(value))
+                for mask in self._masks
+                for entry in table.get(chunk ^ mask, ())
+            )
+        matches = {}
+        for candidate, item in candidates:
+            distance = hamming(value, candidate)
+            if distance <= max_distance:
+                matches[id(item), candidate] = (distance, item)
+        return sorted(matches.values(), key=lambda match: match[0])
+
+
+class DrawingIndex:
+    """
+    Persistent perceptual-hash index of the drawings one tenant has analyzed.
+
+    Each entry maps a drawing's pHash to its image-store digest; the analysis
+    result is saved next to the index as results/<digest>.json, with a small
+    thumbnail in thumbs/<digest>.png, so a near-duplicate (re-scan, re-photo)
+    can reuse it instead of paying for a new analysis. A hash match is only
+    reused once the thumbnails confirm it is the same drawing.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.index_path = os.path.join(self.root, "index.jsonl")
+        self.results_dir = os.path.join(self.root, "results")
+        self.thumbs_dir = os.path.join(self.root, "thumbs")
+        os.makedirs(self.results_dir, exist_ok=True)
+        os.makedirs(self.thumbs_dir, exist_ok=True)
+        self._lookup = MultiIndexHash()
+        self._hashes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._insert(entry["digest"], int(entry["hash"], 16))
+        logger.info(f"Loaded {len(self._hashes)} drawings into the duplicate index")
+
+    def _insert(self, digest: str, value: int) -> None:
+        if digest not in self._hashes:
+            self._hashes[digest] = value
+            self._lookup.add(value, digest)
+
+    def _thumb_path(self, digest: str) -> str:
+        return os.path.join(self.thumbs_dir, f"{digest}.png")
+
+    def _same_drawing(self, digest: str, thumb: bytes, match_digest: str, min_ssim: float) -> bool:
+        if match_digest == digest:
+            return True
+        path = self._thumb_path(match_digest)
+        if not os.path.exists(path):
+            return False
+        with open(path, "rb") as f:
+            return ssim(thumb, f.read()) >= min_ssim
+
+    def find(self, digest: str, max_distance: int = DUPLICATE_DISTANCE, min_ssim: float = DUPLICATE_SSIM) -> Optional[Dict[str, Any]]:
+        """Return the closest previously analyzed drawing confirmed to be the same one, if any."""
+        with get_image_store().open(digest) as data:
+            value = self._hashes.get(digest)
+            if value is None:
+                value = phash(data)
+            with self._lock:
+                matches = self._lookup.search(value, max_distance)
+            if not matches:
+                return None
+            thumb = thumbnail(data)
+        for distance, match_digest in matches:
+            if not self._same_drawing(digest, thumb, match_digest, min_ssim):
+                logger.info(f"Hash match {match_digest[:12]} (distance {distance}) rejected by the pixel check")
+                continue
+            result = self.load_result(match_digest)
+            if result is not None:
+                return {"digest": match_digest, "distance": distance, "result": result}
+        return None
+
+    def add(self, digest: str, result: Dict[str, Any]) -> None:
+        """Index a drawing and save its analysis result and thumbnail."""
+        with get_image_store().open(digest) as data:
+            value = self._hashes.get(digest)
+            if value is None:
+                value = phash(data)
+            thumb = thumbnail(data)
+        with open(os.path.join(self.results_dir, f"{digest}.json"), "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        with open(self._thumb_path(digest), "wb") as f:
+            f.write(thumb)
+        with self._lock:
+            if digest in self._hashes:
+                return
+            self._insert(digest, value)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"digest": digest, "hash": f"{value:0{HASH_SIZE * HASH_SIZE // 4}x}"}) + "\n")
+
+    def load_result(self, digest: str) -> Optional[Dict[str, Any]]:
+        path = os.path.join(self.results_dir, f"{digest}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+
+# Indexes kept loaded at once, least recently used ones are dropped (their files stay)
+MAX_LOADED_INDEXES = 64
+
+_indexes: "OrderedDict[str, DrawingIndex]" = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _index_root(scope: str) -> str:
+    if not re.fullmatch(r"[A-Za-z0-9_-]+", scope):
+        raise ValueError(f"Invalid duplicate index scope: {scope!r}")
+    return os.path.join(get_image_store().root, "phash", scope)
+
+
+def get_drawing_index(scope: str) -> DrawingIndex:
+    """
+    Return the duplicate index of one tenant or session. Reports are only
+    ever reused within the scope that paid for them.
+    """
+    root = _index_root(scope)
+    with _indexes_lock:
+        index = _indexes.get(scope)
+        if index is None:
+            index = DrawingIndex(root)
+            _indexes[scope] = index
+            while len(_indexes) > MAX_LOADED_INDEXES:
+                _indexes.popitem(last=False)
+        else:
+            _indexes.move_to_end(scope)
+        return index
+
+
+def drop_drawing_index(scope: str) -> None:
+    """Delete a scope's index with its saved reports, e.g. when a session ends."""
+    root = _index_root(scope)
+    with _indexes_lock:
+        _indexes.pop(scope, None)
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,316 @@
+"""
+CPU and memory profiling of a run, for the --profile option of run.py,
+batch_run.py and deploy.py.
+
+    python run.py --image_file drawing.png --save_path out.json --profile profile_out
+    python -m src.profiling --output profile_out --drawings 20      # against the mock server
+
+The output directory gets report.txt (top functions and allocation sites),
+cpu.prof (pstats, for snakeviz or gprof2dot) in "cpu" mode, or
+samples.folded (collapsed stacks, for flamegraph.pl or speedscope) in
+"sampling" mode.
+
+cProfile only sees the thread that started it, so "cpu" mode misses work
+done in other threads: the API's threadpool, where deploy.py runs every
+analysis, and the concurrent text stages of pack_workflow. Those runs
+default to "sampling", which covers all threads.
+"""
+import argparse
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005
+# Frames kept per allocation, enough to see which caller copied a buffer
+MEMORY_FRAMES = 25
+TOP = 25
+# A new peak snapshot is only taken when memory grew by this factor since the last one
+PEAK_GROWTH = 1.05
+# Profiler threads left out of the samples
+PROFILER_THREADS = ("sampling-profiler", "memory-watcher")
+# Allocations whose traceback passes through these files are summed under the label
+ALLOCATION_CATEGORIES = [
+    ("base64 encode/decode", ("base64.py", "binascii")),
+    ("PIL image buffers", (os.sep + "PIL" + os.sep,)),
+    ("image store / data URLs", ("image_store.py",)),
+    ("request serialization", ("payload.py", "serialization.py", "json" + os.sep)),
+]
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread at a fixed interval. Unlike cProfile it
+    sees worker threads and adds no per-call overhead.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        # Every allocation here is also traced when memory profiling runs alongside:
+        # frame labels are built once per code object and the profiler threads looked up once
+        labels: Dict[object, str] = {}
+        skip = {thread.ident for thread in threading.enumerate() if thread.name in PROFILER_THREADS}
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skip:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    stack.append(label)
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, limit: int = TOP) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+        """(self samples, inclusive samples) per function, highest first."""
+        own, inclusive = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                inclusive[name] += count
+        return own.most_common(limit), inclusive.most_common(limit)
+
+
+class MemoryWatcher:
+    """Tracks allocations with tracemalloc and snapshots them whenever a new peak is reached."""
+
+    def __init__(self, interval: float = 0.05, frames: int = MEMORY_FRAMES):
+        self.interval = interval
+        self.frames = frames
+        self.peak_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        tracemalloc.start(self.frames)
+        self._thread = threading.Thread(target=self._run, name="memory-watcher", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def check(self) -> None:
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.peak * PEAK_GROWTH:
+            self.peak = current
+            self.peak_snapshot = self._snapshot()
+
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ])
+
+    def stop(self) -> Tuple[tracemalloc.Snapshot, int]:
+        """Stop tracing; returns the snapshot at exit and the peak traced bytes."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.check()
+        final = self._snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return final, peak
+
+
+def _format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def allocation_report(snapshot: tracemalloc.Snapshot, limit: int = TOP) -> List[str]:
+    lines = []
+    stats = snapshot.statistics("traceback")
+    categories: Dict[str, int] = Counter()
+    for stat in stats:
+        files = [frame.filename for frame in stat.traceback]
+        for label, markers in ALLOCATION_CATEGORIES:
+            if any(marker in filename for filename in files for marker in markers):
+                categories[label] += stat.size
+                break
+    total = sum(stat.size for stat in stats)
+    lines.append(f"  total live: {_format_size(total)}")
+    for label, size in sorted(categories.items(), key=lambda item: -item[1]):
+        lines.append(f"  {label:<28} {_format_size(size):>12}")
+    lines.append("  top allocation sites:")
+    for stat in snapshot.statistics("lineno")[:limit]:
+        frame = stat.traceback[0]
+        lines.append(f"  {_format_size(stat.size):>12} {stat.count:>8} blocks  {frame.filename}:{frame.lineno}")
+    return lines
+
+
+class Profiler:
+    """CPU (cProfile of the calling thread, or sampling of all threads) plus allocation profiling."""
+
+    def __init__(self, output_dir: str, mode: str = "cpu", memory: bool = True, interval: float = SAMPLE_INTERVAL):
+        if mode not in ("cpu", "sampling"):
+            raise ValueError(f"Unknown profile mode {mode!r}, use 'cpu' or 'sampling'")
+        self.output_dir = output_dir
+        self.mode = mode
+        self.cpu = cProfile.Profile() if mode == "cpu" else None
+        self.sampler = SamplingProfiler(interval) if mode == "sampling" else None
+        self.memory = MemoryWatcher() if memory else None
+        self.report_path = os.path.join(output_dir, "report.txt")
+        self._started = 0.0
+
+    def start(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.memory:
+            self.memory.start()
+        self._started = time.perf_counter()
+        if self.cpu:
+            self.cpu.enable()
+        if self.sampler:
+            self.sampler.start()
+
+    def stop(self) -> str:
+        """Stop profiling, write the outputs and return the report path."""
+        if self.cpu:
+            self.cpu.disable()
+        if self.sampler:
+            self.sampler.stop()
+        elapsed = time.perf_counter() - self._started
+        # Stop tracing allocations before the reports below allocate their own
+        final, peak = self.memory.stop() if self.memory else (None, 0)
+        lines = [f"Profile ({self.mode}), wall time {elapsed:.2f}s", ""]
+
+        if self.cpu:
+            self.cpu.dump_stats(os.path.join(self.output_dir, "cpu.prof"))
+            for sort in ("cumulative", "tottime"):
+                out = io.StringIO()
+                pstats.Stats(self.cpu, stream=out).strip_dirs().sort_stats(sort).print_stats(TOP)
+                lines += [f"Top functions by {sort} time:", out.getvalue()]
+        if self.sampler:
+            with open(os.path.join(self.output_dir, "samples.folded"), "w", encoding="utf-8") as f:
+                f.write(self.sampler.folded())
+            own, inclusive = self.sampler.top()
+            lines.append(f"Samples: {self.sampler.samples} every {self.sampler.interval * 1000:.0f}ms (all threads, wall clock: waits included)")
+            lines.append("Top functions by self samples:")
+            lines += [f"  {count:>8}  {name}" for name, count in own]
+            lines.append("Top functions by inclusive samples:")
+            lines += [f"  {count:>8}  {name}" for name, count in inclusive]
+            lines.append("")
+        if self.memory:
+            lines.append(f"Peak traced memory: {_format_size(peak)}")
+            if self.memory.peak_snapshot is not None:
+                lines.append("Live allocations at peak:")
+                lines += allocation_report(self.memory.peak_snapshot)
+            lines.append("Live allocations at exit:")
+            lines += allocation_report(final)
+
+        with open(self.report_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        logger.info(f"Profile written to {self.report_path}")
+        return self.report_path
+
+
+@contextmanager
+def profile_session(output_dir: Optional[str], mode: str = "cpu", memory: bool = True) -> Iterator[Optional[Profiler]]:
+    """Profile the block into output_dir; a None output_dir disables profiling."""
+    if not output_dir:
+        yield None
+        return
+    profiler = Profiler(output_dir, mode, memory)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser, default_mode: str = "cpu") -> None:
+    """The --profile options shared by the entry points; work in threads needs default_mode "sampling"."""
+    parser.add_argument("--profile", type=str, default=None, metavar="DIR",
+                        help="Write CPU and allocation profiles of the run to DIR")
+    parser.add_argument("--profile_mode", choices=["cpu", "sampling"], default=default_mode,
+                        help=f"'cpu' uses cProfile (calling thread only), 'sampling' samples all threads (default: {default_mode})")
+
+
+def main(argv: Optional[list] = None) -> None:
+    """Profile the workflow on synthetic drawings against the local mock server."""
+    parser = argparse.ArgumentParser(description="Profile the HTP workflow against a local mock server")
+    parser.add_argument("--output", type=str, default="profile_out", help="Folder for the profile outputs")
+    parser.add_argument("--mode", choices=["cpu", "sampling"], default=None,
+                        help="Profiler (default: 'sampling' with --pack, whose text stages run in threads, 'cpu' otherwise)")
+    parser.add_argument("--drawings", type=int, default=10, help="Number of drawings to analyze")
+    parser.add_argument("--size", type=int, default=1600, help="Width and height of the synthetic drawings")
+    parser.add_argument("--pack", action="store_true", help="Use pack_workflow instead of one workflow per drawing")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the mock server waits per request")
+    config = parser.parse_args(argv)
+
+    from PIL import Image, ImageDraw
+
+    from src.custom_chat_openai import ChatOpenAI
+    from src.image_store import get_image_store, image_ref
+    from src.log_config import configure_logging
+    from src.mock_openai import start_mock_server
+    from src.model_langchain import HTPModel
+
+    configure_logging()
+    server, base_url = start_mock_server(latency=config.latency)
+    store = get_image_store()
+    refs = []
+    for i in range(config.drawings):
+        # Noise keeps the encoded size close to a real scanned drawing
+        image = Image.frombytes("RGB", (config.size, config.size), os.urandom(config.size * config.size * 3))
+        image = Image.blend(Image.new("RGB", image.size, "white"), image, 0.15)
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((100 + i, 600, 600, 1100), outline="black", width=6)
+        draw.ellipse((800, 200 + i, 1200, 700), outline="green", width=6)
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        refs.append(image_ref(store.put(buffer.getvalue())))
+
+    client = ChatOpenAI(api_key="mock", base_url=base_url, model_name="gpt-4o", temperature=0.2)
+    model = HTPModel(text_model=client, multimodal_model=client)
+    mode = config.mode or ("sampling" if config.pack else "cpu")
+    with profile_session(config.output, mode) as profiler:
+        if config.pack:
+            model.pack_workflow(refs)
+        else:
+            for ref in refs:
+                model.workflow(ref)
+    server.shutdown()
+    print(f"Report: {profiler.report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional
+
+try:
+    from src.image_store import get_image_store
+except ImportError:
+    from image_store import get_image_store
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated API keys accepted by the API; unset accepts any key (the key then only names the tenant)
+API_KEYS = [key.strip() for key in os.getenv("PSYDRAW_API_KEYS", "").split(",") if key.strip()]
+# Requests per minute per API key and the burst allowed above that rate; off unless set
+RATE_LIMIT_RPM = float(os.getenv("PSYDRAW_RATE_LIMIT_RPM", "0"))
+RATE_LIMIT_BURST = float(os.getenv("PSYDRAW_RATE_LIMIT_BURST", "10"))
+# LLM tokens per minute per API key (bucket capacity is one minute's worth); off unless set
+TOKEN_LIMIT_TPM = float(os.getenv("PSYDRAW_TOKEN_LIMIT_TPM", "0"))
+# LLM tokens per API key per UTC day; 0 disables the quota
+DAILY_TOKEN_QUOTA = int(os.getenv("PSYDRAW_DAILY_TOKEN_QUOTA", "0"))
+# Analyses run at once per worker process, and requests an API key may have waiting for one
+MAX_CONCURRENT = int(os.getenv("PSYDRAW_MAX_CONCURRENT", "16"))
+MAX_QUEUED_PER_KEY = int(os.getenv("PSYDRAW_MAX_QUEUED_PER_KEY", "32"))
+# Retry-After sent when an API key's queue is full
+QUEUE_RETRY_AFTER = 5.0
+# SQLite file with the token buckets and usage counters, shared by every worker process
+USAGE_DB = os.getenv("PSYDRAW_USAGE_DB")
+
+ANONYMOUS = "anonymous"
+REQUESTS = "requests"
+TOKENS = "tokens"
+
+
+class RateLimited(Exception):
+    """The API key is over one of its limits; retry_after is in seconds."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UnknownAPIKey(Exception):
+    """PSYDRAW_API_KEYS is set and the request's key is not in it."""
+
+
+def _fingerprint(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+
+def tenant_id(api_key: Optional[str], client: Optional[str] = None) -> str:
+    """
+    Stable tenant name of an API key; only a fingerprint of the key is ever stored.
+    Callers without a key are told apart by their client address instead of
+    sharing one anonymous bucket.
+    """
+    if api_key:
+        return _fingerprint(api_key)
+    if client:
+        return f"{ANONYMOUS}-{_fingerprint(client)}"
+    return ANONYMOUS
+
+
+def _today() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
+
+
+def _seconds_to_midnight() -> float:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    midnight = (now + datetime.timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (midnight - now).total_seconds()
+
+
+class UsageStore:
+    """
+    SQLite store of token-bucket levels and per-day usage counters per tenant.
+    Every update is one IMMEDIATE transaction, so worker processes sharing the
+    file enforce a single limit per API key.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "tenant TEXT, kind TEXT, level REAL, updated REAL, PRIMARY KEY (tenant, kind))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "tenant TEXT, day TEXT, requests INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, "
+                "cached_tokens INTEGER, total_tokens INTEGER, PRIMARY KEY (tenant, day))"
+            )
+
+    def take(self, tenant: str, kind: str, cost: float, rate: float, capacity: float) -> float:
+        """
+        Take cost from the tenant's bucket refilled at rate per second up to
+        capacity. Returns 0 when taken, otherwise the seconds until it can be
+        (nothing is taken then). A cost above capacity is charged as capacity.
+        """
+        cost = min(cost, capacity)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT level, updated FROM buckets WHERE tenant = ? AND kind = ?", (tenant, kind)
+                ).fetchone()
+                level = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+                wait = 0.0 if level >= cost else (cost - level) / rate
+                if not wait:
+                    level -= cost
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets (tenant, kind, level, updated) VALUES (?, ?, ?, ?)",
+                    (tenant, kind, level, now),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def refund(self, tenant: str, kind: str, amount: float) -> None:
+        """Add amount back to a bucket (negative to charge an overrun); the next take() clamps to capacity."""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE buckets SET level = level + ? WHERE tenant = ? AND kind = ?", (amount, tenant, kind)
+            )
+
+    def record(self, tenant: str, usage: Dict[str, int], requests: int = 1) -> None:
+        """Add a request's usage (the "usage" dict of a workflow result) to today's counters."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO usage (tenant, day, requests, prompt_tokens, completion_tokens, cached_tokens, total_tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (tenant, day) DO UPDATE SET "
+                "requests = requests + excluded.requests, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cached_tokens = cached_tokens + excluded.cached_tokens, total_tokens = total_tokens + excluded.total_tokens",
+                (tenant, _today(), requests, usage.get("prompt", 0), usage.get("completion", 0),
+                 usage.get("cached", 0), usage.get("total", 0)),
+            )
+
+    def usage(self, tenant: str, day: Optional[str] = None) -> Dict[str, int]:
+        """Counters of one day (all days when day is "all"), in the workflow "usage" format plus "requests"."""
+        query = "SELECT SUM(requests), SUM(prompt_tokens), SUM(completion_tokens), SUM(cached_tokens), SUM(total_tokens) FROM usage WHERE tenant = ?"
+        params = [tenant]
+        if day != "all":
+            query += " AND day = ?"
+            params.append(day or _today())
+        with self._lock:
+            row = self._conn.execute(query, params).fetchone()
+        requests, prompt, completion, cached, total = (value or 0 for value in row)
+        return {"requests": requests, "total": total, "prompt": prompt, "completion": completion, "cached": cached}
+
+
+class FairScheduler:
+    """
+    Concurrency slots of one worker process, handed out round-robin across
+    tenants when they are all busy: a tenant with many queued requests waits
+    its turn behind every other tenant's next request instead of ahead of them.
+    Runs on the event loop only.
+    """
+
+    def __init__(self, slots: int = MAX_CONCURRENT, max_queued: int = MAX_QUEUED_PER_KEY):
+        self.slots = slots
+        self.max_queued = max_queued
+        self.active = 0
+        self.waiting: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    @asynccontextmanager
+    async def slot(self, tenant: str) -> AsyncIterator[None]:
+        if self.active < self.slots and not self.waiting:
+            self.active += 1
+        else:
+            queue = self.waiting.setdefault(tenant, deque())
+            if len(queue) >= self.max_queued:
+                if not queue:
+                    del self.waiting[tenant]
+                raise RateLimited(f"Too many queued requests for this API key (max {self.max_queued})", QUEUE_RETRY_AFTER)
+            future = asyncio.get_running_loop().create_future()
+            queue.append(future)
+            try:
+                # The releasing request passes its slot on by resolving the future
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()
+                elif future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        self.waiting.pop(tenant, None)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        while self.waiting:
+            tenant, queue = next(iter(self.waiting.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiting.move_to_end(tenant)
+            else:
+                del self.waiting[tenant]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def queued(self) -> Dict[str, int]:
+        return {tenant: len(queue) for tenant, queue in self.waiting.items()}
+
+
+class QuotaLimiter:
+    """
+    Admission control of the API per API key: a request bucket, an LLM token
+    bucket charged with the planned tokens of an analysis (and settled with
+    its actual usage), a daily token quota and fair-share concurrency slots.
+    """
+
+    def __init__(self, store: UsageStore, scheduler: Optional[FairScheduler] = None):
+        self.store = store
+        self.scheduler = scheduler or FairScheduler()
+
+    def tenant(self, api_key: Optional[str], client: Optional[str] = None) -> str:
+        if API_KEYS and api_key not in API_KEYS:
+            raise UnknownAPIKey("Missing or unknown API key")
+        return tenant_id(api_key, client)
+
+    @property
+    def limits_tokens(self) -> bool:
+        """Whether analyses are charged against a token bucket, so their tokens must be planned."""
+        return bool(TOKEN_LIMIT_TPM)
+
+    def check_request(self, tenant: str) -> None:
+        """Charge one request; raises RateLimited when over the request rate or the daily quota."""
+        if DAILY_TOKEN_QUOTA and self.store.usage(tenant)["total"] >= DAILY_TOKEN_QUOTA:
+            raise RateLimited(f"Daily quota of {DAILY_TOKEN_QUOTA} tokens used up", _seconds_to_midnight())
+        if RATE_LIMIT_RPM:
+            wait = self.store.take(tenant, REQUESTS, 1, RATE_LIMIT_RPM / 60, max(1.0, RATE_LIMIT_BURST))
+            if wait:
+                raise RateLimited(f"Request rate limit of {RATE_LIMIT_RPM:g}/min exceeded", wait)
+
+    def reserve_tokens(self, tenant: str, tokens: int) -> int:
+        """Charge an analysis' planned tokens up front; returns what was reserved."""
+        if not TOKEN_LIMIT_TPM or tokens <= 0:
+            return 0
+        wait = self.store.take(tenant, TOKENS, tokens, TOKEN_LIMIT_TPM / 60, TOKEN_LIMIT_TPM)
+        if wait:
+            raise RateLimited(f"LLM token rate limit of {TOKEN_LIMIT_TPM:g}/min exceeded", wait)
+        return min(tokens, int(TOKEN_LIMIT_TPM))
+
+    def settle(self, tenant: str, reserved: int, usage: Optional[Dict[str, int]]) -> None:
+        """Record a finished request's usage and return the unused part of its reservation."""
+        usage = usage or {}
+        if reserved:
+            self.store.refund(tenant, TOKENS, reserved - usage.get("total", 0))
+        self.store.record(tenant, usage)
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_quota_limiter() -> QuotaLimiter:
+    """Return the process-wide limiter, with its usage store at PSYDRAW_USAGE_DB (default: in the image store)."""
+    global _default_limiter
+    if _default_limiter is None:
+        with _default_limiter_lock:
+            if _default_limiter is None:
+                path = USAGE_DB or os.path.join(get_image_store().root, "usage.sqlite3")
+                _default_limiter = QuotaLimiter(UsageStore(path))
+    return _default_limiter
@@ -0,0 +1,50 @@
+import io
+import os
+import zipfile
+from typing import Any, Dict, List
+
+try:
+    from src.image_store import get_image_store
+    from src.model_langchain import report_text
+except ImportError:
+    from image_store import get_image_store
+    from model_langchain import report_text
+
+
+def report_docx(result: Dict[str, Any], disclaimer: str) -> bytes:
+    """The .docx report of one Batch page result."""
+    from docx import Document
+
+    doc = Document()
+    if result['success']:
+        doc.add_paragraph(disclaimer)
+        if result['analysis_result']['classification'] is True:
+            doc.add_paragraph(result['analysis_result']['signal'])
+            doc.add_paragraph(report_text(result['analysis_result'], 'final'))
+        else:
+            doc.add_paragraph(result['analysis_result']['fix_signal'])
+    else:
+        doc.add_paragraph("failed")
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def results_zip(results: List[Dict[str, Any]], disclaimer: str) -> bytes:
+    """
+    Zip of the Batch page results: <name>/<image> and <name>/<name>.docx per
+    drawing plus failed.txt. Built in memory; images are copied straight from
+    the image store without re-encoding.
+    """
+    store = get_image_store()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for result in results:
+            file_name = result['file_name']
+            file_name_without_ext = os.path.splitext(file_name)[0]
+            if result['image_ref']:
+                zipf.write(store.path(result['image_ref']), f"{file_name_without_ext}/{file_name}")
+            zipf.writestr(f"{file_name_without_ext}/{file_name_without_ext}.docx", report_docx(result, disclaimer))
+        failed = "".join(f"{result['file_name']}\n" for result in results if not result['success'])
+        zipf.writestr("failed.txt", failed)
+    return buffer.getvalue()
@@ -0,0 +1,59 @@
+import gzip
+import json
+import logging
+import os
+from typing import Any, Callable, Dict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _orjson_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+SERIALIZERS: Dict[str, Callable[[Any], bytes]] = {"json": _json_dumps}
+if orjson is not None:
+    SERIALIZERS["orjson"] = _orjson_dumps
+
+
+def _resolve(name: str) -> Callable[[Any], bytes]:
+    if name == "auto":
+        name = "orjson" if "orjson" in SERIALIZERS else "json"
+    if name not in SERIALIZERS:
+        logger.warning(f"JSON serializer '{name}' is not available, falling back to stdlib json")
+        name = "json"
+    return SERIALIZERS[name]
+
+
+# Selected once per process; override with PSYDRAW_JSON_SERIALIZER=json|orjson|auto
+_dumps = _resolve(os.getenv("PSYDRAW_JSON_SERIALIZER", "auto"))
+
+
+def register_serializer(name: str, func: Callable[[Any], bytes]) -> None:
+    """Register an additional serializer that returns UTF-8 encoded bytes."""
+    SERIALIZERS[name] = func
+
+
+def set_serializer(name: str) -> None:
+    """Switch the process-wide serializer."""
+    global _dumps
+    _dumps = _resolve(name)
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize obj to compact UTF-8 JSON bytes with the configured serializer."""
+    return _dumps(obj)
+
+
+def gzip_body(body: bytes, level: int = 1) -> bytes:
+    """Gzip a request body. Level 1 keeps the CPU cost low for base64 payloads."""
+    return gzip.compress(body, compresslevel=level)
@@ -0,0 +1,211 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+try:
+    from src.image_store import ORIGINAL, get_image_store, image_ref
+    from src.phash import drop_drawing_index
+except ImportError:
+    from image_store import ORIGINAL, get_image_store, image_ref
+    from phash import drop_drawing_index
+
+logger = logging.getLogger(__name__)
+
+# In-memory bytes kept per session before older images are spilled to the image store
+SESSION_MEMORY_LIMIT = int(os.getenv("PSYDRAW_SESSION_IMAGE_MEMORY", str(8 * 1024 * 1024)))
+# Idle sessions are evicted after this many seconds
+SESSION_TTL = float(os.getenv("PSYDRAW_SESSION_TTL", "3600"))
+
+
+class SessionImageManager:
+    """
+    Images owned by one user session.
+
+    Each image is kept as a single compact representation: the bytes of one
+    preprocessing profile from the image store. Recently used images stay in
+    memory; once the session exceeds its memory limit the least recently used
+    ones are spilled, which only drops the in-memory copy because the store
+    already has them on disk. The model reads images by store reference, so
+    they are stored as transient holds of the session and deleted from disk
+    when it drops them or ends.
+    """
+
+    def __init__(self, session_id: str, memory_limit: int = SESSION_MEMORY_LIMIT):
+        self.session_id = session_id
+        self.memory_limit = memory_limit
+        self.last_access = time.monotonic()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _touch(self):
+        self.last_access = time.monotonic()
+
+    def add(self, name: str, data: bytes, profile: str = ORIGINAL) -> str:
+        """Store an image under name (replacing any previous one) and return its reference."""
+        store = get_image_store()
+        digest = hashlib.sha256(data).hexdigest()
+        entry = self._entries.get(name)
+        if entry is not None and entry["digest"] == digest and entry["profile"] == profile:
+            # Same image re-submitted on a rerun, nothing to decode or copy
+            self._touch()
+            return image_ref(digest, profile)
+        # The session holds the stored image until the entry is dropped
+        store.put(data, transient=True)
+        compact = data if profile == ORIGINAL else store.read(digest, profile)
+        with self._lock:
+            self._touch()
+            previous = self._entries.pop(name, None)
+            self._entries[name] = {"digest": digest, "profile": profile, "data": compact, "size": len(compact)}
+            self._spill()
+        if previous is not None:
+            store.release(previous["digest"])
+        return image_ref(digest, profile)
+
+    def _spill(self):
+        in_memory = self._memory_usage()
+        for entry in self._entries.values():
+            if in_memory <= self.memory_limit:
+                break
+            if entry["data"] is not None:
+                entry["data"] = None
+                in_memory -= entry["size"]
+
+    def get_bytes(self, name: str) -> Optional[bytes]:
+        """Return the image bytes, reading spilled images back from the store."""
+        with self._lock:
+            self._touch()
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(name)
+            if entry["data"] is not None:
+                return entry["data"]
+        return get_image_store().read(entry["digest"], entry["profile"])
+
+    def ref(self, name: str, profile: Optional[str] = None) -> Optional[str]:
+        """Return the image reference to pass to HTPModel.workflow."""
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        return image_ref(entry["digest"], profile or entry["profile"])
+
+    def digest(self, name: str) -> Optional[str]:
+        entry = self._entries.get(name)
+        return entry["digest"] if entry else None
+
+    def names(self) -> List[str]:
+        return list(self._entries)
+
+    def remove(self, name: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(name, None)
+        if entry is not None:
+            get_image_store().release(entry["digest"])
+
+    def clear(self) -> None:
+        """Drop every image, deleting the stored files no other session holds."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        store = get_image_store()
+        for entry in entries:
+            store.release(entry["digest"])
+
+    def close(self) -> None:
+        """Drop everything the session left on disk: its images and its duplicate index."""
+        self.clear()
+        drop_drawing_index(self.session_id)
+
+    def _memory_usage(self) -> int:
+        return sum(entry["size"] for entry in self._entries.values() if entry["data"] is not None)
+
+    def memory_usage(self) -> int:
+        """Bytes of image data this session currently holds in memory."""
+        with self._lock:
+            return self._memory_usage()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "images": len(self._entries),
+                "in_memory": sum(1 for entry in self._entries.values() if entry["data"] is not None),
+                "memory_bytes": self._memory_usage(),
+            }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SessionRegistry:
+    """Process-wide registry of session image managers, used for TTL eviction and reporting."""
+
+    def __init__(self, ttl: float = SESSION_TTL):
+        self.ttl = ttl
+        self._sessions: Dict[str, SessionImageManager] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> SessionImageManager:
+        with self._lock:
+            manager = self._sessions.get(session_id)
+            if manager is None:
+                manager = SessionImageManager(session_id)
+                self._sessions[session_id] = manager
+            return manager
+
+    def evict(self, is_active=None) -> int:
+        """Drop sessions that are idle past the TTL or that is_active(session_id) reports as ended."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                session_id for session_id, manager in self._sessions.items()
+                if now - manager.last_access > self.ttl or (is_active is not None and not is_active(session_id))
+            ]
+            for session_id in expired:
+                self._sessions.pop(session_id).close()
+        if expired:
+            logger.info(f"Evicted images of {len(expired)} ended or idle session(s)")
+        return len(expired)
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        """Per-session memory usage."""
+        with self._lock:
+            managers = list(self._sessions.values())
+        return {manager.session_id: manager.stats() for manager in managers}
+
+
+_registry = SessionRegistry()
+
+
+def get_session_registry() -> SessionRegistry:
+    return _registry
+
+
+def _streamlit_session_id() -> str:
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+        if ctx is not None:
+            return ctx.session_id
+    except ImportError:
+        pass
+    return "local"
+
+
+def _streamlit_is_active(session_id: str) -> bool:
+    try:
+        from streamlit import runtime
+        if runtime.exists():
+            return runtime.get_instance().is_active_session(session_id)
+    except (ImportError, AttributeError):
+        pass
+    return True
+
+
+def get_session_images() -> SessionImageManager:
+    """Return the image manager of the current Streamlit session, evicting ended sessions first."""
+    _registry.evict(_streamlit_is_active)
+    return _registry.get(_streamlit_session_id())
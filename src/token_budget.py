@@ -0,0 +1,247 @@
+import base64
+import json
+import logging
+import math
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from io import BytesIO
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Hard ceiling per drawing for any stage, the value every call used to reserve
+MAX_OUTPUT_TOKENS = int(os.getenv("PSYDRAW_MAX_OUTPUT_TOKENS", "4096"))
+# Output limit of the model itself, caps packed multi-drawing calls
+MODEL_OUTPUT_LIMIT = int(os.getenv("PSYDRAW_MODEL_OUTPUT_LIMIT", "16384"))
+# Caps used until a stage has MIN_SAMPLES observations
+STAGE_DEFAULTS = {
+    "multimodal": 2048,
+    "text": 2048,
+    "structured_multimodal": 2048,
+    "structured_text": 2048,
+    "merge": 2048,
+    "final": 2048,
+    "signal": 512,
+    "classification": 16,
+}
+MIN_SAMPLES = 20
+# Observed completion lengths kept per stage
+WINDOW = 500
+PERCENTILE = 0.99
+HEADROOM = 1.25
+MIN_OUTPUT_TOKENS = 16
+# "heuristic" (default, no dependencies) or "tiktoken" (needs the encoding files available locally)
+TOKENIZER = os.getenv("PSYDRAW_TOKENIZER", "heuristic")
+# Base64 characters decoded to read image dimensions, enough for the headers the image store writes
+_HEADER_CHARS = 64 * 1024
+
+# Per-message framing tokens of the chat format
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if TOKENIZER != "tiktoken":
+        return None
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable, using the heuristic token estimate: {e}")
+        return None
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Estimate the tokens of a text: tiktoken when configured, otherwise ~4 characters per token (1 per CJK character)."""
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    non_ascii = sum(1 for char in text if ord(char) > 0x2E7F)
+    return math.ceil((len(text) - non_ascii) / 4) + non_ascii
+
+
+def image_dimensions(data_url: str) -> Optional[Tuple[int, int]]:
+    """Width and height of a base64 data URL image, read from its header without decoding the pixels."""
+    from PIL import Image
+
+    # Slice from the comma instead of splitting, which would copy the whole payload
+    start = data_url.find(",") + 1
+    for chars in (_HEADER_CHARS, len(data_url) - start):
+        try:
+            head = base64.b64decode(data_url[start:start + chars - chars % 4])
+            return Image.open(BytesIO(head)).size
+        except Exception:
+            continue
+    return None
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """
+    Input tokens of an image in GPT-4o style tiling: 85 base tokens plus 170
+    per 512px tile, after fitting into 2048x2048 and scaling the short side to 768.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_content_tokens(content: Any) -> int:
+    if isinstance(content, str):
+        return estimate_text_tokens(content)
+    tokens = 0
+    for item in content or []:
+        if isinstance(item, str):
+            tokens += estimate_text_tokens(item)
+        elif item.get("type") == "text":
+            tokens += estimate_text_tokens(item.get("text", ""))
+        elif item.get("type") == "image_url":
+            image_url = item.get("image_url") or {}
+            url = image_url.get("url", "") if isinstance(image_url, dict) else image_url
+            detail = image_url.get("detail", "auto") if isinstance(image_url, dict) else "auto"
+            size = image_dimensions(url) if url.startswith("data:") else None
+            # Unknown sizes are charged as the largest image the tiling allows
+            tokens += estimate_image_tokens(*size, detail) if size else estimate_image_tokens(768, 2048, detail)
+    return tokens
+
+
+def estimate_input_tokens(messages: List[Any]) -> int:
+    """Estimate the prompt tokens of LangChain messages or OpenAI-format message dicts."""
+    tokens = REPLY_OVERHEAD
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else message.content
+        tokens += MESSAGE_OVERHEAD + estimate_content_tokens(content)
+    return tokens
+
+
+class Reservation:
+    """Tokens one call may consume: its estimated input plus its max_tokens."""
+
+    def __init__(self, stage: str, input_tokens: int, max_tokens: int):
+        self.stage = stage
+        self.input_tokens = input_tokens
+        self.max_tokens = max_tokens
+
+    @property
+    def total(self) -> int:
+        return self.input_tokens + self.max_tokens
+
+    def __repr__(self) -> str:
+        return f"Reservation({self.stage}, input={self.input_tokens}, max_tokens={self.max_tokens})"
+
+
+class TokenBudgetPlanner:
+    """
+    Per-stage token budgets.
+
+    max_tokens of a stage is the PERCENTILE of its recently observed completion
+    lengths times HEADROOM, clamped to [MIN_OUTPUT_TOKENS, ceiling()];
+    until a stage has MIN_SAMPLES observations its STAGE_DEFAULTS value is used.
+    Truncated completions are recorded at twice the cap they hit, so a stage
+    whose outputs grow widens its budget quickly. Calls in flight hold a
+    Reservation, and reserved_tokens() is what a rate-limited scheduler should
+    count against its tokens-per-minute budget.
+    """
+
+    def __init__(self, stats_path: Optional[str] = None):
+        self.stats_path = stats_path
+        self._samples: Dict[str, deque] = {}
+        self._active: Dict[int, Reservation] = {}
+        self._lock = threading.Lock()
+        if stats_path and os.path.exists(stats_path):
+            self.load(stats_path)
+
+    def max_tokens(self, stage: str, items: int = 1) -> int:
+        """Output budget of one call of stage; items scales it for packed multi-drawing calls."""
+        with self._lock:
+            samples = sorted(self._samples.get(stage, ()))
+        if len(samples) < MIN_SAMPLES:
+            per_item = STAGE_DEFAULTS.get(stage, MAX_OUTPUT_TOKENS)
+        else:
+            per_item = math.ceil(samples[min(len(samples) - 1, int(PERCENTILE * len(samples)))] * HEADROOM)
+        return max(MIN_OUTPUT_TOKENS, min(self.ceiling(items), per_item * items))
+
+    @staticmethod
+    def ceiling(items: int = 1) -> int:
+        """Largest max_tokens a call for items drawings may get."""
+        return min(MODEL_OUTPUT_LIMIT, MAX_OUTPUT_TOKENS * items)
+
+    def plan(self, stage: str, messages: List[Any], items: int = 1) -> Reservation:
+        return Reservation(stage, estimate_input_tokens(messages), self.max_tokens(stage, items))
+
+    @contextmanager
+    def reserve(self, stage: str, messages: List[Any], items: int = 1) -> Iterator[Reservation]:
+        """Plan a call and hold its reservation while the call is in flight."""
+        reservation = self.plan(stage, messages, items)
+        with self._lock:
+            self._active[id(reservation)] = reservation
+        try:
+            yield reservation
+        finally:
+            with self._lock:
+                self._active.pop(id(reservation), None)
+
+    def reserved_tokens(self) -> int:
+        """Tokens reserved by calls currently in flight."""
+        with self._lock:
+            return sum(reservation.total for reservation in self._active.values())
+
+    def reservations(self) -> List[Reservation]:
+        with self._lock:
+            return list(self._active.values())
+
+    def observe(self, stage: str, completion_tokens: int, truncated: bool = False, max_tokens: Optional[int] = None, items: int = 1) -> None:
+        """Record the output length of a finished call (per item for packed calls)."""
+        if truncated and max_tokens:
+            completion_tokens = max(completion_tokens, 2 * max_tokens)
+            logger.warning(f"{stage} output hit max_tokens={max_tokens}, widening its budget")
+        if completion_tokens <= 0:
+            return
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=WINDOW)).append(math.ceil(completion_tokens / items))
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            stages = {stage: sorted(samples) for stage, samples in self._samples.items()}
+        return {
+            stage: {"samples": len(samples), "p50": samples[len(samples) // 2], "max": samples[-1], "max_tokens": self.max_tokens(stage)}
+            for stage, samples in stages.items() if samples
+        }
+
+    def load(self, path: str) -> None:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        with self._lock:
+            for stage, samples in saved.items():
+                self._samples[stage] = deque(samples, maxlen=WINDOW)
+
+    def save(self, path: Optional[str] = None) -> None:
+        """Persist the observed lengths so a restarted process starts from them instead of the defaults."""
+        path = path or self.stats_path
+        if not path:
+            return
+        with self._lock:
+            saved = {stage: list(samples) for stage, samples in self._samples.items()}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(saved, f)
+
+
+_default_planner = None
+_default_planner_lock = threading.Lock()
+
+
+def get_token_budget_planner() -> TokenBudgetPlanner:
+    """Return the process-wide planner, loaded from PSYDRAW_TOKEN_STATS when set."""
+    global _default_planner
+    if _default_planner is None:
+        with _default_planner_lock:
+            if _default_planner is None:
+                _default_planner = TokenBudgetPlanner(os.getenv("PSYDRAW_TOKEN_STATS"))
+    return _default_planner
@@ -0,0 +1,140 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# Append finished traces to this file in Chrome trace-event format (chrome://tracing, Perfetto, speedscope)
+TRACE_FILE = os.getenv("PSYDRAW_TRACE_FILE")
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("psydraw_span", default=None)
+_export_lock = threading.Lock()
+
+
+class Span:
+    """A timed section of a trace with attributes and child spans."""
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, **attrs: Any):
+        self.name = name
+        self.parent = parent
+        self.attrs: Dict[str, Any] = dict(attrs)
+        self.children: List["Span"] = []
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def add_child(self, child: "Span") -> None:
+        # Children may be added from worker threads that carry this span's context
+        with self._lock:
+            self.children.append(child)
+
+    @property
+    def duration_ms(self) -> float:
+        end = time.perf_counter() if self.end is None else self.end
+        return (end - self.start) * 1000
+
+    def walk(self) -> Iterator["Span"]:
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def __repr__(self) -> str:
+        return f"Span({self.name}, {self.duration_ms:.1f}ms, {len(self.children)} children)"
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[Span]]:
+    """
+    Time the block as a child of the current span. Outside of a trace this
+    does nothing and yields None, so instrumented code costs nothing untraced.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent, **attrs)
+    parent.add_child(child)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.set(error=type(e).__name__)
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current.reset(token)
+
+
+@contextmanager
+def trace(name: str, **attrs: Any) -> Iterator[Span]:
+    """
+    Start a trace rooted at a new span (nested inside the current one if any),
+    and export it to TRACE_FILE when it is a root and finishes.
+    """
+    parent = _current.get()
+    root = Span(name, parent, **attrs)
+    if parent is not None:
+        parent.add_child(root)
+    token = _current.set(root)
+    try:
+        yield root
+    finally:
+        root.end = time.perf_counter()
+        _current.reset(token)
+        if parent is None and TRACE_FILE:
+            export_chrome_trace(root, TRACE_FILE)
+
+
+def trace_summary(root: Span) -> Dict[str, Any]:
+    """Compact per-result summary: total time and the time of each span name, summed."""
+    spans: Dict[str, Dict[str, float]] = {}
+    for item in root.walk():
+        if item is root:
+            continue
+        entry = spans.setdefault(item.name, {"count": 0, "ms": 0.0})
+        entry["count"] += 1
+        entry["ms"] += item.duration_ms
+    for entry in spans.values():
+        entry["ms"] = round(entry["ms"], 2)
+    return {"name": root.name, "total_ms": round(root.duration_ms, 2), "spans": spans}
+
+
+def chrome_trace_events(root: Span) -> List[Dict[str, Any]]:
+    """Complete ("X") events of every span, timestamps in microseconds."""
+    pid = os.getpid()
+    return [
+        {
+            "name": item.name,
+            "ph": "X",
+            "ts": round(item.start * 1e6, 1),
+            "dur": round(item.duration_ms * 1000, 1),
+            "pid": pid,
+            "tid": item.thread_id,
+            "args": item.attrs,
+        }
+        for item in root.walk()
+    ]
+
+
+def export_chrome_trace(root: Span, path: str) -> None:
+    """
+    Append a trace to path in the JSON array trace-event format. The array is
+    left open so traces can be appended; trace viewers accept that.
+    """
+    lines = "".join(json.dumps(event, default=str) + ",\n" for event in chrome_trace_events(root))
+    with _export_lock:
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a", encoding="utf-8") as f:
+            if new_file:
+                f.write("[\n")
+            f.write(lines)
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+# Keep the tests' images and usage counters out of the real store; set before src is imported
+os.environ.setdefault("PSYDRAW_IMAGE_STORE", os.path.join(tempfile.mkdtemp(prefix="psydraw-tests-"), "images"))
@@ -0,0 +1,201 @@
+import json
+import os
+
+import pytest
+from PIL import Image
+
+from src.batch_jobs import (
+    BatchProvider,
+    BatchScreening,
+    LocalBatchProvider,
+    parse_output_line,
+    request_line,
+    write_request_files,
+)
+from src.custom_chat_openai import ChatOpenAI
+from src.model_langchain import HTPModel
+
+MULTIMODAL_TEXT = "Initial analysis of the drawing."
+TEXT_TEXT = "Deeper educational interpretation."
+
+
+def stage_of(body):
+    """The stage of a request body: "multimodal" when it carries an image, "text" otherwise."""
+    for message in body["messages"]:
+        if isinstance(message["content"], list) and any(item.get("type") == "image_url" for item in message["content"]):
+            return "multimodal"
+    return "text"
+
+
+def drawing_of(body):
+    """The data URL of a request body's image, None for text requests."""
+    for message in body["messages"]:
+        if isinstance(message["content"], list):
+            for item in message["content"]:
+                if item.get("type") == "image_url":
+                    return item["image_url"]["url"]
+    return None
+
+
+class RecordingProvider(LocalBatchProvider):
+    """LocalBatchProvider that counts submissions and can hold batches of a stage open forever."""
+
+    def __init__(self, handler=None, stuck_stage=None):
+        super().__init__(handler or self.answer)
+        self.stuck_stage = stuck_stage
+        self.submitted = []
+        self.cancelled = []
+
+    @staticmethod
+    def answer(body):
+        return MULTIMODAL_TEXT if stage_of(body) == "multimodal" else TEXT_TEXT
+
+    def submit(self, requests_path, metadata=None):
+        batch_id = super().submit(requests_path, metadata)
+        self.submitted.append((batch_id, metadata["psydraw_stage"]))
+        return batch_id
+
+    def retrieve(self, batch_id):
+        stage = dict(self.submitted).get(batch_id)
+        with self._lock:
+            batch = self._batches[batch_id]
+            if stage == self.stuck_stage and batch["status"] != "cancelled":
+                batch["status"] = "in_progress"
+                return {key: value for key, value in batch.items() if key not in ("input", "output")}
+        return super().retrieve(batch_id)
+
+    def cancel(self, batch_id):
+        self.cancelled.append(batch_id)
+        super().cancel(batch_id)
+
+
+@pytest.fixture
+def model():
+    client = ChatOpenAI(api_key="test", model_name="gpt-4o")
+    return HTPModel(text_model=client, multimodal_model=client)
+
+
+@pytest.fixture
+def drawings(tmp_path):
+    paths = []
+    for i, color in enumerate(["red", "green", "blue"]):
+        path = str(tmp_path / f"drawing_{i}.png")
+        Image.new("RGB", (64, 64), color).save(path)
+        paths.append(path)
+    return paths
+
+
+def screening(model, provider, tmp_path, **kwargs):
+    return BatchScreening(model, provider, str(tmp_path / "work"), poll_interval=0, **kwargs)
+
+
+def test_batch_provider_is_abstract():
+    with pytest.raises(TypeError):
+        BatchProvider()
+
+
+def test_local_provider_round_trip(tmp_path):
+    def handler(body):
+        if body["model"] == "bad":
+            raise ValueError("rejected")
+        return f"answer from {body['model']}"
+
+    lines = [request_line(f"r-{i}", {"model": model, "messages": []}) for i, model in enumerate(["a", "bad", "c"])]
+    paths = write_request_files(lines, str(tmp_path / "requests"))
+    provider = LocalBatchProvider(handler)
+    batch_id = provider.submit(paths[0])
+
+    assert provider.retrieve(batch_id)["status"] == "in_progress"
+    batch = provider.wait(batch_id, poll_interval=0)
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 3, "completed": 2, "failed": 1}
+
+    outputs = provider.results(batch_id)
+    assert parse_output_line(outputs["r-0"])[0] == "answer from a"
+    content, usage, error = parse_output_line(outputs["r-1"])
+    assert content is None and usage == {} and error == "rejected"
+
+
+def test_request_files_respect_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr("src.batch_jobs.MAX_BATCH_REQUESTS", 2)
+    lines = [request_line(f"r-{i}", {"model": "m", "messages": []}) for i in range(5)]
+    paths = write_request_files(lines, str(tmp_path / "requests"))
+    counts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            counts.append([json.loads(line)["custom_id"] for line in f])
+    assert counts == [["r-0", "r-1"], ["r-2", "r-3"], ["r-4"]]
+
+
+def test_screening_runs_both_stages(model, drawings, tmp_path):
+    provider = RecordingProvider()
+    results = screening(model, provider, tmp_path).run(drawings)
+
+    assert [stage for _, stage in provider.submitted] == ["multimodal", "text"]
+    assert [result["status"] for result in results] == ["ok"] * 3
+    assert all(result["merge"] == MULTIMODAL_TEXT and result["final"] == TEXT_TEXT for result in results)
+    assert all(result["image_ref"].startswith("sha256:") for result in results)
+
+
+def test_failed_output_lines_fail_only_their_drawing(model, drawings, tmp_path):
+    failing_url = None
+
+    def handler(body):
+        nonlocal failing_url
+        url = drawing_of(body)
+        if url is not None and failing_url is None:
+            failing_url = url
+        if url is not None and url == failing_url:
+            raise RuntimeError("content policy violation")
+        return RecordingProvider.answer(body)
+
+    provider = RecordingProvider(handler)
+    results = screening(model, provider, tmp_path).run(drawings)
+
+    assert [result["status"] for result in results] == ["error", "ok", "ok"]
+    assert "content policy violation" in results[0]["final"]
+    # The failed drawing gets no text-stage request
+    text_batch = [batch_id for batch_id, stage in provider.submitted if stage == "text"][0]
+    assert sorted(provider.results(text_batch)) == ["drawing-1", "drawing-2"]
+
+
+def test_resume_from_state_does_not_resubmit(model, drawings, tmp_path):
+    provider = RecordingProvider()
+    first = screening(model, provider, tmp_path).run(drawings)
+    with open(tmp_path / "work" / "state.json", "r", encoding="utf-8") as f:
+        state = json.load(f)
+    assert set(state["stages"]) == {"multimodal", "text"}
+
+    second = screening(model, provider, tmp_path).run(drawings)
+    assert len(provider.submitted) == 2
+    assert [result["final"] for result in second] == [result["final"] for result in first]
+
+
+def test_state_of_other_drawings_is_ignored(model, drawings, tmp_path):
+    provider = RecordingProvider()
+    screening(model, provider, tmp_path).run(drawings)
+    screening(model, provider, tmp_path).run(drawings[:2])
+    assert len(provider.submitted) == 4
+
+
+def test_deadline_in_second_stage_keeps_partial_results(model, drawings, tmp_path):
+    provider = RecordingProvider(stuck_stage="text")
+    results = screening(model, provider, tmp_path, deadline=0.3).run(drawings)
+
+    assert [result["status"] for result in results] == ["partial"] * 3
+    assert all(result["merge"] == MULTIMODAL_TEXT for result in results)
+    text_batches = [batch_id for batch_id, stage in provider.submitted if stage == "text"]
+    assert provider.cancelled == text_batches
+    # The cancelled stage is dropped from the state, so a later run submits it again
+    with open(tmp_path / "work" / "state.json", "r", encoding="utf-8") as f:
+        assert set(json.load(f)["stages"]) == {"multimodal"}
+
+
+def test_deadline_in_first_stage_times_out(model, drawings, tmp_path):
+    provider = RecordingProvider(stuck_stage="multimodal")
+    results = screening(model, provider, tmp_path, deadline=0.3).run(drawings)
+
+    assert [result["status"] for result in results] == ["timeout"] * 3
+    assert [stage for _, stage in provider.submitted] == ["multimodal"]
+    assert len(provider.cancelled) == 1
+    assert not os.path.exists(tmp_path / "work" / "text-0.jsonl")
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+import requests
+
+import src.custom_chat_openai as custom_chat_openai
+from src.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+from src.custom_chat_openai import ChatOpenAI
+from src.deadline import DeadlineExceeded, deadline_scope
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker("upstream", failure_threshold=3, recovery_timeout=30, clock=clock)
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.before_call()
+        breaker.record_failure()
+
+
+def test_opens_after_consecutive_failures(breaker):
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.failures == 0
+
+    open_breaker(breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == 30
+
+
+def test_half_open_after_recovery_timeout(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(29)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.advance(1)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+def test_half_open_lets_one_probe_through(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(30)
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_successful_probe_closes(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(30)
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+    breaker.before_call()
+
+
+def test_failed_probe_reopens(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(30)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock.advance(29)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock.advance(1)
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+
+
+def test_released_probe_lets_the_next_one_through(breaker, clock):
+    open_breaker(breaker)
+    clock.advance(30)
+    breaker.before_call()
+    breaker.release()
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()
+
+
+class TimingOutSession:
+    def post(self, url, **kwargs):
+        time.sleep(0.1)
+        raise requests.ReadTimeout("read timed out")
+
+
+def test_probe_is_released_when_the_deadline_expires(breaker, clock, monkeypatch):
+    monkeypatch.setattr(custom_chat_openai, "get_circuit_breaker", lambda name: breaker)
+    client = ChatOpenAI(api_key="test", model_name="gpt-4o")
+    monkeypatch.setattr(client, "_get_session", lambda: TimingOutSession())
+    open_breaker(breaker)
+    clock.advance(30)
+
+    with deadline_scope(0.05):
+        with pytest.raises(DeadlineExceeded):
+            client._make_direct_api_call([{"role": "user", "content": "Analyze"}], "gpt-4o")
+    # Our own deadline says nothing about the upstream: still half-open, and the probe is free again
+    assert breaker.state == HALF_OPEN
+    breaker.before_call()
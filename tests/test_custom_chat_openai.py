@@ -0,0 +1,16 @@
+import pytest
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError
+
+from src.custom_chat_openai import DeadlineRetry
+from src.deadline import deadline_scope
+
+
+def test_retries_without_deadline():
+    retry = DeadlineRetry(total=3).increment(method="POST", url="/", error=ConnectTimeoutError())
+    assert retry.total == 2
+
+
+def test_no_retries_under_deadline():
+    with deadline_scope(60):
+        with pytest.raises(MaxRetryError):
+            DeadlineRetry(total=3).increment(method="POST", url="/", error=ConnectTimeoutError())
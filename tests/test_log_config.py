@@ -0,0 +1,35 @@
+import argparse
+import logging
+
+import pytest
+
+from src.log_config import add_log_arguments, configure_logging, log_level
+
+
+@pytest.fixture
+def restore_root():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_levels_are_case_insensitive(restore_root):
+    assert log_level(" debug ") == "DEBUG"
+    configure_logging("debug", force=True)
+    assert restore_root.level == logging.DEBUG
+
+
+def test_unknown_level_is_rejected():
+    with pytest.raises(ValueError, match="Unknown log level"):
+        log_level("verbose")
+
+
+def test_cli_option_accepts_any_case():
+    parser = argparse.ArgumentParser()
+    add_log_arguments(parser)
+    assert parser.parse_args(["--log_level", "warning"]).log_level == "WARNING"
+    assert parser.parse_args([]).log_level is None
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--log_level", "verbose"])
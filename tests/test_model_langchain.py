@@ -0,0 +1,140 @@
+import json
+import time
+
+import pytest
+from langchain_core.messages import AIMessage
+from PIL import Image
+
+from src.deadline import DeadlineExceeded, deadline_scope
+from src.model_langchain import HTPModel, parse_packed_response
+
+ANALYSIS_TEXT = "The house has a large door and open windows, the tree is full and the person is smiling. " * 3
+DEEPER_TEXT = "The drawing suggests a secure and socially open child."
+
+
+class FakeChatModel:
+    """Answers every call with content after delay seconds, recording the messages it got."""
+
+    def __init__(self, content, delay=0.0):
+        self.content = content
+        self.delay = delay
+        self.calls = []
+
+    def invoke(self, messages, **kwargs):
+        self.calls.append(messages)
+        time.sleep(self.delay)
+        content = self.content(messages) if callable(self.content) else self.content
+        return AIMessage(content=content, response_metadata={
+            "token_usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150},
+            "finish_reason": "stop",
+        })
+
+
+def image_count(messages) -> int:
+    return sum(1 for item in messages[0].content if item.get("type") == "image_url")
+
+
+def packed(*ids: str) -> str:
+    return json.dumps({"drawings": [{"id": drawing_id, "analysis": ANALYSIS_TEXT} for drawing_id in ids]})
+
+
+@pytest.fixture
+def drawing(tmp_path):
+    path = str(tmp_path / "drawing.png")
+    Image.new("RGB", (64, 64), "white").save(path)
+    return path
+
+
+@pytest.fixture
+def drawings(tmp_path):
+    paths = []
+    for i, color in enumerate(["white", "red", "green", "blue"]):
+        path = str(tmp_path / f"drawing_{i}.png")
+        Image.new("RGB", (64, 64), color).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_workflow_runs_both_stages(drawing):
+    model = HTPModel(text_model=FakeChatModel(DEEPER_TEXT), multimodal_model=FakeChatModel(ANALYSIS_TEXT))
+    results = model.workflow(drawing)
+    assert results["status"] == "ok"
+    assert results["merge"] == ANALYSIS_TEXT and results["final"] == DEEPER_TEXT
+
+
+def test_slow_model_ends_in_timeout(drawing):
+    text_model = FakeChatModel(DEEPER_TEXT, delay=0.5)
+    model = HTPModel(text_model=text_model, multimodal_model=FakeChatModel(ANALYSIS_TEXT, delay=0.5))
+    started = time.monotonic()
+    results = model.workflow(drawing, timeout=0.2)
+    assert results["status"] == "timeout"
+    # The late first response is dropped and the text stage never starts
+    assert time.monotonic() - started < 1.0
+    assert text_model.calls == []
+
+
+def test_expired_deadline_keeps_first_stage(drawing):
+    model = HTPModel(text_model=FakeChatModel(DEEPER_TEXT, delay=0.5), multimodal_model=FakeChatModel(ANALYSIS_TEXT))
+    results = model.workflow(drawing, timeout=0.2)
+    assert results["status"] == "partial"
+    assert results["merge"] == ANALYSIS_TEXT
+
+
+def test_stage_is_not_started_after_the_deadline(drawing):
+    multimodal_model = FakeChatModel(ANALYSIS_TEXT)
+    model = HTPModel(text_model=FakeChatModel(DEEPER_TEXT), multimodal_model=multimodal_model)
+    with deadline_scope(0.01):
+        time.sleep(0.02)
+        with pytest.raises(DeadlineExceeded):
+            model.multimodal_stage("data:image/png;base64,AAAA")
+    assert multimodal_model.calls == []
+
+
+def test_packed_response_in_a_fence_is_parsed():
+    text = "Here are the analyses:\n```json\n" + packed("0", "1") + "\n```"
+    assert parse_packed_response(text, ["0", "1"]) == {"0": ANALYSIS_TEXT.strip(), "1": ANALYSIS_TEXT.strip()}
+
+
+def test_truncated_packed_response_keeps_complete_entries():
+    text = packed("0", "1", "2")
+    cut = text[:text.rindex('{"id"') + 40]
+    assert parse_packed_response(cut, ["0", "1", "2"]) == {"0": ANALYSIS_TEXT.strip(), "1": ANALYSIS_TEXT.strip()}
+
+
+def test_invalid_packed_entries_are_left_out():
+    text = json.dumps({"drawings": [
+        {"id": "0", "analysis": ANALYSIS_TEXT},
+        {"id": "0", "analysis": "A second answer for the same drawing. " * 10},
+        {"id": "1", "analysis": "Too short."},
+        {"id": "2", "analysis": 42},
+        {"id": "9", "analysis": ANALYSIS_TEXT},
+    ]})
+    assert parse_packed_response(text, ["0", "1", "2"]) == {"0": ANALYSIS_TEXT.strip()}
+
+
+def test_malformed_packed_response_is_empty():
+    assert parse_packed_response("I cannot analyze these drawings.", ["0", "1"]) == {}
+    assert parse_packed_response('{"id": "0", "analysis": "unterminated', ["0"]) == {}
+
+
+def test_missing_packed_drawings_fall_back_to_single_calls(drawings):
+    multimodal_model = FakeChatModel(lambda messages: packed("0", "2") if image_count(messages) > 1 else ANALYSIS_TEXT)
+    model = HTPModel(text_model=FakeChatModel(DEEPER_TEXT), multimodal_model=multimodal_model)
+    results = model.pack_workflow(drawings, pack_size=4)
+    assert [result["status"] for result in results] == ["ok"] * 4
+    assert all(result["final"] == DEEPER_TEXT for result in results)
+    # One packed call, then drawings 1 and 3 on their own
+    assert [image_count(messages) for messages in multimodal_model.calls] == [4, 1, 1]
+
+
+def test_failed_packed_call_falls_back_for_every_drawing(drawings):
+    def answer(messages):
+        if image_count(messages) > 1:
+            raise ValueError("upstream returned garbage")
+        return ANALYSIS_TEXT
+
+    multimodal_model = FakeChatModel(answer)
+    model = HTPModel(text_model=FakeChatModel(DEEPER_TEXT), multimodal_model=multimodal_model)
+    results = model.pack_workflow(drawings, pack_size=4)
+    assert [result["status"] for result in results] == ["ok"] * 4
+    assert [image_count(messages) for messages in multimodal_model.calls] == [4, 1, 1, 1, 1]
@@ -0,0 +1,25 @@
+import json
+
+from src.payload import SPLICE_THRESHOLD, encode_chat_body
+
+
+def data_url(fill: str) -> str:
+    return "data:image/png;base64," + fill * SPLICE_THRESHOLD
+
+
+def test_spliced_body_matches_json():
+    body = {"model": "gpt-4o", "messages": [{"role": "user", "content": [
+        {"type": "text", "text": "Analyze"},
+        {"type": "image_url", "image_url": {"url": data_url("A")}},
+        {"type": "image_url", "image_url": {"url": data_url("B")}},
+    ]}]}
+    assert json.loads(encode_chat_body(body)) == body
+
+
+def test_placeholder_lookalikes_in_text_are_left_alone():
+    text = 'user text with __psydraw_image_0__ and "__psydraw_image_0__"'
+    body = {"model": "gpt-4o", "language": "__psydraw_image_0__", "messages": [{"role": "user", "content": [
+        {"type": "text", "text": text},
+        {"type": "image_url", "image_url": {"url": data_url("A")}},
+    ]}]}
+    assert json.loads(encode_chat_body(body)) == body
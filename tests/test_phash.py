@@ -0,0 +1,82 @@
+import itertools
+import random
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw
+
+from src.image_store import get_image_store
+from src.phash import DUPLICATE_DISTANCE, DrawingIndex, get_drawing_index, hamming, phash
+
+RESULT = {"status": "ok", "final": "report"}
+
+
+def htp_drawing(seed, size=400):
+    """A sparse house/tree/person line drawing, laid out at random."""
+    r = random.Random(seed)
+    image = Image.new("L", (size, size), 255)
+    draw = ImageDraw.Draw(image)
+    w = r.randint(2, 3)
+    x, y, s = r.randint(15, 150), r.randint(150, 250), r.randint(75, 150)
+    draw.rectangle((x, y, x + s, y + s), outline=0, width=w)
+    draw.line((x, y, x + s // 2, y - s // 2, x + s, y), fill=0, width=w)
+    draw.rectangle((x + s // 3, y + s // 2, x + 2 * s // 3, y + s), outline=0, width=w)
+    tx, ty = r.randint(225, 325), r.randint(100, 200)
+    draw.line((tx, ty, tx, ty + r.randint(75, 150)), fill=0, width=w)
+    crown = r.randint(25, 60)
+    draw.ellipse((tx - crown, ty - 2 * crown, tx + crown, ty), outline=0, width=w)
+    px, py = r.randint(150, 350), r.randint(275, 325)
+    draw.ellipse((px - 10, py - 20, px + 10, py), outline=0, width=w)
+    draw.line((px, py, px, py + 40), fill=0, width=w)
+    draw.line((px - 20, py + 15, px + 20, py + 15), fill=0, width=w)
+    return image
+
+
+def encode(image, fmt="PNG", **kwargs):
+    buffer = BytesIO()
+    image.convert("RGB").save(buffer, fmt, **kwargs)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def index(tmp_path):
+    return DrawingIndex(str(tmp_path / "index"))
+
+
+def test_distinct_drawings_are_far_apart():
+    hashes = [phash(encode(htp_drawing(seed))) for seed in range(60)]
+    assert min(hamming(a, b) for a, b in itertools.combinations(hashes, 2)) > 2 * DUPLICATE_DISTANCE
+
+
+def test_distinct_drawings_never_reuse_a_report(index):
+    store = get_image_store()
+    digests = [store.put(encode(htp_drawing(seed))) for seed in range(30)]
+    for digest in digests[:15]:
+        index.add(digest, RESULT)
+    assert all(index.find(digest) is None for digest in digests[15:])
+
+
+def test_hash_matches_are_confirmed_by_pixels(index):
+    store = get_image_store()
+    first, other = store.put(encode(htp_drawing(1))), store.put(encode(htp_drawing(2)))
+    index.add(first, RESULT)
+    # Even with every hash in range, a different drawing fails the pixel check
+    assert index.find(other, max_distance=256) is None
+
+
+def test_rescans_reuse_the_report(index):
+    store = get_image_store()
+    drawing = htp_drawing(3)
+    index.add(store.put(encode(drawing)), RESULT)
+    for copy in (encode(drawing, "JPEG", quality=60), encode(drawing.resize((200, 200)))):
+        match = index.find(store.put(copy))
+        assert match is not None and match["result"] == RESULT
+
+
+def test_indexes_are_scoped():
+    digest = get_image_store().put(encode(htp_drawing(4)))
+    get_drawing_index("tenant-a").add(digest, RESULT)
+    assert get_drawing_index("tenant-a").find(digest)["result"] == RESULT
+    assert get_drawing_index("tenant-b").find(digest) is None
+    with pytest.raises(ValueError):
+        get_drawing_index("../tenant-a")
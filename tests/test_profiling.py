@@ -0,0 +1,32 @@
+import argparse
+import threading
+import time
+
+from src.profiling import add_profile_arguments, profile_session
+
+
+def busy_in_worker_thread():
+    deadline = time.monotonic() + 0.3
+    while time.monotonic() < deadline:
+        sum(range(1000))
+
+
+def run_in_thread():
+    thread = threading.Thread(target=busy_in_worker_thread)
+    thread.start()
+    thread.join()
+
+
+def test_sampling_mode_sees_worker_threads(tmp_path):
+    with profile_session(str(tmp_path), "sampling", memory=False) as profiler:
+        run_in_thread()
+    assert "busy_in_worker_thread" in profiler.sampler.folded()
+
+
+def test_default_mode_per_entry_point():
+    parser = argparse.ArgumentParser()
+    add_profile_arguments(parser)
+    assert parser.parse_args([]).profile_mode == "cpu"
+    parser = argparse.ArgumentParser()
+    add_profile_arguments(parser, default_mode="sampling")
+    assert parser.parse_args([]).profile_mode == "sampling"
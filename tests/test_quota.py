@@ -0,0 +1,35 @@
+import pytest
+
+from src import quota
+from src.quota import ANONYMOUS, QuotaLimiter, RateLimited, UsageStore, tenant_id
+
+
+@pytest.fixture
+def limiter(tmp_path):
+    return QuotaLimiter(UsageStore(str(tmp_path / "usage.sqlite3")))
+
+
+def test_limits_are_off_by_default(limiter):
+    tenant = limiter.tenant(None, "10.0.0.1")
+    for _ in range(200):
+        limiter.check_request(tenant)
+    assert not limiter.limits_tokens
+    assert limiter.reserve_tokens(tenant, 10 ** 9) == 0
+
+
+def test_anonymous_callers_are_keyed_by_client():
+    first, second = tenant_id(None, "10.0.0.1"), tenant_id(None, "10.0.0.2")
+    assert first != second and first.startswith(ANONYMOUS)
+    assert tenant_id(None, "10.0.0.1") == first
+    assert tenant_id("key", "10.0.0.1") == tenant_id("key", "10.0.0.2")
+
+
+def test_one_anonymous_client_does_not_limit_another(limiter, monkeypatch):
+    monkeypatch.setattr(quota, "RATE_LIMIT_RPM", 60)
+    monkeypatch.setattr(quota, "RATE_LIMIT_BURST", 2)
+    noisy = limiter.tenant(None, "10.0.0.1")
+    limiter.check_request(noisy)
+    limiter.check_request(noisy)
+    with pytest.raises(RateLimited):
+        limiter.check_request(noisy)
+    limiter.check_request(limiter.tenant(None, "10.0.0.2"))
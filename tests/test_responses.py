@@ -0,0 +1,54 @@
+import gzip
+
+import brotli
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src.app.responses import CompressionMiddleware, FastJSONResponse, negotiate_encoding
+
+PAYLOAD = {"final": "The drawing shows a house, a tree and a person. " * 50, "status": "ok"}
+
+
+@pytest.fixture
+def client():
+    app = FastAPI(default_response_class=FastJSONResponse)
+    app.add_middleware(CompressionMiddleware)
+
+    @app.get("/report")
+    def report():
+        return PAYLOAD
+
+    @app.get("/small")
+    def small():
+        return {"status": "ok"}
+
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", "br"),
+    ("gzip", "gzip"),
+    ("br;q=0.5, gzip", "gzip"),
+    ("*", "br"),
+    ("identity", None),
+    ("", None),
+])
+def test_negotiate_encoding(header, expected):
+    assert negotiate_encoding(header) == expected
+
+
+@pytest.mark.parametrize("encoding, decompress", [("br", brotli.decompress), ("gzip", gzip.decompress)])
+def test_round_trip(client, encoding, decompress):
+    with client.stream("GET", "/report", headers={"Accept-Encoding": encoding}) as response:
+        body = b"".join(response.iter_raw())
+    assert response.headers["content-encoding"] == encoding
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) == len(body)
+    assert FastJSONResponse(PAYLOAD).body == decompress(body)
+
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get("/small", headers={"Accept-Encoding": "br, gzip"})
+    assert "content-encoding" not in response.headers
+    assert response.json() == {"status": "ok"}
@@ -0,0 +1,71 @@
+import io
+import os
+
+from PIL import Image
+
+from src.image_store import get_image_store
+from src.phash import get_drawing_index
+from src.session_images import SessionRegistry
+
+
+def png(color) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def inactive(session_id: str) -> bool:
+    return False
+
+
+def test_eviction_removes_session_files():
+    store = get_image_store()
+    registry = SessionRegistry()
+    images = registry.get("session-a")
+    images.add("drawing", png("red"), "model")
+    digest = images.digest("drawing")
+    get_drawing_index("session-a")
+    assert store.contains(digest) and store.contains(digest, "model")
+
+    assert registry.evict(is_active=inactive) == 1
+    assert not store.contains(digest)
+    assert not store.contains(digest, "model")
+    assert not os.path.exists(os.path.join(store.root, "phash", "session-a"))
+
+
+def test_replaced_and_removed_images_are_deleted():
+    store = get_image_store()
+    images = SessionRegistry().get("session-b")
+    images.add("drawing", png("green"))
+    first = images.digest("drawing")
+    images.add("drawing", png("blue"))
+    second = images.digest("drawing")
+    assert not store.contains(first) and store.contains(second)
+
+    images.remove("drawing")
+    assert not store.contains(second)
+
+
+def test_shared_image_survives_until_last_session_ends():
+    store = get_image_store()
+    registry = SessionRegistry()
+    data = png("yellow")
+    registry.get("session-c").add("drawing", data)
+    registry.get("session-d").add("canvas", data)
+    digest = registry.get("session-c").digest("drawing")
+
+    registry.evict(is_active=lambda session_id: session_id != "session-c")
+    assert store.contains(digest)
+    registry.evict(is_active=inactive)
+    assert not store.contains(digest)
+
+
+def test_permanently_stored_images_are_kept():
+    store = get_image_store()
+    data = png("purple")
+    digest = store.put(data)
+    registry = SessionRegistry()
+    registry.get("session-e").add("drawing", data)
+
+    registry.evict(is_active=inactive)
+    assert store.contains(digest)